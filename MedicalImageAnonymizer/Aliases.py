@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import csv
+import hmac
+import json
+import hashlib
+import binascii
+import sqlite3
+import threading
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampier@unibo.it', 'nico.curti2@unibo.it']
+__package__ = 'Patient aliases'
+
+
+class AliasTable (object):
+
+  def __init__ (self, filename, index=None, max_memory=2**26):
+    '''
+    Look up table of the patient aliases (original value -> alias).
+
+    The table is read from a CSV file (original,alias on each line) or
+    from a JSON file (a single object). Small tables are kept in memory
+    as a dictionary; the bigger ones (e.g. multi-million rows) are
+    converted once into an SQLite index next to the source file, which is
+    opened read-only by every thread and worker process, so the table is
+    never loaded in memory and each lookup is a primary key search.
+
+    Parameters
+    ----------
+      filename: str
+        CSV or JSON file of the aliases
+
+      index: str
+        filename of the SQLite index (default filename + '.sqlite').
+        It is rebuilt if the source file is newer.
+
+      max_memory: int
+        source files bigger than this (in bytes) are indexed on disk
+
+    Example
+    -------
+    >>> aliases = AliasTable('aliases.csv')
+    >>> aliases.get('PAT0001')
+    'ANON0001'
+    '''
+
+    self.filename = filename
+    self._ext = os.path.splitext(filename)[-1].lower()
+
+    if self._ext not in ('.csv', '.json'):
+      raise ValueError('Alias file extension not supported. Given: {}'.format(filename))
+
+    self._table = None
+    self._index = None
+    self._local = threading.local()
+
+    if os.path.getsize(filename) > max_memory:
+      self._index = index or filename + '.sqlite'
+      self._build_index()
+
+    else:
+      self._table = dict(self._read())
+
+  def _read (self):
+    '''
+    (original, alias) pairs of the source file
+    '''
+
+    if self._ext == '.json':
+
+      with open(self.filename, 'r', encoding='utf-8') as fp:
+        table = json.load(fp)
+
+      if not isinstance(table, dict):
+        raise ValueError('Invalid alias file: a JSON object (original : alias) is required')
+
+      yield from ((str(k), str(v)) for k, v in table.items())
+      return
+
+    with open(self.filename, 'r', encoding='utf-8', newline='') as fp:
+
+      for i, row in enumerate(csv.reader(fp)):
+
+        if not row:
+          continue
+
+        if len(row) != 2:
+          raise ValueError('Invalid alias file format at line {:d}! The file must contain only '
+                           'two items for each line (aka original_name,alias_name)'.format(i + 1))
+
+        yield row[0].strip(), row[1].strip()
+
+  def _build_index (self):
+    '''
+    (re)build the SQLite index if it is missing or out of date
+    '''
+
+    if os.path.isfile(self._index) and os.path.getmtime(self._index) >= os.path.getmtime(self.filename):
+      return
+
+    # built aside and moved in place, so concurrent processes
+    # never open a partial index
+    partial = '{}.{:d}.part'.format(self._index, os.getpid())
+
+    if os.path.isfile(partial):
+      os.remove(partial)
+
+    db = sqlite3.connect(partial)
+
+    try:
+      db.execute('PRAGMA journal_mode = OFF')
+      db.execute('PRAGMA synchronous = OFF')
+      db.execute('CREATE TABLE aliases (original TEXT PRIMARY KEY, alias TEXT NOT NULL) WITHOUT ROWID')
+      db.executemany('INSERT OR REPLACE INTO aliases VALUES (?, ?)', self._read())
+      db.commit()
+
+    finally:
+      db.close()
+
+    os.replace(partial, self._index)
+
+  def _connection (self):
+    '''
+    read-only connection to the index of the current thread
+    '''
+
+    db = getattr(self._local, 'db', None)
+
+    if db is None:
+      db = sqlite3.connect('file:{}?mode=ro'.format(self._index), uri=True)
+      self._local.db = db
+
+    return db
+
+  def get (self, original, default=None):
+    '''
+    The alias of the given value (default if it is not in the table)
+    '''
+
+    if self._table is not None:
+      return self._table.get(original, default)
+
+    row = self._connection().execute('SELECT alias FROM aliases WHERE original = ?', (original, )).fetchone()
+    return row[0] if row is not None else default
+
+  def __getitem__ (self, original):
+
+    alias = self.get(original)
+
+    if alias is None:
+      raise KeyError(original)
+
+    return alias
+
+  def __contains__ (self, original):
+    return self.get(original) is not None
+
+  def __len__ (self):
+
+    if self._table is not None:
+      return len(self._table)
+
+    return self._connection().execute('SELECT COUNT(*) FROM aliases').fetchone()[0]
+
+  def __getstate__ (self):
+    # the connections are opened again by each process
+    state = self.__dict__.copy()
+    del state['_local']
+    return state
+
+  def __setstate__ (self, state):
+    self.__dict__.update(state)
+    self._local = threading.local()
+
+
+class KeyedAliases (object):
+
+  def __init__ (self, key, prefix='ANON', length=16):
+    '''
+    Aliases derived from the original values with a keyed hash (HMAC-SHA256).
+
+    The same value is always mapped to the same alias, on any machine
+    and in any process which uses the same key, so no table has to be
+    shared and the cost of each alias is a single hash. Without the key
+    the aliases can not be linked back to the original values: keep it
+    secret and do not lose it.
+
+    Parameters
+    ----------
+      key: bytes or str
+        the secret key
+
+      prefix: str
+        prefix of the aliases
+
+      length: int
+        number of hexadecimal digits of the aliases (at most 64)
+
+    Example
+    -------
+    >>> aliases = KeyedAliases.from_file('site.key')
+    >>> aliases.get('PAT0001')
+    'ANON6F1C0A1D33B5E72A'
+    '''
+
+    if isinstance(key, str):
+      key = key.encode('utf-8')
+
+    if not key:
+      raise ValueError('Empty key: the aliases would not be secret')
+
+    self._key = key
+    self.prefix = prefix
+    self.length = length
+    # the key is processed once, each alias costs a copy and an update
+    self._hmac = hmac.new(key, digestmod=hashlib.sha256)
+
+  @classmethod
+  def from_file (cls, filename, **kwargs):
+    '''
+    Read the key from the given file (e.g. created by create_key)
+    '''
+
+    with open(filename, 'rb') as fp:
+      key = fp.read().strip()
+
+    return cls(key, **kwargs)
+
+  @staticmethod
+  def create_key (filename, nbytes=32):
+    '''
+    Write a new random key into the given file (it is never overwritten)
+    '''
+
+    with open(filename, 'x') as fp:
+      fp.write(binascii.hexlify(os.urandom(nbytes)).decode('ascii') + '\n')
+
+  def get (self, original, default=None):
+    '''
+    The alias of the given value (default if the value is empty)
+    '''
+
+    original = str(original).strip()
+
+    if not original:
+      return default
+
+    digest = self._hmac.copy()
+    digest.update(original.encode('utf-8'))
+
+    return self.prefix + digest.hexdigest()[:self.length].upper()
+
+  def __getitem__ (self, original):
+
+    alias = self.get(original)
+
+    if alias is None:
+      raise KeyError(original)
+
+    return alias
+
+  def __contains__ (self, original):
+    return self.get(original) is not None
+
+  def __getstate__ (self):
+    # the hmac objects can not be pickled
+    return {'key' : self._key, 'prefix' : self.prefix, 'length' : self.length}
+
+  def __setstate__ (self, state):
+    self.__init__(**state)
+
+
+def load_aliases (filename, **kwargs):
+  '''
+  Load the aliases of the patients from the given file
+
+  Parameters
+  ----------
+    filename: str
+      CSV or JSON file of the aliases (see AliasTable) or
+      .key file with the secret key of the pseudonyms (see KeyedAliases)
+
+  Returns
+  -------
+    aliases: AliasTable or KeyedAliases
+      the aliases, which provide get(original, default=None)
+  '''
+
+  if os.path.splitext(filename)[-1].lower() == '.key':
+    return KeyedAliases.from_file(filename, **kwargs)
+
+  return AliasTable(filename, **kwargs)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import os
 
 __author__ = ['Enrico Giampieri', 'Nico Curti']
@@ -8,6 +9,46 @@ __email__ = ['enrico.giampier@unibo.it', 'nico.curti2@unibo.it']
 __package__ = 'Biomedical Images Anonymizer Base class'
 
 
+class OutputStream (io.RawIOBase):
+
+  def __init__ (self, sink):
+    '''
+    Forward-only binary writer over a generic sink
+
+    The position is tracked so the image writers can query it, but
+    random access is not allowed: this is enough to stream the
+    anonymized data into a pipe, a socket or a remote (SFTP) file.
+    The sink is not closed by the stream.
+
+    Parameters
+    ----------
+      sink: file-like
+        any object with a write method
+    '''
+
+    self._sink = sink
+    self._position = 0
+
+  def writable (self):
+    return True
+
+  def write (self, data):
+    self._sink.write(data)
+    self._position += len(data)
+    return len(data)
+
+  def tell (self):
+    return self._position
+
+  def seek (self, offset, whence=io.SEEK_SET):
+
+    if (whence == io.SEEK_SET and offset == self._position) or \
+       (whence == io.SEEK_CUR and offset == 0):
+      return self._position
+
+    raise io.UnsupportedOperation('OutputStream does not support random access')
+
+
 class Anonymizer (object):
 
   def __init__ (self, filename):
@@ -25,7 +66,65 @@ class Anonymizer (object):
 
     self._filename = filename
 
+  def _lookup_alias (self, alias, keys):
+    '''
+    Alias of the patient
+
+    Parameters
+    ----------
+      alias: str or alias table
+        a constant alias, or a table (e.g. AliasTable) which
+        provides get(original, default=None)
+
+      keys: iterable of str
+        the original values to look up in the table, in order of priority
+
+    Returns
+    -------
+      alias: str
+        the constant alias or the alias of the first key found
+
+    Raises
+    ------
+      KeyError
+        if the table is given and none of the keys is in the table
+    '''
+
+    if isinstance(alias, (str, bytes)):
+      return alias
+
+    for key in keys:
+      if key:
+        value = alias.get(key)
+        if value is not None:
+          return value
+
+    # the original values are not reported: the message ends into the logs
+    raise KeyError('No alias found for the patient of {}'.format(self._filename))
+
+  @staticmethod
+  def _is_stream (outfile):
+    '''
+    Check if the output is a writable file-like object instead of a filename
+    '''
+    return hasattr(outfile, 'write')
+
   def anonymize (self, outfile=None, outlog=None, infolog=False):
+    '''
+    Anonymize the file
+
+    Parameters
+    ----------
+      outfile: str or file-like
+        output filename or writable binary file-like object (sink) in
+        which the anonymized data are streamed
+
+      outlog: str
+        filename of the (local) information log used to revert the anonymization
+
+      infolog: bool
+        store the sensitive informations into the information log
+    '''
     pass
 
   def deanonymize (self, infolog=False):
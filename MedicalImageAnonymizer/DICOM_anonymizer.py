@@ -4,63 +4,324 @@
 import os
 import json
 import pydicom
+from pydicom.tag import Tag
+from pydicom.datadict import dictionary_VR
 from ast import literal_eval
-from configparser import ConfigParser
+from functools import lru_cache
 
 from MedicalImageAnonymizer.Anonymizer import Anonymizer
+from MedicalImageAnonymizer.Anonymizer import OutputStream
+from MedicalImageAnonymizer.Profiler import profiler
+from MedicalImageAnonymizer.Metrics import per_file
+from MedicalImageAnonymizer import DICOM_profile as dp
 
 __author__ = ['Enrico Giampieri', 'Nico Curti']
 __email__ = ['enrico.giampier@unibo.it', 'nico.curti2@unibo.it']
 __package__ = 'DICOM Anonymizer'
 
 
+# values given by the dummy action, according to the VR
+_dummy_values = {'AE' : 'ANONYMOUS', 'AS' : '000Y', 'CS' : 'ANONYMOUS', 'DA' : '19000101',
+                 'DS' : '0', 'DT' : '19000101000000', 'FD' : 0., 'FL' : 0., 'IS' : '0',
+                 'LO' : 'ANONYMOUS', 'LT' : 'ANONYMOUS', 'PN' : 'ANONYMOUS', 'SH' : 'ANONYMOUS',
+                 'SL' : 0, 'SS' : 0, 'ST' : 'ANONYMOUS', 'TM' : '000000', 'UC' : 'ANONYMOUS',
+                 'UL' : 0, 'US' : 0, 'UT' : 'ANONYMOUS',
+                 }
+
+# the values of these VRs are not stored in the information log
+# when they are removed or replaced by the profile
+_binary_vrs = frozenset(('OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN'))
+# these VRs are stored as numbers, so they can be set back
+_numeric_vrs = frozenset(('FD', 'FL', 'SL', 'SS', 'SV', 'UL', 'US', 'UV'))
+
+
+def _tag_key (tag):
+  '''
+  the tag as written in dicom_tags.ini (and in the information logs)
+  '''
+  return "('{:04x}', '{:04x}')".format(tag.group, tag.element)
+
+
+def _log_value (elem):
+  '''
+  the value of the element as stored in the information log
+  '''
+  value = elem.value
+
+  if elem.VR in _numeric_vrs:
+    return list(value) if elem.VM > 1 else value
+
+  if elem.VM > 1:
+    return '\\'.join(str(v) for v in value)
+
+  return str(value)
+
+
+def _private_block (tag):
+  '''
+  (group << 8) | block of a private creator (gggg,00xx)
+  or of a private data element (gggg,xxee)
+  '''
+  element = tag & 0xffff
+  return (tag >> 8) & 0xffffff00 | (element if element <= 0xff else element >> 8)
+
+
+def _remove_private (dataset, safe_creators=frozenset(), listed=(), infos=None, path=''):
+  '''
+  Remove all the private elements (odd group numbers) of the dataset,
+  except the blocks reserved by the safe private creators and the tags
+  listed in the profile (their own action is applied by the scrub).
+
+  Only the tags (the keys of the dataset) are tested, so the elements
+  removed are never decoded; only the creators are read, if needed, and
+  the values logged into infos (if given), as for the other removed
+  elements, when their VR is not binary.
+  '''
+  private = [tag for tag in dataset.keys() if tag & 0x10000 and tag not in listed]
+
+  if private and safe_creators:
+    safe = {_private_block(tag) for tag in private
+            if 0x10 <= tag & 0xffff <= 0xff and str(dataset[tag].value).strip() in safe_creators}
+
+    if safe:
+      private = [tag for tag in private if _private_block(tag) not in safe]
+
+  for tag in private:
+
+    # the implicit VR elements (VR None) are decoded to find their VR
+    if infos is not None and dataset.get_item(tag).VR not in _binary_vrs:
+      elem = dataset[tag]
+      if elem.VR not in _binary_vrs:
+        infos[path + _tag_key(tag)] = _log_value(elem)
+
+    del dataset[tag]
+
+
+@lru_cache(maxsize=None)
+def _load_tags_profile (filename):
+  '''
+  Profile of the tags of the configuration file (once for all the files)
+  '''
+  return dp.DICOMProfile.from_tags(filename)
+
+
 class DICOMAnonymize (Anonymizer):
 
-  def __init__ (self, filename, alias='0'):
+  _alias_tags = dp.alias_tags
+
+  def __init__ (self, filename, alias='0', uid_map=None, profile=None, masks=None):
+    '''
+    DICOM anonymizer object
+
+    Parameters
+    ----------
+      filename: str
+        DICOM filename to anonymize
+
+      alias: str or alias table
+        the alias of the patient, or a look up table of the aliases
+        (e.g. AliasTable) indexed by the original PatientID or PatientName
+
+      uid_map: UIDMap
+        if given, the UIDs (study, series, instance, frame of reference
+        and their references inside the sequences) are remapped
+
+      profile: DICOMProfile
+        the confidentiality profile to apply. If None, the tags of
+        GUI/dicom_tags.ini are set to '0'. A profile remaps the UIDs
+        with uid_map (or, if not given, with the map of the profile)
+        unless its retain_uids option is set.
+
+      masks: PixelMasks
+        if given, the burned-in annotations of the matching images are
+        masked (the original pixels can not be restored)
+    '''
 
     super(DICOMAnonymize, self).__init__(filename)
     self.alias = alias
-    self._load_tags_list(os.path.join(os.path.dirname(__file__), 'GUI', 'dicom_tags.ini'))
+
+    if profile is None:
+      self._load_tags_list(os.path.join(os.path.dirname(__file__), 'GUI', 'dicom_tags.ini'))
+
+    else:
+      self.profile = profile
+
+      if profile.retain_uids:
+        uid_map = None
+      elif uid_map is None:
+        uid_map = profile.uid_map
+
+    self.uid_map = uid_map
+    self.masks = masks
 
   def _load_tags_list (self, filename):
 
-    parser = ConfigParser()
-    parser.read(filename)
+    self.profile = _load_tags_profile(filename)
+
+  def _scrub (self, dataset, alias, remap, infos, path=''):
+    '''
+    Apply the actions of the profile to the elements of the dataset,
+    recursively into the sequences, in a single pass
 
-    self.TAG_CODES = parser._sections['DICOM_TAGS']
+    Parameters
+    ----------
+      dataset: pydicom.Dataset
+        the dataset (or sequence item) to scrub
 
-  def _get_value_from_tag (self, img):
+      alias: str
+        the alias of the patient
 
-    infos = {}
+      remap: callable
+        function which remaps the UIDs (None to keep them)
+
+      infos: dict
+        the original values, keyed by the path of the element
+        (e.g. "('0008', '1120')/0/('0010', '0010')" for the first
+        item of a sequence)
+
+      path: str
+        path of the dataset (empty for the top level)
+    '''
+    actions = self.profile.actions
+    rules = self.profile.rules
+    removed = []
+
+    if self.profile.remove_private:
+      _remove_private(dataset, self.profile.safe_private_creators, actions, infos, path)
+
+    for elem in dataset:
+
+      tag = elem.tag
+      action = actions.get(tag)
+
+      if action is None:
+        for mask, match, rule in rules:
+          if tag & mask == match:
+            action = rule
+            break
+
+      if elem.VR == 'SQ':
+
+        if action == dp.REMOVE:
+          removed.append(tag)
+
+        elif action in (dp.ZERO, dp.DUMMY):
+          elem.value = []
+
+        else:
+          for i, item in enumerate(elem.value):
+            self._scrub(item, alias, remap, infos, '{}{}/{:d}/'.format(path, _tag_key(tag), i))
+
+        continue
+
+      if action is None or action == dp.REMAP:
+        if remap is not None and elem.VR == 'UI' and elem.value:
+          elem.value = [remap(uid) for uid in elem.value] if elem.VM > 1 else remap(elem.value)
+        continue
+
+      if action == dp.KEEP:
+        continue
+
+      if action in (dp.ALIAS, dp.LEGACY_ZERO) or elem.VR not in _binary_vrs:
+        infos[path + _tag_key(tag)] = _log_value(elem)
+
+      if action == dp.REMOVE:
+        removed.append(tag)
+      elif action == dp.ZERO:
+        elem.value = None
+      elif action == dp.DUMMY:
+        elem.value = _dummy_values.get(elem.VR)
+      elif action == dp.ALIAS:
+        elem.value = alias
+      else:
+        elem.value = b'0'
+
+    for tag in removed:
+      del dataset[tag]
+
+  def _restore (self, img, infos):
+    '''
+    Set the original values of the information log. Both the paths of
+    the nested elements and the plain tags (old logs) are accepted.
+    The removed elements are added again, except the private ones and
+    those inside the removed sequences.
+    '''
+
+    for key, value in infos.items():
+      *parents, tag = key.split('/')
+      tag = Tag(literal_eval(tag))
+      dataset = img
 
-    for k, tag in self.TAG_CODES.items():
       try:
-        infos[tag] = str(img[literal_eval(tag)].value)
-      except KeyError:
-        pass
 
-    return infos
+        for sequence, index in zip(parents[::2], parents[1::2]):
+          dataset = dataset[Tag(literal_eval(sequence))].value[int(index)]
 
-  def _set_value_from_tag (self, img, infos=None):
+        if tag in dataset:
+          dataset[tag].value = value
+        else:
+          dataset.add_new(tag, dictionary_VR(tag), value)
 
-    if infos is not None:
-      for k, v in infos.items():
-        img[literal_eval(k)].value = v
+      except (KeyError, IndexError):
+        # the VR of the private tags is unknown
+        continue
 
-    else:
-      for k, tag in self.TAG_CODES.items():
-        try:
-          img[literal_eval(tag)].value = b'0' # TODO: add alias here for the patient name
-        except KeyError:
-          pass
+  def _patient_alias (self, img):
+    '''
+    Alias of the patient of the given dataset
+    '''
+    keys = (str(img[tag].value) for tag in self._alias_tags if tag in img)
+    return self._lookup_alias(self.alias, keys)
+
+  def _map_uids (self, dataset, function):
+    '''
+    Replace all the UIDs of the dataset (recursively into the
+    sequences) with function(uid)
+    '''
+
+    for elem in dataset:
+
+      if elem.VR == 'SQ':
+        for item in elem.value:
+          self._map_uids(item, function)
+
+      elif elem.VR == 'UI' and elem.value:
+        elem.value = [function(uid) for uid in elem.value] if elem.VM > 1 else function(elem.value)
+
+  def _remap_meta (self, img):
+
+    # the file meta information refers to the same instance
+    if 'MediaStorageSOPInstanceUID' in getattr(img, 'file_meta', ()):
+      img.file_meta.MediaStorageSOPInstanceUID = self.uid_map.remap(img.file_meta.MediaStorageSOPInstanceUID)
+
+  def _restore_uids (self, img):
 
+    restore = lambda uid : self.uid_map.original(uid) or uid
 
+    self._map_uids(img, restore)
+
+    if 'MediaStorageSOPInstanceUID' in getattr(img, 'file_meta', ()):
+      img.file_meta.MediaStorageSOPInstanceUID = restore(img.file_meta.MediaStorageSOPInstanceUID)
+
+  @per_file('anonymize')
   def anonymize (self, outfile=None, outlog=None, infolog=False):
 
-    img = pydicom.dcmread(self._filename)
+    with profiler.stage('dicom.read', self._filename) as stage:
+      img = pydicom.dcmread(self._filename)
+      stage.add(bytes_read=os.path.getsize(self._filename))
+
+    with profiler.stage('dicom.scrub', self._filename):
+      infos = {}
+      remap = self.uid_map.remap if self.uid_map is not None else None
 
-    infos = self._get_value_from_tag(img)
-    self._set_value_from_tag(img)
+      self._scrub(img, self._patient_alias(img), remap, infos)
+
+      if remap is not None:
+        self._remap_meta(img)
+
+    if self.masks is not None:
+      with profiler.stage('dicom.pixels', self._filename):
+        self.masks.apply(img)
 
     if infolog is not None:
       root, ext = os.path.splitext(self._filename)
@@ -68,17 +329,31 @@ class DICOMAnonymize (Anonymizer):
       if outfile is None:
         outfile = root + '_anonym.dcm'
 
-      img.save_as(outfile)
+      with profiler.stage('dicom.write', self._filename) as stage:
+        if self._is_stream(outfile):
+          stream = OutputStream(outfile)
+          img.save_as(stream)
+          stage.add(bytes_written=stream.tell())
+        else:
+          img.save_as(outfile)
+          stage.add(bytes_written=os.path.getsize(outfile))
 
       if outlog is None:
         outlog = root + '_info.json'
 
-      with open(outlog, 'w', encoding='utf-8') as log:
-        json.dump(infos, log)
-        log.write('\n')
+      with profiler.stage('log.write', self._filename):
+        with open(outlog, 'w', encoding='utf-8') as log:
+          json.dump(infos, log)
+          log.write('\n')
 
     else:
-      img.save_as(self._filename)
+      with profiler.stage('dicom.write', self._filename) as stage:
+        img.save_as(self._filename)
+        stage.add(bytes_written=os.path.getsize(self._filename))
+
+    # the new pairs are stored only once the file is written
+    if self.uid_map is not None:
+      self.uid_map.commit()
 
 
   def deanonymize (self, infolog=False):
@@ -90,7 +365,10 @@ class DICOMAnonymize (Anonymizer):
       with open(root + '_info.json', 'r', encoding='utf-8') as log:
         infos = json.load(log)
 
-      self._set_value_from_tag(img, infos)
+      self._restore(img, infos)
+
+      if self.uid_map is not None:
+        self._restore_uids(img)
 
     else:
       img = pydicom.dcmread(self._filename)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+from ast import literal_eval
+from configparser import ConfigParser
+
+from pydicom.uid import ExplicitVRLittleEndian
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampier@unibo.it', 'nico.curti2@unibo.it']
+__package__ = 'DICOM burned-in annotation masks'
+
+
+# default templates of the package
+_default_masks = os.path.join(os.path.dirname(__file__), 'GUI', 'dicom_masks.ini')
+
+
+def _parse_regions (value):
+  '''
+  list of the (x0, y0, x1, y1) rectangles of a template
+  '''
+  regions = literal_eval(value)
+
+  # a single rectangle
+  if all(isinstance(x, int) for x in regions):
+    regions = (regions, )
+
+  if not regions or any(len(region) != 4 for region in regions):
+    raise ValueError('Invalid regions: each rectangle must be given as (x0, y0, x1, y1)')
+
+  return [tuple(int(x) for x in region) for region in regions]
+
+
+class PixelMasks (object):
+
+  def __init__ (self, filename=None):
+    '''
+    Templates of the burned-in annotations of the DICOM images.
+
+    Each template gives the rectangles of the pixel data which store the
+    patient informations (e.g. the banner of an ultrasound scanner) and
+    the attributes which select the images it applies to (Modality,
+    Manufacturer, ManufacturerModelName, Rows, Columns, ...). The
+    rectangles are zeroed on the decoded array of all the frames at once,
+    with a single (broadcast) slice assignment for each rectangle, and
+    the pixel data are encoded again only if a template matches.
+
+    Parameters
+    ----------
+      filename: str
+        ini file of the templates (default GUI/dicom_masks.ini): one
+        section for each template, with the attributes to match and the
+        rectangles as  regions = (x0, y0, x1, y1), ...  in pixels
+        (negative values count from the right/bottom border)
+
+    Notes
+    -----
+    The original pixels are not stored in the information log, so the
+    masking can not be undone by deanonymize.
+
+    Example
+    -------
+    >>> masks = PixelMasks('us_masks.ini')
+    >>> DICOMAnonymize('us.dcm', masks=masks).anonymize(infolog=True)
+    '''
+
+    self.filename = filename or _default_masks
+
+    parser = ConfigParser()
+    parser.optionxform = str
+
+    if not parser.read(self.filename):
+      raise FileNotFoundError('Mask templates not found: {}'.format(self.filename))
+
+    # templates grouped by modality, so each image is compared
+    # only with those of its modality (or without modality)
+    self.templates = {}
+
+    for name in parser.sections():
+      section = dict(parser[name])
+
+      if 'regions' not in section:
+        raise ValueError('Template {} without regions'.format(name))
+
+      regions = _parse_regions(section.pop('regions'))
+      modality = section.pop('Modality', '').strip().upper() or None
+      attributes = {keyword : value.strip().upper() for keyword, value in section.items()}
+
+      self.templates.setdefault(modality, []).append((name, attributes, regions))
+
+  def __len__ (self):
+    return sum(len(templates) for templates in self.templates.values())
+
+  def match (self, img):
+    '''
+    The rectangles of the templates which match the given dataset
+
+    Returns
+    -------
+      regions: list
+        the (x0, y0, x1, y1) rectangles to mask (empty if no template matches)
+    '''
+
+    modality = str(img.get('Modality', '')).strip().upper()
+    candidates = self.templates.get(modality, []) + self.templates.get(None, [])
+    regions = []
+
+    for name, attributes, rectangles in candidates:
+
+      if all(str(img.get(keyword, '')).strip().upper() == value for keyword, value in attributes.items()):
+        regions.extend(rectangles)
+
+    return regions
+
+  def apply (self, img):
+    '''
+    Mask the burned-in annotations of the dataset (in place)
+
+    Returns
+    -------
+      masked: bool
+        True if a template matches and the pixel data were encoded again
+    '''
+
+    if 'PixelData' not in img:
+      return False
+
+    regions = self.match(img)
+
+    if not regions:
+      return False
+
+    if img.BitsAllocated == 1:
+      raise ValueError('The burned-in annotations of 1 bit images can not be masked')
+
+    samples = img.get('SamplesPerPixel', 1)
+    arr = img.pixel_array
+
+    if not arr.flags.writeable:
+      arr = arr.copy()
+
+    # rows and columns are the last two axes (or the two before the
+    # samples), so each slice covers all the frames at once
+    channels = (slice(None), ) if samples > 1 else ()
+
+    for x0, y0, x1, y1 in regions:
+      arr[(Ellipsis, slice(y0, y1), slice(x0, x1)) + channels] = 0
+
+    self._encode(img, arr, samples)
+
+    return True
+
+  @staticmethod
+  def _encode (img, arr, samples):
+    '''
+    store the array as native (uncompressed) pixel data
+    '''
+
+    if img.file_meta.TransferSyntaxUID.is_compressed:
+      img.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    if samples > 1:
+      # the color images are decoded as interleaved RGB
+      img.PhotometricInterpretation = 'RGB'
+      img.PlanarConfiguration = 0
+
+    img.PixelData = arr.tobytes()
+    img['PixelData'].VR = 'OW' if img.BitsAllocated > 8 else 'OB'
+    img['PixelData'].is_undefined_length = False
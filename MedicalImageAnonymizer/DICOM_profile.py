@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+from ast import literal_eval
+from configparser import ConfigParser
+
+from pydicom.tag import Tag
+
+from MedicalImageAnonymizer.UIDMap import UIDMap
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampier@unibo.it', 'nico.curti2@unibo.it']
+__package__ = 'DICOM confidentiality profile'
+
+
+# actions of the profile (PS3.15 Table E.1-1)
+REMOVE = 'X'
+ZERO = 'Z'
+DUMMY = 'D'
+KEEP = 'K'
+REMAP = 'U'
+# actions of the anonymizer: the patient alias and the
+# value '0' given to the tags of dicom_tags.ini
+ALIAS = 'A'
+LEGACY_ZERO = '0'
+
+_actions = (REMOVE, ZERO, DUMMY, KEEP, REMAP, ALIAS, LEGACY_ZERO)
+
+# tags which receive the patient alias (PatientID, PatientName),
+# their original values are looked up in this order
+alias_tags = (Tag(0x0010, 0x0020), Tag(0x0010, 0x0010))
+
+# default profile of the package
+_default_profile = os.path.join(os.path.dirname(__file__), 'GUI', 'dicom_profile.ini')
+
+
+def _parse_action (action):
+  '''
+  The action of a compound code (e.g. X/Z/D): the last one is
+  used, since it keeps the dataset conformant to its IOD
+  '''
+  action = action.strip().replace('*', '').split('/')[-1]
+
+  if action not in _actions:
+    raise ValueError('Unknown profile action: {}'.format(action))
+
+  return action
+
+
+def _parse_tags (section):
+  '''
+  (tag as integer, action) of each line of the section
+  '''
+  for name, value in section.items():
+    tag, action = value.rsplit(',', 1)
+    yield int(Tag(literal_eval(tag.strip()))), _parse_action(action)
+
+
+class DICOMProfile (object):
+
+  def __init__ (self, filename=None, options=(), safe_private_creators=()):
+    '''
+    Attribute confidentiality profile of the DICOM files
+    (PS3.15 Annex E, Basic Application Level Confidentiality Profile).
+
+    The profile is compiled at load time into a dictionary of the
+    actions keyed by the tag as integer, plus a few group-wide rules
+    (tag & mask == value) for all the private groups and the curve
+    (50xx) and overlay (60xx) groups, so the cost of each element is a
+    dictionary lookup and does not grow with the size of the profile.
+
+    Parameters
+    ----------
+      filename: str
+        ini file of the profile (default GUI/dicom_profile.ini), with a
+        BASIC_PROFILE section, an optional GROUP_RULES section and a
+        section for each option
+
+      options: list of str
+        the options of the profile (e.g. 'retain_uids',
+        'retain_device_identity', 'retain_institution_identity',
+        'retain_patient_characteristics', 'retain_longitudinal_full_dates',
+        'retain_safe_private')
+
+      safe_private_creators: list of str
+        private creators whose blocks are kept, in addition to those of
+        the RETAIN_SAFE_PRIVATE section (if that option is selected)
+
+    Notes
+    -----
+    The actions are X (remove), Z (zero length), D (dummy value), K (keep)
+    and U (remap the UID). PatientID and PatientName always receive the
+    alias of the patient (see DICOMAnonymize).
+
+    All the private groups are removed in bulk (see remove_private),
+    except the blocks reserved by the safe private creators.
+
+    Unless the retain_uids option is set, the profile owns an in-memory
+    UIDMap (uid_map), so all the files anonymized with the same profile
+    (or with its copies in the worker processes) share the same UIDs.
+    A UIDMap with a database must be given to DICOMAnonymize to restore
+    the original UIDs.
+
+    Example
+    -------
+    >>> profile = DICOMProfile(options=('retain_patient_characteristics', ))
+    >>> profile.action(0x00100010)
+    'A'
+    '''
+
+    self.filename = filename or _default_profile
+    self.options = tuple(option.lower() for option in options)
+
+    parser = ConfigParser()
+    parser.optionxform = str
+
+    if not parser.read(self.filename):
+      raise FileNotFoundError('Profile not found: {}'.format(self.filename))
+
+    self.actions = dict(_parse_tags(parser['BASIC_PROFILE']))
+    self.remove_private = True
+    self.safe_private_creators = frozenset(creator.strip() for creator in safe_private_creators)
+
+    for option in self.options:
+
+      section = option.upper()
+
+      if section not in parser or section in ('BASIC_PROFILE', 'GROUP_RULES'):
+        raise ValueError('Unknown profile option: {}'.format(option))
+
+      if section == 'RETAIN_SAFE_PRIVATE':
+        self.safe_private_creators |= {creator.strip() for creator in parser[section].values()}
+      else:
+        self.actions.update(_parse_tags(parser[section]))
+
+    self.rules = []
+
+    if parser.has_section('GROUP_RULES'):
+
+      for name, value in parser['GROUP_RULES'].items():
+        mask, match, action = (v.strip() for v in value.split(','))
+        self.rules.append((int(mask, 16), int(match, 16), _parse_action(action)))
+
+    self._set_alias_tags()
+
+    self.uid_map = None if self.retain_uids else UIDMap()
+
+  @classmethod
+  def from_tags (cls, filename, remove_private=False, safe_private_creators=()):
+    '''
+    Profile of a list of tags (e.g. dicom_tags.ini) which are all set
+    to '0', without group-wide rules. If remove_private, all the other
+    private elements are removed too, except the blocks of the safe
+    private creators.
+    '''
+    profile = cls.__new__(cls)
+    profile.filename = filename
+    profile.options = ()
+    profile.remove_private = remove_private
+    profile.safe_private_creators = frozenset(creator.strip() for creator in safe_private_creators)
+
+    parser = ConfigParser()
+    parser.read(filename)
+
+    profile.actions = {int(Tag(literal_eval(tag))) : LEGACY_ZERO for tag in parser['DICOM_TAGS'].values()}
+    profile.rules = []
+    profile.uid_map = None
+    profile._set_alias_tags()
+
+    return profile
+
+  def _set_alias_tags (self):
+
+    for tag in alias_tags:
+      self.actions[int(tag)] = ALIAS
+
+  @property
+  def retain_uids (self):
+    return 'retain_uids' in self.options
+
+  def action (self, tag):
+    '''
+    The action of the given tag (None if it is not in the profile)
+    '''
+    action = self.actions.get(tag)
+
+    if action is not None:
+      return action
+
+    for mask, match, action in self.rules:
+      if tag & mask == match:
+        return action
+
+    return None
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from collections import OrderedDict
+
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+class FileRegistry (object):
+  '''
+  Ordered set of the files loaded in the GUI, shared by all the tabs.
+
+  The files are keyed by their resolved path, so the same file loaded
+  twice (from different tabs, or by a relative and an absolute path) is
+  stored once. Each file keeps the steps it went through (anonymized,
+  pushed, pulled) as independent flags, each one with the scopes in
+  which it was done (e.g. the output directory of the anonymization),
+  so the tabs can skip the work already done with O(1) lookups.
+  '''
+
+  states = ('anonymized', 'pushed', 'pulled')
+
+  def __init__ (self):
+
+    # resolved path : {state : set of scopes}
+    self._files = OrderedDict()
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def _key (filename):
+    return os.path.realpath(str(filename))
+
+  def _check (self, state):
+
+    if state not in self.states:
+      raise ValueError('Unknown state {}: it must be one of {}'.format(state, ', '.join(self.states)))
+
+  def __len__ (self):
+    return len(self._files)
+
+  def __contains__ (self, filename):
+    return self._key(filename) in self._files
+
+  def __iter__ (self):
+    with self._lock:
+      return iter(list(self._files))
+
+  def add (self, filenames):
+    '''
+    Add the files not yet registered
+
+    Parameters
+    ----------
+      filenames: iterable of str or path
+        the files to add
+
+    Returns
+    -------
+      added: int
+        number of files actually added (the others were already registered)
+    '''
+    added = 0
+
+    with self._lock:
+
+      for filename in filenames:
+        key = self._key(filename)
+
+        if key not in self._files:
+          self._files[key] = {}
+          added += 1
+
+    return added
+
+  def mark (self, filename, state, scope=None):
+    '''
+    Record that the file went through the given step (registering it
+    if needed). The other steps are not affected: e.g. a file pushed
+    raw is not anonymized.
+
+    Parameters
+    ----------
+      filename: str or path
+        the file processed
+
+      state: str
+        the step done ('anonymized', 'pushed' or 'pulled')
+
+      scope: hashable
+        where the step was done (e.g. the output directory of the
+        anonymization). The step must be done again in a new scope.
+    '''
+    self._check(state)
+    key = self._key(filename)
+
+    with self._lock:
+      self._files.setdefault(key, {}).setdefault(state, set()).add(scope)
+
+  def steps (self, filename):
+    '''
+    The steps done on the file, in any scope (None if it is not registered)
+    '''
+    steps = self._files.get(self._key(filename))
+    return frozenset(steps) if steps is not None else None
+
+  def todo (self, state, filenames=None, scope=None):
+    '''
+    The files which have not yet gone through the given step
+
+    Parameters
+    ----------
+      state: str
+        the step to do (e.g. 'pushed' to get the files to push)
+
+      filenames: list of str or path
+        if given, filter these files (keeping their names and order)
+        instead of the whole registry
+
+      scope: hashable
+        the scope of the step (see mark)
+
+    Returns
+    -------
+      files: list
+        the files to process, in order of registration (or of filenames)
+    '''
+    self._check(state)
+
+    with self._lock:
+
+      if filenames is None:
+        return [key for key, steps in self._files.items() if scope not in steps.get(state, ())]
+
+      return [filename for filename in filenames
+              if scope not in self._files.get(self._key(filename), {}).get(state, ())]
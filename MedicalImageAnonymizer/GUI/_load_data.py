@@ -8,12 +8,19 @@ from tkinter import ttk
 import os
 import json
 import shutil
+import threading
 from glob import glob
 from pathlib import Path
 
 from MedicalImageAnonymizer import DICOMAnonymize
 from MedicalImageAnonymizer import NiftiAnonymize
 from MedicalImageAnonymizer import SVSAnonymize
+from MedicalImageAnonymizer.Profiler import profiler
+from MedicalImageAnonymizer.Aliases import load_aliases
+from MedicalImageAnonymizer.UIDMap import UIDMap
+from _tasks import _BackgroundTask
+from _log_sink import _LogSink
+from _file_registry import FileRegistry
 
 
 __author__ = ['Enrico Giampieri', 'Nico Curti']
@@ -31,17 +38,29 @@ class _Anonymizer (ttk.Frame):
                   # add other aliases
                   }
 
+  # anonymizers which accept the patient aliases
+  _aliased = (DICOMAnonymize, NiftiAnonymize)
 
-  def __init__ (self, *args, **kwargs):
+
+  def __init__ (self, *args, config=None, **kwargs):
 
     super(_Anonymizer, self).__init__(*args, **kwargs)
 
+    # configuration tab (for the optional ANONYMIZE parameters)
+    self._config = config
     self._files = []
     self._outdir = ''
     self._alias = None
+    self._alias_source = None
+    # UID map of the output directory, shared by the worker threads
+    self._uid_map = None
+    self._lock = threading.Lock()
+    # files of all the tabs with their processing state
+    self._registry = FileRegistry()
 
     # add log
     self._winfos = tk.scrolledtext.ScrolledText(self, width=60, height=20)
+    self._log = _LogSink(self._winfos)
     # variables
     self._import_type = tk.IntVar()
     self._num_files = tk.StringVar()
@@ -53,6 +72,7 @@ class _Anonymizer (ttk.Frame):
     self._wnum_files = tk.Label(self, textvariable=self._num_files)
     self._wanonym = tk.Button(self, text='Anonymize', fg='red', command=self._anonymize_cb)
     self._walias = tk.Button(self, text='Load Aliases', command=self._load_alias_cb)
+    self._task = _BackgroundTask(self)
 
     # widget on grid
     self._winfos.grid(column=0, row=2, columnspan=3, rowspan=2)
@@ -62,6 +82,7 @@ class _Anonymizer (ttk.Frame):
     self._wnum_files.grid(column=4, row=1)
     self._walias.grid(column=4, row=2)
     self._wanonym.grid(column=4, row=3)
+    self._task.grid(column=0, row=4, columnspan=3)
 
     # widget values
     self._winfos.insert(tk.INSERT, self._template_log())
@@ -100,7 +121,7 @@ class _Anonymizer (ttk.Frame):
     dtypes = ''.join('  {}:{}\n'.format(k, v ) for k, v in found)
     log = '{}\nLoad {} files:\n{}\noutput directory: {}\n'.format(log, len(self._files), dtypes, self._outdir)
 
-    self._winfos.insert(tk.INSERT, log)
+    self._log.write(log)
 
 
   def _load_from_directory (self):
@@ -114,62 +135,54 @@ class _Anonymizer (ttk.Frame):
     available_ext = ('*.{}'.format(x.lower()) for x in self._anonymizers.keys())
 
     found = []
-    files = glob(os.path.join(self._indir, '**', '*'), recursive=True)
-    self._files = [x for x in files if Path(x).is_file() and not Path(x).is_symlink() and not Path(x).suffix == '.lnk']
 
-    for ext in available_ext:
-      all_files_in_subdirs = glob(os.path.join(self._indir, '**', ext), recursive=True)
-      found.append((ext, len(all_files_in_subdirs)))
+    with profiler.stage('walk', self._indir) as stage:
+
+      files = glob(os.path.join(self._indir, '**', '*'), recursive=True)
+      self._files = [x for x in files if Path(x).is_file() and not Path(x).is_symlink() and not Path(x).suffix == '.lnk']
+
+      for ext in available_ext:
+        all_files_in_subdirs = glob(os.path.join(self._indir, '**', ext), recursive=True)
+        found.append((ext, len(all_files_in_subdirs)))
+
+      stage.add(files=len(self._files))
 
     self._outdir = self._indir + '_anonym'
 
     dtypes = ''.join('  {}:{}\n'.format(k, v ) for k, v in found)
     log = 'Found {} files in {}:\n{}\noutput directory: {}\n'.format(len(self._files), self._indir, dtypes, self._outdir)
 
-    self._winfos.insert(tk.INSERT, log)
+    self._log.write(log)
 
 
   def _load_alias_cb (self):
     '''
     load alias file as name look up table
     '''
-    # TODO:
-    tk.messagebox.showerror('Error', 'Option not yet supported!')
-    return
-
     local = os.path.abspath('.')
     alias_file = tk.filedialog.askopenfilename(initialdir=local, title='Select alias file',
                                                filetypes=(('csv', '*.csv'),
                                                           ('json', '*.json'),
+                                                          ('key', '*.key'),
                                                           ('all files', '*.*'))
                                                )
 
-    root, ext = os.path.splitext(self._alias)
-
-    if ext == '.csv':
-      self._alias = {}
-
-      with open(alias_file, 'r') as fp:
-        lines = fp.read().splitlines()
-
-      for line in lines:
-        try:
-          original, alias = line.split(',')
-        except Exception:
-          tk.messagebox.showerror('Error',
-                                  'Invalid file format! '
-                                  'The file must contain only two items '
-                                  '(aka original_name,alias_name')
+    if not alias_file:
+      return
 
-        self._alias[original] = alias
+    try:
+      self._alias = load_aliases(alias_file)
+      # a new version of the same file is a new alias table
+      self._alias_source = (os.path.realpath(alias_file), os.path.getmtime(alias_file))
 
-    elif ext == '.json':
-      with open(alias_file, 'r') as fp:
-        self._alias = json.load(fp)
+    except Exception as e:
+      tk.messagebox.showerror('Error', str(e))
+      return
 
+    if hasattr(self._alias, '__len__'):
+      self._log.write('Loaded {} aliases from {}\n'.format(len(self._alias), alias_file))
     else:
-      tk.messagebox.showerror('Error',
-                              'Alias file extension not supported.')
+      self._log.write('Aliases derived from the key {}\n'.format(alias_file))
 
 
   def _load_cb (self):
@@ -185,6 +198,7 @@ class _Anonymizer (ttk.Frame):
     else:
       raise ValueError('Something goes wrong')
 
+    self._registry.add(self._files)
     self._num_files.set('# of files: {}'.format(len(self._files)))
 
 
@@ -200,39 +214,111 @@ class _Anonymizer (ttk.Frame):
 
   def _anonymize_cb (self):
     '''
-    Anonymize the loaded file list
+    Anonymize the loaded file list in background
     '''
 
+    if self._task.running:
+      tk.messagebox.showerror('Error', 'A task is already running!')
+      return
+
     os.makedirs(self._outdir, exist_ok=True)
+    os.makedirs(self._outdir + '_log', exist_ok=True)
 
-    log = 'Anonymizing {} file(s)...\n\n'.format(len(self._files))
-    issues = 0
+    # keep the whole log next to the information logs of the files
+    self._log.mirror(os.path.join(self._outdir + '_log', 'anonymize.log'))
+    # the files already anonymized (into the same output directory
+    # with the same aliases) are not processed again
+    scope = (os.path.realpath(self._outdir), self._alias_source)
+    file_list = self._registry.todo('anonymized', self._files, scope=scope)
+    total = len(file_list)
 
-    for i in range(len(self._files)):
+    if total < len(self._files):
+      self._log.write('Skip {} file(s): already anonymized\n'.format(len(self._files) - total))
 
-      err = self._anonymize(self._files[i])
-      issues += err
+    self._log.write('Anonymizing {} file(s)...\n\n'.format(total))
 
-      # log
-      log = '{}Anonymize {}...\n'.format(log, self._files[i])
-      self._winfos.delete(1., tk.END)
-      self._winfos.insert(tk.INSERT, log)
+    issues = []
 
-    if issues:
-      tk.messagebox.showwarning('Warning!',
-                                '{} files have troubles in the anonymization! '
-                                'We suggest to not push them before an accurate review!'.format(issues))
+    def _on_result (filename, outfile, error):
 
-    tk.messagebox.showinfo('Anonymizer!',
-                           '{}/{} files have been anonymized! '
-                           ''.format(len(self._files) - issues, len(self._files)))
+      if error is not None:
+        print(error)
+        issues.append(filename)
+        log = 'Fail {}: it can be corrupted or not a valid {} file\n'.format(filename, Path(filename).suffix[1:].upper())
+      else:
+        log = 'Anonymize {}...\n'.format(filename)
+        self._registry.mark(filename, 'anonymized', scope=scope)
 
+      self._log.write(log)
 
+    def _on_done (cancelled, error):
+
+      if profiler.enabled:
+        self._log.write('\n{}\n'.format(profiler.table()))
+
+      self._log.flush()
+      self._log.mirror(None)
+
+      if issues:
+        tk.messagebox.showwarning('Warning!',
+                                  '{} files have troubles in the anonymization! '
+                                  'We suggest to not push them before an accurate review!'.format(len(issues)))
+
+      tk.messagebox.showinfo('Anonymizer!',
+                             '{}{}/{} files have been anonymized! '
+                             ''.format('Anonymization cancelled: ' if cancelled else '',
+                                       self._task.processed - len(issues), total))
+
+    self._task.map(self._anonymize, file_list, on_result=_on_result, on_done=_on_done)
+
+
+  def _get_anonymizer (self, dtype, filename):
+    '''
+    Anonymizer of the given file, with the aliases loaded (if any)
+
+    Raises
+    ------
+      KeyError
+        if no anonymizer is available for the format
+    '''
+    anonymizer = self._anonymizers[dtype]
+    kwargs = {}
+
+    if self._alias is not None and anonymizer in self._aliased:
+      kwargs['alias'] = self._alias
+
+    if anonymizer is DICOMAnonymize and self._config is not None and \
+       self._config.anonymize_params['remap_uids']:
+      kwargs['uid_map'] = self._get_uid_map()
+
+    return anonymizer(filename, **kwargs)
+
+
+  def _get_uid_map (self):
+    '''
+    UID map of the current output directory, so the files anonymized
+    in different runs keep the same UIDs
+    '''
+    database = os.path.join(self._outdir + '_log', 'uid_map.sqlite')
+
+    with self._lock:
+
+      if self._uid_map is None or self._uid_map.database != database:
+        os.makedirs(self._outdir + '_log', exist_ok=True)
+        self._uid_map = UIDMap(database=database)
+
+      return self._uid_map
 
 
   def _anonymize (self, filename):
     '''
-    Anonymize the filename given
+    Anonymize the filename given into the output directory
+
+    Returns
+    -------
+      outfile: Path
+        the anonymized file (or its copy if no anonymizer is
+        available for its format)
     '''
 
     path_filename = Path(filename)
@@ -244,25 +330,52 @@ class _Anonymizer (ttk.Frame):
     outlog.parent.mkdir(parents=True, exist_ok=True)
 
     try:
-
-      anonymizer = self._anonymizers[dtype](filename)
-      anonymizer.anonymize(infolog=True, outfile=str(outfile), outlog=str(outlog.with_suffix('.json')))
+      anonymizer = self._get_anonymizer(dtype, filename)
 
     except KeyError as e:
       # no anonymizer available but it could be a usefull file
       shutil.copy(str(path_filename), str(outfile))
+      return outfile
+
+    # the per-file metrics are recorded by the anonymizer
+    anonymizer.anonymize(infolog=True, outfile=str(outfile), outlog=str(outlog.with_suffix('.json')))
+
+    return outfile
+
+
+  def _anonymize_to (self, filename, sink):
+    '''
+    Anonymize the filename given streaming the output into the
+    writable sink (the information log is stored locally)
+    '''
+
+    path_filename = Path(str(filename))
+    dtype = path_filename.suffix[1:].upper()
+    outlog = Path(self._outdir + '_log')/path_filename.absolute().relative_to(self._indir)
+
+    outlog.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+      anonymizer = self._get_anonymizer(dtype, str(path_filename))
+
+    except KeyError as e:
+      # no anonymizer available but it could be a usefull file
+      with open(str(path_filename), 'rb') as fp:
+        shutil.copyfileobj(fp, sink)
+      return
+
+    try:
+      anonymizer.anonymize(infolog=True, outfile=sink, outlog=str(outlog.with_suffix('.json')))
 
     except Exception as e:
       print(e)
-      tk.messagebox.showwarning('Warning!',
-                                'Found some troubles in the anonymization'
-                                ' of file {}. It can be corrupted or not '
-                                'a valid {} file'.format(filename, dtype))
-      return True
-
-    return False
+      raise
 
 
   @property
   def file_list (self):
     return self._files
+
+  @property
+  def registry (self):
+    return self._registry
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import tkinter as tk
+
+import threading
+from collections import deque
+
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+class _LogSink (object):
+
+  def __init__ (self, widget, max_lines=5000, interval=200, filename=None):
+    '''
+    Bounded log of a text widget.
+
+    The messages are buffered and appended to the widget in a single
+    insert every interval ms, so the cost of each message does not depend
+    on the length of the log. Only the last max_lines lines are kept in
+    the widget (and in the buffer, as ring buffer), while the whole log
+    can be mirrored into a file.
+
+    Parameters
+    ----------
+      widget: tk.Text
+        the text widget which shows the log
+
+      max_lines: int
+        maximum number of lines kept in the widget
+
+      interval: int
+        period of the updates of the widget in ms
+
+      filename: str
+        if given, the whole log is appended to this file too
+    '''
+
+    self._widget = widget
+    self._max_lines = max_lines
+    self._interval = interval
+
+    # messages not yet shown: the oldest are dropped if they would
+    # be removed from the widget anyway
+    self._pending = deque(maxlen=max_lines)
+    self._lock = threading.Lock()
+    self._mirror = None
+
+    if filename:
+      self.mirror(filename)
+
+    self._widget.after(self._interval, self._tick)
+
+  def mirror (self, filename):
+    '''
+    Append the following messages to the given file (None to stop)
+    '''
+
+    with self._lock:
+
+      if self._mirror is not None:
+        self._mirror.close()
+
+      self._mirror = open(filename, 'a', encoding='utf-8') if filename else None
+
+  def write (self, message):
+    '''
+    Add a message to the log (it can be called from any thread)
+    '''
+
+    with self._lock:
+      self._pending.append(message)
+
+      if self._mirror is not None:
+        self._mirror.write(message)
+
+  def flush (self):
+    '''
+    Show the pending messages (it must be called from the main thread)
+    '''
+
+    with self._lock:
+      batch = ''.join(self._pending)
+      self._pending.clear()
+
+      if self._mirror is not None:
+        self._mirror.flush()
+
+    if not batch:
+      return
+
+    # follow the end of the log only if the user is not scrolling back
+    at_bottom = self._widget.yview()[1] >= 1.
+
+    self._widget.insert(tk.END, batch)
+
+    lines = int(self._widget.index('end-1c').split('.')[0])
+
+    if lines > self._max_lines:
+      self._widget.delete('1.0', '{:d}.0'.format(lines - self._max_lines + 1))
+
+    if at_bottom:
+      self._widget.see(tk.END)
+
+  def _tick (self):
+
+    self.flush()
+    self._widget.after(self._interval, self._tick)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from queue import Queue
+from collections import deque
+from collections import namedtuple
+
+from plumbum import local
+from _ssh_utils import get_sha1
+from _ssh_utils import push_files
+from MedicalImageAnonymizer.Metrics import metrics
+
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+# outcome of a file processed by the pipeline:
+#  filename: the original file
+#  staged: the anonymized file in the staging area (None on failure)
+#  destination: the remote location of the file (None on failure)
+#  pushed: False if the file was already on the server
+#  error: the exception raised by the anonymization (None on success)
+PipelineResult = namedtuple('PipelineResult', ['filename', 'staged', 'destination', 'pushed', 'error'])
+
+# end of stream marker for the queues between the stages
+_END = None
+
+
+class _StagingBudget (object):
+  '''
+  Number of bytes which can be stored in the staging area.
+
+  The anonymization of a new file waits until the files already staged
+  are uploaded, so the staging area never exceeds the given size
+  (a single file bigger than the whole budget is processed alone).
+  '''
+
+  def __init__ (self, max_bytes):
+    '''
+    Parameters
+    ----------
+      max_bytes: int or None
+        maximum size of the staging area. None means unlimited
+    '''
+    self._max_bytes = max_bytes
+    self._used = 0
+    self._cond = threading.Condition()
+
+  def acquire (self, nbytes):
+
+    with self._cond:
+
+      if self._max_bytes is not None:
+        self._cond.wait_for(lambda : self._used == 0 or self._used + nbytes <= self._max_bytes)
+
+      self._used += nbytes
+
+  def release (self, nbytes):
+
+    with self._cond:
+      self._used -= nbytes
+      self._cond.notify_all()
+
+  def resize (self, reserved, nbytes):
+    '''
+    replace a reservation with the actual size of the staged file
+    '''
+    with self._cond:
+      self._used += nbytes - reserved
+      self._cond.notify_all()
+
+
+class Pipeline (object):
+  '''
+  Overlapped anonymize -> hash -> upload pipeline.
+
+  Each stage runs in its own thread and the stages are connected by
+  bounded queues: while a file is uploaded, the next one is hashed and
+  the following one is anonymized.
+  '''
+
+  def __init__ (self, anonymize, params, remote_config, max_staging=None, queue_size=4, codec=None):
+    '''
+    Parameters
+    ----------
+      anonymize: callable
+        function which anonymizes the given file into the staging area
+        and returns the path of the anonymized file
+
+      params: dict
+        parameters of the connection host
+
+      remote_config: dict
+        parameters of the remote server
+
+      max_staging: int or None
+        maximum number of bytes stored in the staging area.
+        If given, the staged files are removed as soon as they are uploaded.
+
+      queue_size: int
+        maximum number of files waiting between two stages
+
+      codec: TransferCodec
+        if given, the files are compressed on the wire when convenient
+    '''
+    self._anonymize = anonymize
+    self._params = params
+    self._remote_config = remote_config
+    self._max_staging = max_staging
+    self._queue_size = queue_size
+    self._codec = codec
+    self._stop = threading.Event()
+
+  def _anonymize_stage (self, file_list, budget, staged, results):
+
+    try:
+
+      for filename in file_list:
+
+        if self._stop.is_set():
+          break
+
+        reserved = 0
+
+        try:
+          reserved = os.path.getsize(filename)
+          budget.acquire(reserved)
+          outfile = self._anonymize(filename)
+          size = os.path.getsize(str(outfile))
+
+        except Exception as e:
+          budget.release(reserved)
+          results.put(PipelineResult(filename, None, None, False, e))
+          continue
+
+        # replace the estimate with the actual size of the staged file
+        budget.resize(reserved, size)
+
+        staged.put((filename, outfile, size))
+        metrics.set_queue_depth('staged', staged.qsize())
+
+    finally:
+      # the following stages must always be released
+      staged.put(_END)
+
+  def _hash_stage (self, staged, hashed, budget, results):
+
+    try:
+
+      for item in iter(staged.get, _END):
+        filename, outfile, size = item
+
+        try:
+          origin_hash = get_sha1(str(outfile))
+
+        except Exception as e:
+          budget.release(size)
+          results.put(PipelineResult(filename, None, None, False, e))
+          continue
+
+        hashed.put((filename, outfile, size, origin_hash))
+        metrics.set_queue_depth('staged', staged.qsize())
+        metrics.set_queue_depth('hashed', hashed.qsize())
+
+    finally:
+      hashed.put(_END)
+
+  def _upload_stage (self, hashed, budget, results):
+
+    # the original names are needed after the upload and
+    # the files are pushed in order
+    pending = deque()
+    exhausted = threading.Event()
+
+    def _to_upload ():
+      for item in iter(hashed.get, _END):
+        filename, outfile, size, origin_hash = item
+        metrics.set_queue_depth('hashed', hashed.qsize())
+
+        if self._stop.is_set():
+          # cancelled: drop the files anonymized but not yet uploaded
+          budget.release(size)
+          continue
+
+        path = local.path(str(outfile))
+        pending.append((filename, size))
+        yield path, origin_hash
+
+      exhausted.set()
+
+    try:
+
+      for path, destination, pushed in push_files(_to_upload(), self._params, self._remote_config,
+                                                  codec=self._codec, batch_size=None):
+
+        filename, size = pending.popleft()
+
+        if self._max_staging is not None:
+          path.delete()
+
+        budget.release(size)
+        results.put(PipelineResult(filename, path, destination, pushed, None))
+
+    except Exception as e:
+      # the connection is lost: stop the whole pipeline and
+      # drain the previous stages
+      self._stop.set()
+      results.put(e)
+
+      for filename, size in pending:
+        budget.release(size)
+
+      if not exhausted.is_set():
+        for item in iter(hashed.get, _END):
+          budget.release(item[2])
+
+    finally:
+      results.put(_END)
+
+  def run (self, file_list):
+    '''
+    Anonymize and push the given files.
+
+    Parameters
+    ----------
+      file_list: list of str
+        the original files to process
+
+    Yields
+    ------
+      result: PipelineResult
+        the outcome of each file, in order of completion
+
+    Raises
+    ------
+      Exception
+        the error which stopped the upload (the files already
+        anonymized stay in the staging area)
+    '''
+    self._stop.clear()
+    budget = _StagingBudget(self._max_staging)
+    staged = Queue(maxsize=self._queue_size)
+    hashed = Queue(maxsize=self._queue_size)
+    results = Queue()
+
+    stages = [threading.Thread(target=self._anonymize_stage, args=(file_list, budget, staged, results)),
+              threading.Thread(target=self._hash_stage, args=(staged, hashed, budget, results)),
+              threading.Thread(target=self._upload_stage, args=(hashed, budget, results))]
+
+    for stage in stages:
+      stage.daemon = True
+      stage.start()
+
+    try:
+
+      for result in iter(results.get, _END):
+
+        if isinstance(result, Exception):
+          raise result
+
+        yield result
+
+    finally:
+      # the consumer can stop early (e.g. a cancel from the GUI):
+      # the files in flight are completed, the others are skipped
+      self._stop.set()
@@ -7,8 +7,13 @@ from tkinter import ttk
 
 import os
 from glob import glob
+from plumbum import local
 from plumbum.path import Path
-from _ssh_utils import pull_single_file
+from _ssh_utils import pull_files
+from _ssh_utils import sync_results
+from _ssh_codec import get_codec
+from _tasks import _BackgroundTask
+from _log_sink import _LogSink
 
 
 __author__ = ['Enrico Giampieri', 'Nico Curti']
@@ -23,13 +28,16 @@ class _Puller (ttk.Frame):
     super(_Puller, self).__init__(*args, **kwargs)
     self._prev_tab = prev_tab
 
-    self._files = []
+    # files shared with the other tabs
+    self._registry = prev_tab[1].registry
 
     # add log
     self._winfos = tk.scrolledtext.ScrolledText(self, width=60, height=20)
+    self._log = _LogSink(self._winfos)
     # variables
     self._import_type = tk.IntVar()
     self._num_files = tk.StringVar()
+    self._sync = tk.BooleanVar()
 
     # add widgets
     self._wload = tk.Button(self, text='Load', command=self._load_cb)
@@ -38,6 +46,8 @@ class _Puller (ttk.Frame):
     self._wnum_files = tk.Label(self, textvariable=self._num_files)
     #self._wupdate = tk.Button(self, text='Load Anonymize data', command=self._update_cb)
     self._wpull = tk.Button(self, text='Pull files', command=self._pull_cb)
+    self._wsync = tk.Checkbutton(self, text='Only new results', variable=self._sync)
+    self._task = _BackgroundTask(self)
 
     # widget on grid
     self._winfos.grid(column=0, row=2, columnspan=3, rowspan=2)
@@ -47,8 +57,10 @@ class _Puller (ttk.Frame):
     self._wnum_files.grid(column=4, row=1)
     #self._wupdate.grid(column=4, row=1)
     self._wpull.grid(column=4, row=2)
+    self._wsync.grid(column=4, row=3)
+    self._task.grid(column=0, row=4, columnspan=3)
 
-    self._num_files.set('# of files: {}'.format(len(self._files)))
+    self._num_files.set('# of files: {}'.format(len(self._registry)))
 
 
   def _load_from_file (self):
@@ -68,20 +80,21 @@ class _Puller (ttk.Frame):
     if not listfile:
       return
 
-    self._files = list(listfile)
+    files = list(listfile)
+    self._registry.add(files)
 
-    log = 'Loading {} file'.format('\n'.join(self._files))
+    log = 'Loading {} file'.format('\n'.join(files))
     available_ext = ('.{}'.format(x.lower()) for x in self._prev_tab[1]._anonymizers.keys())
 
     found = []
 
     for ext in available_ext:
-      found.append((ext, len([x for x in self._files if x.endswith(ext)])))
+      found.append((ext, len([x for x in files if x.endswith(ext)])))
 
     dtypes = ''.join('  {}:{}\n'.format(k, v ) for k, v in found)
-    log = '{}\nLoad {} files:\n{}\n'.format(log, len(self._files), dtypes)
+    log = '{}\nLoad {} files:\n{}\n'.format(log, len(files), dtypes)
 
-    self._winfos.insert(tk.INSERT, log)
+    self._log.write(log)
 
 
   def _load_from_directory (self):
@@ -95,18 +108,20 @@ class _Puller (ttk.Frame):
     available_ext = ('*.{}'.format(x.lower()) for x in self._prev_tab[1]._anonymizers.keys())
 
     found = []
-    self._files = []
+    files = []
 
     for ext in available_ext:
       all_files_in_subdirs = glob(os.path.join(directory, '**', ext), recursive=True)
-      self._files.extend(all_files_in_subdirs)
+      files.extend(all_files_in_subdirs)
 
       found.append((ext, len(all_files_in_subdirs)))
 
+    self._registry.add(files)
+
     dtypes = ''.join('  {}:{}\n'.format(k, v ) for k, v in found)
-    log = 'Found {} files in {}:\n{}\n'.format(len(self._files), directory, dtypes)
+    log = 'Found {} files in {}:\n{}\n'.format(len(files), directory, dtypes)
 
-    self._winfos.insert(tk.INSERT, log)
+    self._log.write(log)
 
   def _load_cb (self):
     '''
@@ -121,7 +136,7 @@ class _Puller (ttk.Frame):
     else:
       raise ValueError('Something goes wrong')
 
-    self._num_files.set('# of files: {}'.format(len(self._files)))
+    self._num_files.set('# of files: {}'.format(len(self._registry)))
 
   def _template_log (self):
     '''
@@ -130,20 +145,26 @@ class _Puller (ttk.Frame):
 
     return 'Config file: {}\n'\
            '# of files loaded: {}\n\n'\
-           ''.format(self._prev_tab[0].config, len(self._files))
+           ''.format(self._prev_tab[0].config, len(self._registry))
 
   def _update_cb (self):
     '''
     Update the variables
     '''
-    self._files = sum([self._files, self._prev_tab[1].file_list], [])
+    # the files loaded in the other tabs are already in the registry
+    self._log.flush()
     self._winfos.delete(1., tk.END)
     self._winfos.insert(tk.INSERT, self._template_log())
 
 
   def _pull_cb (self):
     '''
+    Pull the results of the loaded files in background
     '''
+    if self._task.running:
+      tk.messagebox.showerror('Error', 'A task is already running!')
+      return
+
     self._update_cb()
 
     if not self._prev_tab[0].config:
@@ -152,26 +173,86 @@ class _Puller (ttk.Frame):
 
     params = self._prev_tab[0].connection_params
     remote = self._prev_tab[0].remote_params
-    file_list = self._files
+    codec = get_codec(self._prev_tab[0].transfer_params)
+    pull_params = self._prev_tab[0].pull_params
 
-    if not len(file_list):
+    if not len(self._registry):
       tk.messagebox.showerror('Error', 'No file to pull!')
       return
 
+    if self._sync.get():
+      # the sync checks also the files already pulled for new results
+      self._sync_results(list(self._registry), params, remote, pull_params, codec)
+      return
+
+    file_list = self._registry.todo('pulled')
 
-    for file in file_list:
+    if not len(file_list):
+      tk.messagebox.showinfo('Pull', 'All the results have already been pulled!')
+      return
 
-      try:
-        file = Path(file)
-        destination = pull_single_file(file, destination_dir='.',
-                                       params=params, remote_config=remote)
+    results = pull_files(map(local.path, file_list), destination_dir=local.path(pull_params['destination_dir']),
+                         params=params, remote_config=remote, codec=codec)
 
-        log = 'Pull {}'.format(file)
-        self._winfos.insert(tk.INSERT, log)
+    def _on_result (result):
 
-      except Exception as e:
-        print(repr(e))
-        tk.messagebox.showerror('Error', repr(e))
+      file, pulled = result
+
+      if pulled:
+        self._registry.mark(file, 'pulled')
+
+      log = 'Pull {}: {} result(s)\n'.format(file, len(pulled))
+      self._log.write(log)
+
+    def _on_done (cancelled, error):
+
+      self._log.flush()
+
+      if error is not None:
+        print(repr(error))
+        tk.messagebox.showerror('Error', repr(error))
         return
 
-    tk.messagebox.showinfo('Pull', 'Pulled {} files'.format(len(self._files)))
+      tk.messagebox.showinfo('Pull', '{}Pulled {} files'.format('Pull cancelled: ' if cancelled else '',
+                                                              self._task.processed))
+
+    self._task.iterate(results, total=len(file_list), on_result=_on_result, on_done=_on_done)
+
+  def _sync_results (self, file_list, params, remote, pull_params, codec):
+    '''
+    Pull only the results not yet retrieved
+    '''
+    counts = {'pulled' : 0, 'failed' : 0}
+
+    results = sync_results(map(local.path, file_list), params=params, remote_config=remote,
+                           codec=codec, **pull_params)
+
+    def _on_result (result):
+
+      file, new, error = result
+
+      if error is not None:
+        log = 'Pull {} failed: {}\n'.format(file, repr(error))
+        counts['failed'] += 1
+      elif new:
+        log = 'Pull {}: {} new result(s)\n'.format(file, len(new))
+        self._registry.mark(file, 'pulled')
+        counts['pulled'] += len(new)
+      else:
+        return
+
+      self._log.write(log)
+
+    def _on_done (cancelled, error):
+
+      self._log.flush()
+
+      if error is not None:
+        print(repr(error))
+        tk.messagebox.showerror('Error', repr(error))
+        return
+
+      tk.messagebox.showinfo('Pull', '{}Pulled {pulled} new results ({failed} failures)'
+                                     ''.format('Pull cancelled: ' if cancelled else '', **counts))
+
+    self._task.iterate(results, total=len(file_list), on_result=_on_result, on_done=_on_done)
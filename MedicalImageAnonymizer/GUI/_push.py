@@ -8,7 +8,14 @@ from tkinter import ttk
 import os
 from glob import glob
 from plumbum.path import Path
-from _ssh_utils import push_single_file
+from _ssh_utils import push_files
+from _ssh_utils import stream_files
+from _ssh_utils import push_archive
+from _ssh_codec import get_codec
+from _pipeline import Pipeline
+from _pipeline import PipelineResult
+from _tasks import _BackgroundTask
+from _log_sink import _LogSink
 
 
 __author__ = ['Enrico Giampieri', 'Nico Curti']
@@ -22,13 +29,17 @@ class _Pusher (ttk.Frame):
     super(_Pusher, self).__init__(*args, **kwargs)
     self._prev_tab = prev_tab
 
-    self._files = []
+    # files shared with the other tabs
+    self._registry = prev_tab[1].registry
 
     # add log
     self._winfos = tk.scrolledtext.ScrolledText(self, width=60, height=20)
+    self._log = _LogSink(self._winfos)
     # variables
     self._import_type = tk.IntVar()
     self._num_files = tk.StringVar()
+    self._stream = tk.BooleanVar()
+    self._archive = tk.BooleanVar()
 
     # add widgets
     self._wload = tk.Button(self, text='Load', command=self._load_cb)
@@ -37,6 +48,10 @@ class _Pusher (ttk.Frame):
     self._wnum_files = tk.Label(self, textvariable=self._num_files)
     #self._wupdate = tk.Button(self, text='Load Anonymize data', command=self._update_cb)
     self._wpush = tk.Button(self, text='Push files', command=self._push_cb)
+    self._warchive = tk.Checkbutton(self, text='Pack into archives', variable=self._archive)
+    self._wpipeline = tk.Button(self, text='Anonymize & Push', fg='red', command=self._pipeline_cb)
+    self._wstream = tk.Checkbutton(self, text='No local copy', variable=self._stream)
+    self._task = _BackgroundTask(self)
 
     # widget on grid
     self._winfos.grid(column=0, row=2, columnspan=3, rowspan=2)
@@ -46,11 +61,15 @@ class _Pusher (ttk.Frame):
     self._wnum_files.grid(column=4, row=1)
     #self._wupdate.grid(column=4, row=1)
     self._wpush.grid(column=4, row=2)
+    self._warchive.grid(column=4, row=5)
+    self._wpipeline.grid(column=4, row=3)
+    self._wstream.grid(column=4, row=4)
+    self._task.grid(column=0, row=4, columnspan=3)
 
     # widget values
     self._winfos.insert(tk.INSERT, self._template_log())
 
-    self._num_files.set('# of files: {}'.format(len(self._files)))
+    self._num_files.set('# of files: {}'.format(len(self._registry)))
 
   def _load_from_file (self):
     '''
@@ -69,21 +88,22 @@ class _Pusher (ttk.Frame):
     if not listfile:
       return
 
-    self._files = list(listfile)
+    files = list(listfile)
+    self._registry.add(files)
 
-    log = 'Loading {} file'.format('\n'.join(self._files))
+    log = 'Loading {} file'.format('\n'.join(files))
 
     available_ext = ('.{}'.format(x.lower()) for x in self._prev_tab[1]._anonymizers.keys())
 
     found = []
 
     for ext in available_ext:
-      found.append((ext, len([x for x in self._files if x.endswith(ext)])))
+      found.append((ext, len([x for x in files if x.endswith(ext)])))
 
     dtypes = ''.join('  {}:{}\n'.format(k, v ) for k, v in found)
-    log = '{}\nLoad {} files:\n{}\n'.format(log, len(self._files), dtypes)
+    log = '{}\nLoad {} files:\n{}\n'.format(log, len(files), dtypes)
 
-    self._winfos.insert(tk.INSERT, log)
+    self._log.write(log)
 
 
   def _load_from_directory (self):
@@ -97,18 +117,20 @@ class _Pusher (ttk.Frame):
     available_ext = ('*.{}'.format(x.lower()) for x in self._prev_tab[1]._anonymizers.keys())
 
     found = []
-    self._files = []
+    files = []
 
     for ext in available_ext:
       all_files_in_subdirs = glob(os.path.join(directory, '**', ext), recursive=True)
-      self._files.extend(all_files_in_subdirs)
+      files.extend(all_files_in_subdirs)
 
       found.append((ext, len(all_files_in_subdirs)))
 
+    self._registry.add(files)
+
     dtypes = ''.join('  {}:{}\n'.format(k, v ) for k, v in found)
-    log = 'Found {} files in {}:\n{}\n'.format(len(self._files), directory, dtypes)
+    log = 'Found {} files in {}:\n{}\n'.format(len(files), directory, dtypes)
 
-    self._winfos.insert(tk.INSERT, log)
+    self._log.write(log)
 
   def _load_cb (self):
     '''
@@ -123,7 +145,7 @@ class _Pusher (ttk.Frame):
     else:
       raise ValueError('Something goes wrong')
 
-    self._num_files.set('# of files: {}'.format(len(self._files)))
+    self._num_files.set('# of files: {}'.format(len(self._registry)))
 
   def _template_log (self):
     '''
@@ -132,21 +154,27 @@ class _Pusher (ttk.Frame):
 
     return 'Config file: {}\n'\
            '# of files loaded: {}\n\n'\
-           ''.format(self._prev_tab[0].config, len(self._files))
+           ''.format(self._prev_tab[0].config, len(self._registry))
 
 
   def _update_cb (self):
     '''
     Update the variables
     '''
-    self._files = sum([self._files, self._prev_tab[1].file_list], [])
+    # the files loaded in the other tabs are already in the registry
+    self._log.flush()
     self._winfos.delete(1., tk.END)
     self._winfos.insert(tk.INSERT, self._template_log())
 
 
   def _push_cb (self):
     '''
+    Push the loaded files in background
     '''
+    if self._task.running:
+      tk.messagebox.showerror('Error', 'A task is already running!')
+      return
+
     self._update_cb()
 
     if not self._prev_tab[0].config:
@@ -155,25 +183,172 @@ class _Pusher (ttk.Frame):
 
     params = self._prev_tab[0].connection_params
     remote = self._prev_tab[0].remote_params
-    file_list = self._files
+    # the files already pushed are skipped without querying the server
+    file_list = self._registry.todo('pushed')
 
     if not len(file_list):
-      tk.messagebox.showerror('Error', 'No file to push!')
+      tk.messagebox.showerror('Error', 'No file to push!' if not len(self._registry) else
+                                       'All the files have already been pushed!')
+      return
+
+
+    if self._archive.get():
+      self._push_archive(file_list, params, remote)
       return
 
+    transfer_params = self._prev_tab[0].transfer_params
+    verify = transfer_params['verify'] if transfer_params['verify'] != 'off' else None
 
-    for file in file_list:
+    results = push_files(map(Path, file_list), params=params, remote_config=remote,
+                         codec=get_codec(transfer_params), verify=verify)
+    pushed = []
 
-      try:
-        file = Path(file)
-        destination = push_single_file(file, params=params, remote_config=remote)
+    def _on_result (result):
 
+      file, destination, is_new = result
+      self._registry.mark(file, 'pushed')
+
+      if is_new:
         log = 'Push {} on {}\n'.format(file, destination)
-        self._winfos.insert(tk.INSERT, log)
+        pushed.append(file)
+      else:
+        log = 'Skip {}: already pushed\n'.format(file)
+
+      self._log.write(log)
 
-      except Exception as e:
-        print(repr(e))
-        tk.messagebox.showerror('Error', repr(e))
+    def _on_done (cancelled, error):
+
+      self._log.flush()
+
+      if error is not None:
+        print(repr(error))
+        tk.messagebox.showerror('Error', repr(error))
         return
 
-    tk.messagebox.showinfo('Push', 'Pushed {} files'.format(len(file_list)))
+      tk.messagebox.showinfo('Push', '{}Pushed {}/{} files'.format('Push cancelled: ' if cancelled else '',
+                                                                  len(pushed), len(file_list)))
+
+    self._task.iterate(results, total=len(file_list), on_result=_on_result, on_done=_on_done)
+
+  def _push_archive (self, file_list, params, remote):
+    '''
+    Push the files packed into tar archives
+    '''
+
+    archive = self._prev_tab[0].archive_params
+    size = archive['files_per_archive']
+    pushed = []
+
+    def _archives ():
+      for i in range(0, len(file_list), size):
+        yield push_archive(map(Path, file_list[i : i + size]), params=params, remote_config=remote,
+                           compression=archive['compression'])
+
+    def _on_result (result):
+
+      destination, members = result
+
+      for file, _, _ in members:
+        self._registry.mark(file, 'pushed')
+
+      new = sum(is_new for _, _, is_new in members)
+      pushed.append(new)
+
+      log = 'Pack {} files in {}\n'.format(new, destination)
+      self._log.write(log)
+
+    def _on_done (cancelled, error):
+
+      self._log.flush()
+
+      if error is not None:
+        print(repr(error))
+        tk.messagebox.showerror('Error', repr(error))
+        return
+
+      tk.messagebox.showinfo('Push', '{}Pushed {}/{} files'.format('Push cancelled: ' if cancelled else '',
+                                                                  sum(pushed), len(file_list)))
+
+    self._task.iterate(_archives(), total=(len(file_list) + size - 1) // size, on_result=_on_result, on_done=_on_done)
+
+  def _pipeline_cb (self):
+    '''
+    Anonymize the files loaded in the Anonymize tab and push them
+    while the anonymization is still running
+    '''
+
+    if self._task.running:
+      tk.messagebox.showerror('Error', 'A task is already running!')
+      return
+
+    if not self._prev_tab[0].config:
+      tk.messagebox.showerror('Error', 'No config file loaded!')
+      return
+
+    params = self._prev_tab[0].connection_params
+    remote = self._prev_tab[0].remote_params
+    anonymizer = self._prev_tab[1]
+
+    if not len(anonymizer.file_list):
+      tk.messagebox.showerror('Error', 'No file to anonymize!')
+      return
+
+    file_list = self._registry.todo('pushed', anonymizer.file_list)
+
+    if not len(file_list):
+      tk.messagebox.showinfo('Push', 'All the files have already been pushed!')
+      return
+
+    if self._stream.get():
+      # stream the anonymized data directly to the server
+      results = (PipelineResult(file, None, destination, is_new,
+                                None if destination is not None else 'anonymization failed')
+                 for file, destination, is_new in stream_files(file_list, anonymizer._anonymize_to,
+                                                               params=params, remote_config=remote))
+
+    else:
+      os.makedirs(anonymizer._outdir, exist_ok=True)
+      pipeline = Pipeline(anonymizer._anonymize, params=params, remote_config=remote,
+                          codec=get_codec(self._prev_tab[0].transfer_params),
+                          **self._prev_tab[0].pipeline_params)
+      results = pipeline.run(file_list)
+
+    pushed = []
+    issues = []
+
+    def _on_result (result):
+
+      if result.error is not None:
+        print(result.error)
+        log = 'Fail {}: {}\n'.format(result.filename, result.error)
+        issues.append(result.filename)
+
+      elif result.pushed:
+        log = 'Push {} on {}\n'.format(result.filename, result.destination)
+        pushed.append(result.filename)
+        self._registry.mark(result.filename, 'pushed')
+
+      else:
+        log = 'Skip {}: already pushed\n'.format(result.filename)
+        self._registry.mark(result.filename, 'pushed')
+
+      self._log.write(log)
+
+    def _on_done (cancelled, error):
+
+      self._log.flush()
+
+      if error is not None:
+        print(repr(error))
+        tk.messagebox.showerror('Error', repr(error))
+        return
+
+      if issues:
+        tk.messagebox.showwarning('Warning!',
+                                  '{} files have troubles in the anonymization '
+                                  'and they have not been pushed!'.format(len(issues)))
+
+      tk.messagebox.showinfo('Push', '{}Pushed {}/{} files'.format('Push cancelled: ' if cancelled else '',
+                                                                  len(pushed), len(file_list)))
+
+    self._task.iterate(results, total=len(file_list), on_result=_on_result, on_done=_on_done)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import zlib
+import threading
+
+try:
+  import zstandard
+
+except ImportError:
+  zstandard = None
+
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+class TransferCodec (object):
+  '''
+  On-the-wire compression of the transfers.
+
+  Each file is compressed only if its format is not already compressed,
+  if a sample of its content compresses enough and if the measured
+  compression speed does not become the bottleneck of the link.
+  The data are (de)compressed on the fly: the remote side of the
+  transfer is performed by the gzip/zstd commands on the server.
+
+  The same codec can be shared by the threads of the parallel
+  transfers (e.g. the sync workers): its state is updated under a lock.
+  '''
+
+  # uncompressed formats which are worth compressing
+  _compressible = ('.dcm', '.dicom', '.nii')
+
+  # DICOM transfer syntaxes with already compressed pixel data
+  # (JPEG family, RLE and deflated explicit little endian)
+  _compressed_syntaxes = (b'1.2.840.10008.1.2.4', b'1.2.840.10008.1.2.5', b'1.2.840.10008.1.2.1.99')
+
+  suffixes = {'gzip' : '.gz',
+              'zstd' : '.zst'}
+
+  # commands executed on the server
+  remote_compress = {'gzip' : 'gzip -c -1',
+                     'zstd' : 'zstd -c -q -3'}
+  remote_decompress = {'gzip' : 'gzip -dc',
+                       'zstd' : 'zstd -dc -q'}
+
+  def __init__ (self, methods=('zstd', 'gzip'), min_ratio=1.2, sample_size=2**20, smoothing=.3,
+                adaptive=True, reprobe=32):
+    '''
+    Parameters
+    ----------
+      methods: list of str
+        compression methods in order of preference ('zstd' requires
+        the zstandard package, otherwise it is ignored)
+
+      min_ratio: float
+        minimum compression ratio of the sample for which the file
+        is compressed
+
+      sample_size: int
+        number of bytes of each file used to estimate the compression ratio
+
+      smoothing: float
+        weight of the new measurements in the running averages of the
+        link and compression speeds
+
+      adaptive: bool
+        skip the compression when it is slower than the link. If False
+        the first method is always used for the compressible files
+
+      reprobe: int
+        while the compression is skipped for its speed, one file every
+        reprobe is compressed anyway to measure the codec speed again
+    '''
+    self._methods = [m for m in methods if m == 'gzip' or (m == 'zstd' and zstandard is not None)]
+    self._min_ratio = min_ratio
+    self._sample_size = sample_size
+    self._smoothing = smoothing
+    self._adaptive = adaptive
+    self._reprobe = reprobe
+    self._skipped = 0
+    self._lock = threading.Lock()
+
+    self.link_speed = None
+    self.codec_speed = None
+
+  def _update (self, current, nbytes, seconds):
+
+    if seconds <= 0:
+      return current
+
+    speed = nbytes / seconds
+
+    if current is None:
+      return speed
+
+    return self._smoothing * speed + (1. - self._smoothing) * current
+
+  def record_link (self, nbytes, seconds):
+    '''
+    add a measurement of the bytes moved over the link
+    '''
+    with self._lock:
+      self.link_speed = self._update(self.link_speed, nbytes, seconds)
+
+  def record_codec (self, nbytes, seconds):
+    '''
+    add a measurement of the bytes (de)compressed
+    '''
+    with self._lock:
+      self.codec_speed = self._update(self.codec_speed, nbytes, seconds)
+
+  def disable (self, method):
+    '''
+    stop using a compression method (e.g. not available on the server)
+    '''
+    with self._lock:
+      if method in self._methods:
+        self._methods.remove(method)
+
+  def _codec_too_slow (self):
+    '''
+    True if the compression would be the bottleneck of the link
+    (to be called with the lock held)
+    '''
+    # the compression runs concurrently with the transfer: it is useful
+    # only if it is faster than the link
+    if not self._adaptive or self.link_speed is None or self.codec_speed is None or \
+       self.codec_speed > self.link_speed:
+      self._skipped = 0
+      return False
+
+    # the codec speed is measured only when the files are compressed:
+    # probe it again once in a while, since the first measurements can
+    # be pessimistic (cold start, small files) and the link can slow down
+    self._skipped += 1
+
+    if self._skipped >= self._reprobe:
+      self._skipped = 0
+      return False
+
+    return True
+
+  def _is_compressed_dicom (self, filepath):
+
+    with open(str(filepath), 'rb') as fp:
+      # the transfer syntax is stored in the file meta information
+      head = fp.read(4096)
+
+    return any(syntax in head for syntax in self._compressed_syntaxes)
+
+  def _sample_ratio (self, filepath):
+
+    with open(str(filepath), 'rb') as fp:
+      sample = fp.read(self._sample_size)
+
+    if not sample:
+      return 1.
+
+    return len(sample) / len(zlib.compress(sample, 1))
+
+  def select (self, filepath):
+    '''
+    Choose the compression method for the given file
+
+    Parameters
+    ----------
+      filepath: path
+        the (local) file to transfer
+
+    Returns
+    -------
+      method: str or None
+        the compression method to use. None if the file must be
+        transferred as it is
+    '''
+
+    if not self._methods:
+      return None
+
+    ext = os.path.splitext(str(filepath))[-1].lower()
+
+    if ext not in self._compressible:
+      return None
+
+    if ext in ('.dcm', '.dicom') and self._is_compressed_dicom(filepath):
+      return None
+
+    with self._lock:
+      if self._codec_too_slow():
+        return None
+
+    if self._sample_ratio(filepath) < self._min_ratio:
+      return None
+
+    # another thread can disable the methods in the meantime
+    with self._lock:
+      return self._methods[0] if self._methods else None
+
+  def select_remote (self, path):
+    '''
+    Choose the compression method for a remote file (the content
+    is not available, so only the format is considered)
+    '''
+
+    if not self._methods:
+      return None
+
+    if os.path.splitext(str(path))[-1].lower() not in self._compressible:
+      return None
+
+    with self._lock:
+
+      if not self._methods or self._codec_too_slow():
+        return None
+
+      return self._methods[0]
+
+  @staticmethod
+  def compressor (method):
+    '''
+    streaming compressor object (with compress and flush methods)
+    '''
+    if method == 'gzip':
+      return zlib.compressobj(1, zlib.DEFLATED, 31)
+    return zstandard.ZstdCompressor(level=3).compressobj()
+
+  @staticmethod
+  def decompressor (method):
+    '''
+    streaming decompressor object (with a decompress method)
+    '''
+    if method == 'gzip':
+      return zlib.decompressobj(31)
+    return zstandard.ZstdDecompressor().decompressobj()
+
+def get_codec (transfer_params):
+  '''
+  Build the transfer codec from the configuration parameters
+
+  Parameters
+  ----------
+    transfer_params: dict
+      the TRANSFER parameters of the configuration file
+
+  Returns
+  -------
+    codec: TransferCodec or None
+      None if the compression is disabled
+  '''
+  compression = transfer_params['compression']
+
+  if compression == 'off':
+    return None
+
+  if compression == 'auto':
+    return TransferCodec(methods=transfer_params['methods'], min_ratio=transfer_params['min_ratio'])
+
+  if compression not in TransferCodec.suffixes:
+    raise ValueError('Unknown compression {}: it must be auto, off, gzip or zstd'.format(compression))
+
+  if compression == 'zstd' and zstandard is None:
+    raise ImportError('zstd compression requires the zstandard package')
+
+  # a method given explicitly is always used for the compressible files
+  return TransferCodec(methods=(compression, ), min_ratio=transfer_params['min_ratio'], adaptive=False)
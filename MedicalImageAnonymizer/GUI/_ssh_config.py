@@ -11,6 +11,8 @@ import paramiko
 from glob import glob
 from configparser import ConfigParser
 
+from MedicalImageAnonymizer.Metrics import metrics
+
 __author__ = ['Enrico Giampieri', 'Nico Curti']
 __email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
 
@@ -34,6 +36,7 @@ class _Config (ttk.Frame):
     if available_cfg:
       self._cfg_file = available_cfg[0]
       self._parser.read(self._cfg_file)
+      self._start_metrics()
 
     # add log
     self._winfos = tk.scrolledtext.ScrolledText(self, width=60, height=25)
@@ -60,6 +63,7 @@ class _Config (ttk.Frame):
 
     try:
       self._parser.read(self._cfg_file)
+      self._start_metrics()
     except Exception as e:
       tk.messagebox.showerror('Error', e)
       return
@@ -89,6 +93,15 @@ class _Config (ttk.Frame):
            'done_subdir={5}\n' \
            'todo_subdir={6}\n\n'.format(*values)
 
+  def _start_metrics (self):
+    '''
+    Export the metrics if required by the (optional) METRICS section
+    '''
+    params = self.metrics_params
+
+    if params['port'] or params['textfile']:
+      metrics.enable(**params)
+
   def _check_config (self):
     '''
     Check if the config file has the minimum required sections
@@ -188,6 +201,67 @@ class _Config (ttk.Frame):
                 todo_subdir=self._parser.get('REMOTE', 'todo_subdir'),
                 )
 
+  @property
+  def pipeline_params (self):
+    '''
+    Return the (optional) parameters of the anonymize and push pipeline as dict
+    '''
+    max_staging = self._parser.getfloat('PIPELINE', 'max_staging_mb', fallback=0.)
+
+    return dict(max_staging=int(max_staging * 2**20) if max_staging > 0 else None,
+                queue_size=self._parser.getint('PIPELINE', 'queue_size', fallback=4),
+                )
+
+  @property
+  def archive_params (self):
+    '''
+    Return the (optional) parameters of the packed archive push mode as dict
+    '''
+    return dict(files_per_archive=self._parser.getint('ARCHIVE', 'files_per_archive', fallback=1000),
+                compression=self._parser.get('ARCHIVE', 'compression', fallback='') or None,
+                )
+
+  @property
+  def pull_params (self):
+    '''
+    Return the (optional) parameters of the download of the results as dict
+    '''
+    return dict(destination_dir=self._parser.get('PULL', 'destination_dir', fallback='.'),
+                workers=self._parser.getint('PULL', 'workers', fallback=4),
+                )
+
+  @property
+  def anonymize_params (self):
+    '''
+    Return the (optional) parameters of the anonymization as dict
+    '''
+    return dict(remap_uids=self._parser.getboolean('ANONYMIZE', 'remap_uids', fallback=False),
+                )
+
+  @property
+  def metrics_params (self):
+    '''
+    Return the (optional) parameters of the metrics export as dict
+    '''
+    port = self._parser.get('METRICS', 'port', fallback='')
+
+    return dict(port=int(port) if port else None,
+                textfile=self._parser.get('METRICS', 'textfile', fallback='') or None,
+                interval=self._parser.getfloat('METRICS', 'interval', fallback=15.),
+                )
+
+  @property
+  def transfer_params (self):
+    '''
+    Return the (optional) parameters of the on-the-wire compression as dict
+    '''
+    methods = self._parser.get('TRANSFER', 'methods', fallback='zstd,gzip')
+    return dict(compression=self._parser.get('TRANSFER', 'compression', fallback='auto'),
+                methods=tuple(m.strip() for m in methods.split(',') if m.strip()),
+                min_ratio=self._parser.getfloat('TRANSFER', 'min_ratio', fallback=1.2),
+                verify=self._parser.get('TRANSFER', 'verify', fallback='batch'),
+                )
+
   @property
   def config(self):
     return self._cfg_file
@@ -6,17 +6,44 @@
 # or a corresponding integer value). All other bits are ignored.
 import stat
 
+import io
 import os
+import re
+import json
+import time
+import uuid
+import socket
+import tarfile
 import hashlib
+import posixpath
 import paramiko
+import warnings
+import threading
+from queue import Queue
+from queue import Empty
+from itertools import islice
+from collections import deque
+from collections import namedtuple
 from contextlib import contextmanager
 
 from plumbum import cli
 from plumbum.path import Path
 from plumbum import local
 from plumbum.path.utils import delete
+from plumbum.commands.base import shquote
+from plumbum.commands.processes import CommandNotFound
+from plumbum.commands.processes import ProcessExecutionError
 from plumbum.machines.paramiko_machine import ParamikoMachine
 
+from MedicalImageAnonymizer.Profiler import profiler
+from MedicalImageAnonymizer.Metrics import metrics
+
+try:
+  import zstandard
+
+except ImportError:
+  zstandard = None
+
 
 __author__ = ['Enrico Giampieri', 'Nico Curti']
 __email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
@@ -30,8 +57,87 @@ read_write = (stat.S_IRUSR |
               stat.S_IWGRP |
               stat.S_IROTH)
 
+# the remote names are built from the sha1 of the file content
+_hash_expression = re.compile(r'[0-9a-f]{40}')
+
+# a file found on the server: remote path (as string), size in bytes,
+# modification time and path relative to the indexed directory
+RemoteEntry = namedtuple('RemoteEntry', ['path', 'size', 'mtime', 'name'])
+
+# remote indexes already computed, stored as
+# (host, directory) : (creation time, index)
+_remote_index_cache = {}
+
+# suffix of the lists of the member hashes written next to the archives
+# pushed to the server (the member names do not appear in the listings)
+_members_suffix = '.hashes'
+
+# size of the blocks moved by the resumable transfers
+_chunk_size = 2**20
+# suffix of the temporary names used during the transfers
+_partial_suffix = '.part'
+# errors which denote a dropped connection: the transfer can be resumed.
+# The failed authentications (a subclass of SSHException) are raised
+# before them, since a new connection would fail again
+_connection_errors = (EOFError, ConnectionError, socket.timeout, paramiko.SSHException)
+# name of the file which stores the results already retrieved by the sync
+_sync_state_name = '.mia_pull_state.json'
+
+
+class _Pending (object):
+  '''
+  lazy queue of the items of an iterable: the head item is kept until
+  it is explicitly removed, so it can be processed again after a
+  reconnection
+  '''
+
+  def __init__ (self, iterable):
+    self._items = iter(iterable)
+    self._buffer = deque()
+
+  def __bool__ (self):
+    return bool(self.peek(1))
+
+  @property
+  def head (self):
+    return self._buffer[0]
+
+  def popleft (self):
+    self._buffer.popleft()
+
+  def peek (self, n):
+    '''
+    the next n items (or less, if the iterable is exhausted)
+    '''
+    for item in islice(self._items, max(0, n - len(self._buffer))):
+      self._buffer.append(item)
 
-def get_sha1 (filepath):
+    return list(islice(self._buffer, n))
+
+
+class HashingWriter (object):
+  '''
+  writable wrapper of a sink which computes the sha1 and the
+  size of the data written on the fly
+  '''
+
+  def __init__ (self, sink):
+    self._sink = sink
+    self._sha1 = hashlib.sha1()
+    self.size = 0
+
+  def write (self, data):
+    self._sink.write(data)
+    self._sha1.update(data)
+    self.size += len(data)
+    return len(data)
+
+  def hexdigest (self):
+    return self._sha1.hexdigest()
+
+
+
+def get_sha1 (filepath, length=None):
   """
   calculate the sha1 hash of the content of a given file
 
@@ -40,6 +146,9 @@ def get_sha1 (filepath):
   filepath : path
     the file of which to calculate the hash.
 
+  length : int
+    if given, only the first length bytes of the file are hashed
+
   Returns
   -------
   hash: str
@@ -47,13 +156,17 @@ def get_sha1 (filepath):
 
   """
   sha1sum = hashlib.sha1()
+  remaining = float('inf') if length is None else length
 
-  with open(filepath, 'rb') as source:
-    block = source.read(2**16)
+  with profiler.stage('hash', filepath) as stage, open(filepath, 'rb') as source:
+    block = source.read(int(min(2**16, remaining)))
 
     while len(block) != 0:
       sha1sum.update(block)
-      block = source.read(2**16)
+      remaining -= len(block)
+      block = source.read(int(min(2**16, remaining)))
+
+    stage.add(bytes_read=source.tell())
 
   return sha1sum.hexdigest()
 
@@ -82,7 +195,10 @@ def get_destination_local (params, remote_config):
       the (remote) directory where to search for the completed results.
 
   """
-  with ParamikoMachine(missing_host_policy=paramiko.AutoAddPolicy(), **params) as rem:
+  with profiler.stage('ssh.connect', params.get('host')):
+    rem = ParamikoMachine(missing_host_policy=paramiko.AutoAddPolicy(), **params)
+
+  with rem:
 
     with rem.cwd(remote_config['base_dir']):
 
@@ -91,6 +207,532 @@ def get_destination_local (params, remote_config):
 
       yield rem, todo, done
 
+def remote_sha1 (rem, path, length=None):
+  '''
+  calculate the sha1 hash of a remote file on the server side,
+  without downloading it.
+
+  Parameters
+  ----------
+  rem : RemoteConnection
+    the connection to the remote server
+
+  path : str
+    the remote file
+
+  length : int
+    if given, only the first length bytes of the file are hashed
+
+  Returns
+  -------
+  hash : str or None
+    the hash of the content of the remote file; None if the server
+    does not provide the sha1sum command.
+
+  Raises
+  ------
+  ProcessExecutionError
+    if the hash can not be computed (e.g. the file is not readable)
+
+  '''
+  try:
+    with profiler.stage('remote.sha1', path, calls=1):
+      if length is None:
+        out = rem['sha1sum']('--', str(path))
+      else:
+        # plumbum pipelines are not supported by paramiko machines
+        out = rem['sh']('-c', 'command -v sha1sum > /dev/null || exit 127; '
+                              'head -c {:d} -- {} | sha1sum'.format(length, shquote(str(path))))
+  except CommandNotFound:
+    return None
+  except ProcessExecutionError as e:
+    # the shell of the server does not find sha1sum
+    if e.retcode != 127:
+      raise
+    return None
+
+  return out.split()[0]
+
+def verify_remote_files (rem, expected, chunk=256):
+  '''
+  compare the sha1 of many remote files with the expected ones,
+  hashing them on the server side with one sha1sum command every
+  chunk files (instead of a round trip for each file).
+
+  Parameters
+  ----------
+  rem : RemoteConnection
+    the connection to the remote server
+
+  expected : dict
+    map between the remote paths (as string) and their expected sha1
+
+  chunk : int
+    maximum number of files hashed by a single command
+
+  Returns
+  -------
+  corrupted : list of str
+    the remote paths whose content (or absence) does not match the
+    expected hash. The list is empty (and a RuntimeWarning is issued)
+    if the server does not provide the sha1sum command.
+
+  '''
+  paths = sorted(expected)
+  found = {}
+
+  try:
+    sha1sum = rem['sha1sum']
+  except CommandNotFound:
+    warnings.warn('The server does not provide sha1sum: the hashes of {:d} uploaded file(s) '
+                  'are not verified'.format(len(paths)), RuntimeWarning)
+    return []
+
+  for start in range(0, len(paths), chunk):
+    # the missing files are reported on stderr: keep the others
+    with profiler.stage('remote.verify', calls=1, files=len(paths[start : start + chunk])):
+      _, out, _ = sha1sum.run(['--'] + paths[start : start + chunk], retcode=None)
+
+    for line in out.splitlines():
+      digest, _, path = line.partition('  ')
+      found[path.lstrip('*')] = digest
+
+  return [path for path in paths if found.get(path) != expected[path]]
+
+def _remote_rename (sftp, source, destination):
+  '''
+  atomically replace the destination with the source file
+  '''
+  try:
+    sftp.posix_rename(source, destination)
+  except IOError:
+    # the server does not support the posix-rename extension
+    sftp.rename(source, destination)
+
+def upload_resumable (rem, origin, destination, origin_hash=None, verify=True, rename=True):
+  """
+  upload a file to a temporary remote name, resuming a previous
+  interrupted transfer if any, and move it to the final destination
+  only after checking the integrity of the data.
+
+  Parameters
+  ----------
+  rem : RemoteConnection
+    the connection to the remote server
+
+  origin : path
+    the local file to upload
+
+  destination : path
+    the final location of the file on the server
+
+  origin_hash : str
+    sha1 of the local file (computed if not given)
+
+  verify : bool
+    compare the sha1 of the uploaded data with the local one. If False,
+    only the size is checked (see verify_remote_files for a batched check)
+
+  rename : bool
+    move the data to the destination. If False, they are left in the
+    temporary name (the destination plus the .part suffix), which the
+    remote processing ignores, e.g. until a batched check
+
+  Raises
+  ------
+  IOError
+    if the uploaded data do not match the local file.
+
+  """
+  sftp = rem.sftp
+  partial = str(destination) + _partial_suffix
+  size = os.path.getsize(str(origin))
+
+  try:
+    offset = sftp.stat(partial).st_size
+  except FileNotFoundError:
+    offset = 0
+
+  # an already uploaded prefix is kept only if it matches the local data
+  if offset and (offset > size or remote_sha1(rem, partial, offset) not in (None, get_sha1(str(origin), offset))):
+    offset = 0
+
+  with profiler.stage('upload', origin, bytes_written=size - offset), \
+       open(str(origin), 'rb') as source, sftp.open(partial, 'ab' if offset else 'wb') as sink:
+    sink.set_pipelined(True)
+    source.seek(offset)
+    block = source.read(_chunk_size)
+
+    while len(block) != 0:
+      sink.write(block)
+      block = source.read(_chunk_size)
+
+  if origin_hash is None and verify:
+    origin_hash = get_sha1(str(origin))
+
+  uploaded_hash = remote_sha1(rem, partial) if verify else None
+
+  if sftp.stat(partial).st_size != size or uploaded_hash not in (None, origin_hash):
+    sftp.remove(partial)
+    raise IOError('Corrupted upload of {}'.format(origin))
+
+  if rename:
+    _remote_rename(sftp, partial, str(destination))
+
+def download_resumable (rem, path, destination):
+  """
+  download a remote file to a temporary local name, resuming a previous
+  interrupted transfer if any, and move it to the final destination
+  only after checking the integrity of the data.
+
+  Parameters
+  ----------
+  rem : RemoteConnection
+    the connection to the remote server
+
+  path : path
+    the remote file to download
+
+  destination : path
+    the final location of the local file
+
+  Raises
+  ------
+  IOError
+    if the downloaded data do not match the remote file.
+
+  """
+  sftp = rem.sftp
+  partial = str(destination) + _partial_suffix
+  size = sftp.stat(str(path)).st_size
+  offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+
+  # an already downloaded prefix is kept only if it matches the remote data
+  if offset and (offset > size or remote_sha1(rem, path, offset) not in (None, get_sha1(partial, offset))):
+    offset = 0
+
+  with profiler.stage('download', path, bytes_read=size - offset), \
+       sftp.open(str(path), 'rb') as source, open(partial, 'ab' if offset else 'wb') as sink:
+    source.seek(offset)
+    source.prefetch(size)
+    block = source.read(_chunk_size)
+
+    while len(block) != 0:
+      sink.write(block)
+      block = source.read(_chunk_size)
+
+  remote_hash = remote_sha1(rem, path)
+
+  if os.path.getsize(partial) != size or remote_hash not in (None, get_sha1(partial)):
+    os.remove(partial)
+    raise IOError('Corrupted download of {}'.format(path))
+
+  os.replace(partial, str(destination))
+
+def upload_compressed (rem, origin, destination, method, codec, origin_hash=None, verify=True, rename=True):
+  """
+  upload a file compressed on the fly and decompress it on the server
+  side, moving it to the final destination only after checking the
+  integrity of the data.
+
+  Parameters
+  ----------
+  rem : RemoteConnection
+    the connection to the remote server
+
+  origin : path
+    the local file to upload
+
+  destination : path
+    the final location of the file on the server
+
+  method : str
+    the compression method (see TransferCodec)
+
+  codec : TransferCodec
+    the codec which collects the measured speeds
+
+  origin_hash : str
+    sha1 of the local file (computed if not given)
+
+  verify : bool
+    compare the sha1 of the uploaded data with the local one. If False,
+    only the size is checked
+
+  rename : bool
+    move the data to the destination (see upload_resumable)
+
+  Raises
+  ------
+  IOError
+    if the uploaded data do not match the local file.
+
+  ProcessExecutionError
+    if the server is not able to decompress the data.
+
+  """
+  sftp = rem.sftp
+  partial = str(destination) + _partial_suffix
+  packed = str(destination) + codec.suffixes[method] + _partial_suffix
+  compressor = codec.compressor(method)
+  raw_bytes, wire_bytes, codec_time = 0, 0, 0.
+
+  start = time.perf_counter()
+
+  with profiler.stage('upload.compressed', origin) as stage, \
+       open(str(origin), 'rb') as source, sftp.open(packed, 'wb') as sink:
+    sink.set_pipelined(True)
+    block = source.read(_chunk_size)
+
+    while len(block) != 0:
+      tic = time.perf_counter()
+      data = compressor.compress(block)
+      codec_time += time.perf_counter() - tic
+      raw_bytes += len(block)
+      wire_bytes += len(data)
+      sink.write(data)
+      block = source.read(_chunk_size)
+
+    data = compressor.flush()
+    wire_bytes += len(data)
+    sink.write(data)
+    stage.add(bytes_read=raw_bytes, bytes_written=wire_bytes)
+
+  codec.record_codec(raw_bytes, codec_time)
+  codec.record_link(wire_bytes, time.perf_counter() - start - codec_time)
+
+  try:
+    rem['sh']('-c', '{} -- {} > {}'.format(codec.remote_decompress[method], shquote(packed), shquote(partial)))
+  finally:
+    rem['rm']('-f', '--', packed)
+
+  if origin_hash is None and verify:
+    origin_hash = get_sha1(str(origin))
+
+  uploaded_hash = remote_sha1(rem, partial) if verify else None
+
+  if uploaded_hash not in (None, origin_hash) or sftp.stat(partial).st_size != raw_bytes:
+    sftp.remove(partial)
+    raise IOError('Corrupted upload of {}'.format(origin))
+
+  if rename:
+    _remote_rename(sftp, partial, str(destination))
+
+def download_compressed (rem, path, destination, method, codec):
+  """
+  compress a remote file on the server side and download it,
+  decompressing the data on the fly, moving it to the final
+  destination only after checking the integrity of the data.
+
+  Parameters
+  ----------
+  rem : RemoteConnection
+    the connection to the remote server
+
+  path : path
+    the remote file to download
+
+  destination : path
+    the final location of the local file
+
+  method : str
+    the compression method (see TransferCodec)
+
+  codec : TransferCodec
+    the codec which collects the measured speeds
+
+  Raises
+  ------
+  IOError
+    if the downloaded data do not match the remote file.
+
+  ProcessExecutionError
+    if the server is not able to compress the data.
+
+  """
+  sftp = rem.sftp
+  partial = str(destination) + _partial_suffix
+  # the packed copy lives next to the remote file, hidden from the indexes
+  packed = '{}.{}{}{}'.format(path, uuid.uuid4().hex, codec.suffixes[method], _partial_suffix)
+  decompressor = codec.decompressor(method)
+  raw_bytes, wire_bytes, codec_time = 0, 0, 0.
+
+  try:
+    rem['sh']('-c', '{} -- {} > {}'.format(codec.remote_compress[method], shquote(str(path)), shquote(packed)))
+
+    start = time.perf_counter()
+
+    with profiler.stage('download.compressed', path) as stage, \
+         sftp.open(packed, 'rb') as source, open(partial, 'wb') as sink:
+      source.prefetch(sftp.stat(packed).st_size)
+      block = source.read(_chunk_size)
+
+      while len(block) != 0:
+        tic = time.perf_counter()
+        data = decompressor.decompress(block)
+        codec_time += time.perf_counter() - tic
+        wire_bytes += len(block)
+        raw_bytes += len(data)
+        sink.write(data)
+        block = source.read(_chunk_size)
+
+      stage.add(bytes_read=wire_bytes, bytes_written=raw_bytes)
+
+  finally:
+    rem['rm']('-f', '--', packed)
+
+  codec.record_codec(raw_bytes, codec_time)
+  codec.record_link(wire_bytes, time.perf_counter() - start - codec_time)
+
+  remote_hash = remote_sha1(rem, path)
+
+  if remote_hash not in (None, get_sha1(partial)):
+    os.remove(partial)
+    raise IOError('Corrupted download of {}'.format(path))
+
+  os.replace(partial, str(destination))
+
+def _upload (rem, origin, destination, origin_hash=None, codec=None, verify=True, rename=True):
+  '''
+  upload a file, compressed if the codec finds it convenient
+  '''
+  method = codec.select(origin) if codec is not None else None
+
+  if method is not None:
+    try:
+      return upload_compressed(rem, origin, destination, method, codec, origin_hash, verify, rename)
+
+    except ProcessExecutionError:
+      # the server does not provide the decompression tool
+      codec.disable(method)
+
+  start = time.perf_counter()
+  upload_resumable(rem, origin, destination, origin_hash, verify, rename)
+
+  if codec is not None:
+    codec.record_link(os.path.getsize(str(origin)), time.perf_counter() - start)
+
+def _download (rem, path, destination, codec=None):
+  '''
+  download a file, compressed if the codec finds it convenient
+  '''
+  # the results can be stored in sub-directories
+  os.makedirs(os.path.dirname(str(destination)), exist_ok=True)
+
+  method = codec.select_remote(path) if codec is not None else None
+
+  if method is not None:
+    try:
+      return download_compressed(rem, path, destination, method, codec)
+
+    except ProcessExecutionError:
+      # the server does not provide the compression tool
+      codec.disable(method)
+
+  start = time.perf_counter()
+  download_resumable(rem, path, destination)
+
+  if codec is not None:
+    codec.record_link(os.path.getsize(str(destination)), time.perf_counter() - start)
+
+def _find_remote_files (directory):
+  '''
+  list all the files in the remote directory tree with a single
+  find command executed on the server.
+  '''
+  find = directory.remote['find']
+  out = find(str(directory), '-type', 'f', '-printf', '%s\\t%T@\\t%p\\n')
+
+  entries = []
+
+  for line in out.splitlines():
+    size, mtime, path = line.split('\t', 2)
+    entries.append(RemoteEntry(path, int(size), float(mtime), posixpath.relpath(path, str(directory))))
+
+  return entries
+
+def _walk_remote_files (directory):
+  '''
+  list all the files in the remote directory tree with a single
+  SFTP walk (one request for each sub-directory).
+  '''
+  sftp = directory.remote.sftp
+  entries = []
+  to_visit = [str(directory)]
+
+  while to_visit:
+    current = to_visit.pop()
+
+    for attr in sftp.listdir_attr(current):
+      path = '{}/{}'.format(current, attr.filename)
+
+      if stat.S_ISDIR(attr.st_mode):
+        to_visit.append(path)
+      elif stat.S_ISREG(attr.st_mode):
+        entries.append(RemoteEntry(path, attr.st_size, attr.st_mtime, posixpath.relpath(path, str(directory))))
+
+  return entries
+
+def index_remote_directory (directory, ttl=60.):
+  '''
+  build the map between hashes and files stored in a remote directory
+  tree. The whole tree is listed with a single find command on the
+  server (falling back to a single SFTP walk if find is not available)
+  and the result is cached for the following queries.
+
+  Parameters
+  ----------
+  directory : path
+    the (remote) directory to index
+
+  ttl : float
+    seconds for which a cached index is considered still valid.
+    Use 0 to force the refresh of the index.
+
+  Returns
+  -------
+  index : dict
+    map between each hash found in the tree and the list of
+    RemoteEntry whose path (relative to the directory) contains it,
+    e.g. also the results inside a directory named with the hash.
+    The dict is empty if the directory does not exist.
+
+  '''
+  key = (str(directory.remote), str(directory))
+  now = time.time()
+
+  try:
+    created, index = _remote_index_cache[key]
+    if now - created < ttl:
+      return index
+  except KeyError:
+    pass
+
+  if not directory.exists():
+    return {}
+
+  with profiler.stage('remote.index', directory, calls=1):
+
+    try:
+      entries = _find_remote_files(directory)
+    except (CommandNotFound, ProcessExecutionError):
+      # the remote host has not a GNU find (e.g. Windows server)
+      entries = _walk_remote_files(directory)
+
+  index = {}
+
+  for entry in entries:
+    # skip the interrupted transfers
+    if entry.path.endswith(_partial_suffix):
+      continue
+
+    for origin_hash in set(_hash_expression.findall(entry.name)):
+      index.setdefault(origin_hash, []).append(entry)
+
+  _remote_index_cache[key] = (now, index)
+
+  return index
+
 def query_single_file (filename, params, remote):
   '''
   given a filepath, check all the files on the remote server whose
@@ -113,8 +755,9 @@ def query_single_file (filename, params, remote):
     the hash of the original file (calculated on the content)
 
   exists : list of paths
-    all the files on the server whose name contains the hash of the
-    original file. The list is empty if no files are found
+    all the files on the server whose path (relative to the done
+    directory) contains the hash of the original file. The list is
+    empty if no files are found
 
   '''
 
@@ -122,10 +765,9 @@ def query_single_file (filename, params, remote):
 
     origin = filename
     origin_hash = get_sha1(origin)
-    source = done/origin_hash
-    find_hash = lambda p : origin_hash in str(p)
+    index = index_remote_directory(done)
 
-    paths = list(done.walk(filter=find_hash))
+    paths = [rem.path(entry.path) for entry in index.get(origin_hash, [])]
   # returning the hash is necessary for the file pulling, as it needs
   # to replace the name of the files after downloading them
   return origin_hash, paths
@@ -166,7 +808,7 @@ def push_single_file (filepath, params, remote_config):
     destination = Path(destination)
 
     if not destination.exists():
-      rem.upload(origin, destination)
+      upload_resumable(rem, origin, destination, origin_hash)
 
     else:
       s = "{} has already been pushed".format(filepath)
@@ -177,46 +819,889 @@ def push_single_file (filepath, params, remote_config):
 
   return destination
 
-def pull_single_file (filepath, destination_dir, params, remote_config):
-  """
+def list_remote_hashes (directory):
+  '''
+  list the content of a remote directory with a single round trip
+  and index the file names according to the hash that they contain.
 
   Parameters
   ----------
-  filepath : plumbum path object
-    origin file to pull from the server
+  directory : path
+    the (remote) directory to list
 
-  destination_dir : plumbum path object
-    the directory in which to copy the files
+  Returns
+  -------
+  hashes : dict
+    map between each hash found in the directory and the set of
+    file names which contain it. The dict is empty if the directory
+    does not exist.
 
-  params : dict
-    parameters of the connection host
+  '''
+  hashes = {}
 
-  remote_config : dict
-    parameters of the remote server
+  try:
+    names = [p.name for p in directory.list()]
+  except FileNotFoundError:
+    return hashes
 
-  Returns
-  -------
-  pulled_file: List[path]
-    the list of filepaths downloaded from the server
-    (after name-swapping the hash)
+  for name in names:
+    # skip the interrupted transfers
+    if name.endswith(_partial_suffix):
+      continue
 
+    for origin_hash in _hash_expression.findall(name):
+      hashes.setdefault(origin_hash, set()).add(name)
+
+  return hashes
+
+def _list_known_hashes (todo, done):
+  '''
+  map between the hashes already available on the server (both
+  in the todo and done directories) and their file names
+  '''
+  known = list_remote_hashes(todo)
+
+  for origin_hash, names in list_remote_hashes(done).items():
+    known.setdefault(origin_hash, set()).update(names)
+
+  # the members of the archives still in todo
+  names = {name for names in known.values() for name in names}
+
+  for name in names:
+    if name.endswith(_members_suffix) and name[:-len(_members_suffix)] in names:
+      for origin_hash in _hash_expression.findall((todo/name).read('ascii')):
+        known.setdefault(origin_hash, set()).add(name[:-len(_members_suffix)])
+
+  return known
+
+def query_missing_hashes (rem, todo, done, hashes):
   """
-  pulled_file = []
+  ask the server which of the given hashes are not yet available
+  (in the todo or done directories) with a single round trip.
 
-  with get_destination_local(params, remote_config) as (rem, todo, done):
+  The hashes are written into a hidden scratch manifest in the base
+  directory (never in todo, which is consumed by the remote processing)
+  and a single remote command filters out the ones already on the
+  server, so only the missing subset travels back. The members of the
+  archives still in todo are read from their lists of hashes (see
+  push_archive).
 
-    origin_hash, paths = query_single_file(filepath, params, remote_config)
+  Parameters
+  ----------
+  rem : RemoteConnection
+    the connection to the remote server
 
-    for path in paths:
-      # this operation is necessary because the path keeps track
-      # of the identity of the machine and not just of the data
-      # so given that it was created in a different context manager
-      # it freaks out even if it's not needed
-      path.remote = rem
-      # the name and extension might be changed, so replace only the hash part
-      dest_name = path.name.replace(origin_hash, filepath.stem)
-      destination = destination_dir/dest_name
-      rem.download(path, destination)
-      pulled_file.append(destination)
+  todo : path
+    the (remote) directory of the files to process
+
+  done : path
+    the (remote) directory of the results
+
+  hashes : iterable of str
+    the hashes to query
+
+  Returns
+  -------
+  missing : set of str
+    the hashes not available on the server
+
+  """
+  hashes = set(hashes)
+
+  if not hashes:
+    return hashes
+
+  sftp = rem.sftp
+  # the working directory of the connection is the base directory
+  stem = str(rem.cwd/('.mia_query_' + uuid.uuid4().hex))
+  manifest, names, found = (stem + suffix + _partial_suffix for suffix in ('.manifest', '.names', '.found'))
+
+  script = ('find {todo} {done} -maxdepth 1 -type f ! -name "*{part}" -printf "%f\\n" > {names} 2> /dev/null'
+            ' || {{ rm -f {manifest} {names}; exit 1; }}; '
+            # the lists of the members of the archives still in todo
+            'for f in {todo}/*{members}; do [ ! -e "${{f%{members}}}" ] || cat -- "$f" >> {names}; done; '
+            'grep -oE "[0-9a-f]{{40}}" {names} > {found}; '
+            'grep -vxF -f {found} {manifest}; '
+            'rm -f {manifest} {names} {found}; exit 0').format(todo=shquote(str(todo)), done=shquote(str(done)),
+                                                               part=_partial_suffix, members=_members_suffix,
+                                                               manifest=shquote(manifest), names=shquote(names),
+                                                               found=shquote(found))
+
+  # the script removes its scratch files when it runs to the end
+  cleaned = False
+
+  try:
+
+    with sftp.open(manifest, 'wb') as sink:
+      sink.set_pipelined(True)
+      sink.write('\n'.join(sorted(hashes)).encode('ascii') + b'\n')
+
+    try:
+      with profiler.stage('remote.query', calls=1, files=len(hashes)):
+        out = rem['sh']('-c', script)
+      cleaned = True
+
+    except ProcessExecutionError:
+      # the server has not GNU find (or one of the directories does not
+      # exist yet): fall back to the listing of the directories
+      return hashes.difference(_list_known_hashes(todo, done))
+
+  finally:
+
+    for scratch in () if cleaned else (manifest, names, found):
+      try:
+        sftp.remove(scratch)
+      except (IOError, *_connection_errors):
+        pass
+
+  return hashes.intersection(out.split())
+
+def _with_hashes (file_list):
+  '''
+  pair each file with its sha1 (computed if not given)
+  '''
+  for filepath in file_list:
+
+    if isinstance(filepath, tuple):
+      yield filepath
+    else:
+      yield filepath, get_sha1(filepath)
+
+def push_files (file_list, params, remote_config, retries=3, codec=None, batch_size=1000, verify='batch'):
+  """
+  upload a batch of files to the server over a single connection.
+
+  The server is asked which files are missing once for every
+  batch_size files (see query_missing_hashes), so the files already
+  available on the server are skipped without any per-file query.
+
+  Parameters
+  ----------
+  file_list : iterable of path or (path, hash)
+    the files to upload to the server, consumed lazily. The
+    sha1 of each file is computed if it is not given.
+
+  params : dict
+    parameters of the connection host
+
+  remote_config : dict
+    parameters of the remote server
+
+  retries : int
+    number of reconnections allowed if the connection drops: the
+    interrupted upload is resumed from the data already transferred
+
+  codec : TransferCodec
+    if given, the files are compressed on the wire when convenient
+
+  batch_size : int or None
+    number of files queried together to the server. If None, the
+    content of the todo and done directories is listed once at the
+    beginning instead (so the files are processed as soon as they are
+    available in file_list, e.g. for a pipeline)
+
+  verify : str or None
+    integrity check of the uploaded files against their local hash:
+    'each' hashes every file on the server right after its upload,
+    'batch' hashes all the files uploaded in a batch with a single
+    command (see verify_remote_files) while they are still under their
+    temporary names, uploads again the corrupted ones and only then
+    moves them into todo, None checks only the size
+
+  Yields
+  ------
+  filepath : path
+    the file processed
+
+  destination : path
+    the location of the file on the server.
+
+  pushed : bool
+    False if the file was already on the server and it has been skipped
+
+  """
+  pending = _Pending(_with_hashes(file_list))
+  # the files uploaded but not yet reported, across the reconnections
+  pushed = set()
+  # upload time of each file, for the per-file metrics
+  elapsed = {}
+  failures = 0
+
+  while pending:
+
+    try:
+
+      with get_destination_local(params, remote_config) as (rem, todo, done):
+
+        known = set() if batch_size else set(_list_known_hashes(todo, done))
+
+        while pending:
+
+          batch = pending.peek(batch_size or 1)
+
+          if batch_size:
+            hashes = {h for _, h in batch}
+            known.update(hashes.difference(query_missing_hashes(rem, todo, done, hashes)))
+
+          destinations = []
+          uploaded = {}
+
+          for origin, origin_hash in batch:
+
+            destination = todo/origin_hash
+            destination = destination.with_suffix(os.path.splitext(str(origin))[-1])
+            destination = Path(destination)
+            destinations.append(destination)
+
+            if origin_hash not in known:
+              # with the batched check the files stay under their temporary
+              # names (ignored by the remote processing and by the queries)
+              # until they are verified: after a dropped connection they are
+              # still missing, so they are resumed and verified again
+              tic = time.perf_counter()
+              _upload(rem, origin, destination, origin_hash, codec,
+                      verify=(verify == 'each'), rename=(verify != 'batch'))
+              elapsed[origin_hash] = elapsed.get(origin_hash, 0.) + time.perf_counter() - tic
+              # keep the listing up to date for the next files of the batch
+              known.add(origin_hash)
+              pushed.add(origin_hash)
+              uploaded[str(destination) + _partial_suffix] = (origin, origin_hash, destination)
+
+          if verify == 'batch' and uploaded:
+
+            expected = {partial : origin_hash for partial, (_, origin_hash, _) in uploaded.items()}
+            corrupted = set(verify_remote_files(rem, expected))
+
+            for partial, (origin, origin_hash, destination) in uploaded.items():
+
+              if partial in corrupted:
+                try:
+                  rem.sftp.remove(partial)
+                except FileNotFoundError:
+                  pass
+                tic = time.perf_counter()
+                _upload(rem, origin, destination, origin_hash, codec, verify=True)
+                elapsed[origin_hash] += time.perf_counter() - tic
+              else:
+                _remote_rename(rem.sftp, partial, str(destination))
+
+          for (filepath, origin_hash), destination in zip(batch, destinations):
+            is_new = origin_hash in pushed
+            pushed.discard(origin_hash)
+
+            if is_new:
+              metrics.file_processed(filepath, elapsed.pop(origin_hash, 0.), operation='push')
+
+            pending.popleft()
+            yield filepath, destination, is_new
+
+    except paramiko.AuthenticationException:
+      raise
+
+    except _connection_errors:
+
+      failures += 1
+      if failures > retries:
+        raise
+
+def stream_files (file_list, anonymize, params, remote_config, retries=3):
+  """
+  anonymize a batch of files streaming the anonymized data directly
+  to the server, without any local staging copy.
+
+  The data are written to a temporary remote file while their hash is
+  computed on the fly; at the end the file is renamed according to its
+  hash, or removed if the same content is already on the server.
+
+  Parameters
+  ----------
+  file_list : iterable of path
+    the files to anonymize and upload, consumed lazily
+
+  anonymize : callable
+    function anonymize(filepath, sink) which writes the anonymized
+    version of the file into the writable sink. The information log
+    used to revert the anonymization is kept locally by the function.
+
+  params : dict
+    parameters of the connection host
+
+  remote_config : dict
+    parameters of the remote server
+
+  retries : int
+    number of reconnections allowed if the connection drops: the
+    interrupted file is anonymized and streamed again
+
+  Yields
+  ------
+  filepath : path
+    the file processed
+
+  destination : path
+    the location of the file on the server. None if the anonymization
+    failed (the error is reported by the anonymize function)
+
+  pushed : bool
+    False if the file was already on the server (or if it failed)
+
+  """
+  pending = _Pending(file_list)
+  failures = 0
+
+  while pending:
+
+    try:
+
+      with get_destination_local(params, remote_config) as (rem, todo, done):
+
+        sftp = rem.sftp
+        known = _list_known_hashes(todo, done)
+
+        while pending:
+
+          filepath = pending.head
+          partial = str(todo/(uuid.uuid4().hex + _partial_suffix))
+          tic = time.perf_counter()
+
+          try:
+
+            with sftp.open(partial, 'wb') as sink:
+              sink.set_pipelined(True)
+              writer = HashingWriter(sink)
+              anonymize(filepath, writer)
+
+          except _connection_errors:
+            raise
+
+          except Exception:
+            sftp.remove(partial)
+            pending.popleft()
+            yield filepath, None, False
+            continue
+
+          origin_hash = writer.hexdigest()
+          destination = todo/origin_hash
+          destination = destination.with_suffix(os.path.splitext(str(filepath))[-1])
+          destination = Path(destination)
+
+          is_new = origin_hash not in known
+
+          if is_new:
+
+            if remote_sha1(rem, partial) not in (None, origin_hash) or sftp.stat(partial).st_size != writer.size:
+              sftp.remove(partial)
+              raise IOError('Corrupted upload of {}'.format(filepath))
+
+            _remote_rename(sftp, partial, str(destination))
+            known.setdefault(origin_hash, set()).add(destination.name)
+            # the anonymization is recorded on its own by the anonymizer
+            metrics.file_processed(filepath, time.perf_counter() - tic, operation='push', nbytes=writer.size)
+
+          else:
+            sftp.remove(partial)
+
+          pending.popleft()
+          yield filepath, destination, is_new
+
+    except paramiko.AuthenticationException:
+      raise
+
+    except _connection_errors:
+
+      failures += 1
+      if failures > retries:
+        raise
+
+def _write_archive (sink, file_list, known, compression=None):
+  '''
+  write the files not already known into a tar stream (with a final
+  manifest.json member mapping the content hashes to the member names)
+  '''
+  if compression == 'zstd':
+    if zstandard is None:
+      raise ImportError('zstd compression requires the zstandard package')
+    stream = zstandard.ZstdCompressor().stream_writer(sink, closefd=False)
+    mode = 'w|'
+  elif compression in ('gz', 'bz2', 'xz'):
+    stream = sink
+    mode = 'w|' + compression
+  elif compression is None:
+    stream = sink
+    mode = 'w|'
+  else:
+    raise ValueError('Unknown compression {}'.format(compression))
+
+  manifest = {}
+  members = []
+
+  with tarfile.open(fileobj=stream, mode=mode) as tar:
+
+    for filepath in file_list:
+
+      if isinstance(filepath, tuple):
+        filepath, origin_hash = filepath
+      else:
+        origin_hash = get_sha1(filepath)
+
+      name = origin_hash + os.path.splitext(str(filepath))[-1]
+      is_new = origin_hash not in known and origin_hash not in manifest
+
+      if is_new:
+        tar.add(str(filepath), arcname=name, recursive=False)
+        manifest[origin_hash] = name
+
+      members.append((filepath, name, is_new))
+
+    data = json.dumps(manifest, indent=2).encode('utf-8')
+    info = tarfile.TarInfo('manifest.json')
+    info.size = len(data)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
+
+  if stream is not sink:
+    stream.close()
+
+  return members
+
+def push_archive (file_list, params, remote_config, compression=None, retries=3):
+  """
+  upload a batch of (small) files packed into a single tar archive,
+  streamed directly to the todo directory of the server.
+
+  Only one remote file is created for the whole batch, so the per-file
+  protocol overhead (open, stat, close) disappears. The archive members
+  are named with the content hash of the files and a manifest.json
+  member maps each hash to its member name.
+
+  The hashes of the packed files are also written, one per line, next
+  to the archive (with the .hashes suffix), so the following dedup
+  queries (query_missing_hashes) do not send them again while the
+  archive is in todo, even from another session.
+
+  Parameters
+  ----------
+  file_list : list of path or (path, hash)
+    the files to pack and upload
+
+  params : dict
+    parameters of the connection host
+
+  remote_config : dict
+    parameters of the remote server
+
+  compression : str or None
+    compression of the archive: None, 'gz', 'bz2', 'xz' or 'zstd'
+    (the latter requires the zstandard package)
+
+  retries : int
+    number of times the archive is sent again if the connection drops
+
+  Returns
+  -------
+  destination : path
+    the location of the archive on the server (None if all the files
+    were already on the server)
+
+  members : list of (path, str, bool)
+    for each file, its member name and False if it was already on the
+    server and it has not been packed
+
+  """
+  file_list = list(_with_hashes(file_list))
+  hashes = {origin_hash for _, origin_hash in file_list}
+  suffix = {None: '.tar', 'zstd': '.tar.zst'}.get(compression, '.tar.' + str(compression))
+  failures = 0
+
+  while True:
+
+    try:
+
+      with get_destination_local(params, remote_config) as (rem, todo, done):
+
+        sftp = rem.sftp
+        known = hashes.difference(query_missing_hashes(rem, todo, done, hashes))
+        partial = str(todo/(uuid.uuid4().hex + _partial_suffix))
+
+        with sftp.open(partial, 'wb') as sink:
+          sink.set_pipelined(True)
+          writer = HashingWriter(sink)
+          members = _write_archive(writer, file_list, known, compression)
+
+        if not any(is_new for _, _, is_new in members):
+          sftp.remove(partial)
+          return None, members
+
+        if remote_sha1(rem, partial) not in (None, writer.hexdigest()) or sftp.stat(partial).st_size != writer.size:
+          sftp.remove(partial)
+          raise IOError('Corrupted upload of the archive')
+
+        destination = Path(todo/(writer.hexdigest() + suffix))
+        # the list is written first: it is used only while its archive exists
+        listing = str(destination) + _members_suffix
+        archived = (name.split('.', 1)[0] for _, name, is_new in members if is_new)
+
+        with sftp.open(listing + _partial_suffix, 'wb') as sink:
+          sink.write(''.join(h + '\n' for h in archived).encode('ascii'))
+
+        _remote_rename(sftp, listing + _partial_suffix, listing)
+        _remote_rename(sftp, partial, str(destination))
+        _remote_index_cache.pop((str(todo.remote), str(todo)), None)
+
+      return destination, members
+
+    except paramiko.AuthenticationException:
+      raise
+
+    except _connection_errors:
+
+      failures += 1
+      if failures > retries:
+        raise
+
+def pull_single_file (filepath, destination_dir, params, remote_config):
+  """
+
+  Parameters
+  ----------
+  filepath : plumbum path object
+    origin file to pull from the server
+
+  destination_dir : plumbum path object
+    the directory in which to copy the files
+
+  params : dict
+    parameters of the connection host
+
+  remote_config : dict
+    parameters of the remote server
+
+  Returns
+  -------
+  pulled_file: List[path]
+    the list of filepaths downloaded from the server
+    (after name-swapping the hash)
+
+  """
+  with get_destination_local(params, remote_config) as (rem, todo, done):
+
+    index = index_remote_directory(done)
+    pulled_file = _pull_from_index(rem, index, filepath, destination_dir)
+
+  return pulled_file
+
+def _pull_from_index (rem, index, filepath, destination_dir, codec=None):
+  '''
+  download all the results of the given file listed in the remote index
+  '''
+  origin_hash = get_sha1(filepath)
+  pulled_file = []
+
+  for entry in index.get(origin_hash, []):
+    path = rem.path(entry.path)
+    # the name and extension might be changed, so replace only the hash
+    # part (the sub-directories of the results are kept)
+    dest_name = entry.name.replace(origin_hash, filepath.stem)
+    destination = destination_dir/dest_name
+    _download(rem, path, destination, codec)
+    pulled_file.append(destination)
 
   return pulled_file
+
+def pull_files (file_list, destination_dir, params, remote_config, ttl=60., retries=3, codec=None):
+  """
+  download the results of a batch of files over a single connection.
+
+  The done directory is indexed only once for the whole batch
+  (see index_remote_directory) and all the downloads are driven by
+  the index.
+
+  Parameters
+  ----------
+  file_list : list of path
+    origin files to pull from the server
+
+  destination_dir : plumbum path object
+    the directory in which to copy the files
+
+  params : dict
+    parameters of the connection host
+
+  remote_config : dict
+    parameters of the remote server
+
+  ttl : float
+    seconds for which a cached remote index is considered still valid
+
+  retries : int
+    number of reconnections allowed if the connection drops: the
+    interrupted download is resumed from the data already transferred
+
+  codec : TransferCodec
+    if given, the files are compressed on the wire when convenient
+
+  Yields
+  ------
+  filepath : path
+    the origin file processed
+
+  pulled_file: List[path]
+    the list of filepaths downloaded from the server
+    (after name-swapping the hash)
+
+  """
+  pending = _Pending(file_list)
+  failures = 0
+
+  os.makedirs(str(destination_dir), exist_ok=True)
+
+  while pending:
+
+    try:
+
+      with get_destination_local(params, remote_config) as (rem, todo, done):
+
+        index = index_remote_directory(done, ttl=ttl)
+
+        while pending:
+
+          filepath = pending.head
+          tic = time.perf_counter()
+          pulled_file = _pull_from_index(rem, index, filepath, destination_dir, codec)
+
+          if pulled_file:
+            metrics.file_processed(filepath, time.perf_counter() - tic, operation='pull',
+                                   nbytes=sum(os.path.getsize(str(f)) for f in pulled_file))
+
+          pending.popleft()
+          yield filepath, pulled_file
+
+    except paramiko.AuthenticationException:
+      raise
+
+    except _connection_errors:
+
+      failures += 1
+      if failures > retries:
+        raise
+
+def _load_sync_state (state_file):
+  '''
+  read the results already retrieved as
+  remote path : [size, mtime, local path]
+  '''
+  try:
+    with open(str(state_file), 'r') as fp:
+      return json.load(fp)
+  except (IOError, ValueError):
+    return {}
+
+def _save_sync_state (state_file, state):
+  '''
+  atomically replace the state file
+  '''
+  partial = str(state_file) + _partial_suffix
+
+  with open(partial, 'w') as fp:
+    json.dump(state, fp)
+
+  os.replace(partial, str(state_file))
+
+def _sync_worker (tasks, results, params, remote_config, retries, codec):
+  '''
+  download the results queued in tasks over a dedicated connection
+  '''
+  pending = _Pending(iter(tasks.get, None))
+  failures = 0
+
+  while pending:
+
+    try:
+
+      with get_destination_local(params, remote_config) as (rem, todo, done):
+
+        while pending:
+
+          filepath, downloads = pending.head
+          tic = time.perf_counter()
+
+          for entry, destination in downloads:
+            _download(rem, rem.path(entry.path), destination, codec)
+
+          metrics.file_processed(filepath, time.perf_counter() - tic, operation='sync',
+                                 nbytes=sum(entry.size for entry, _ in downloads))
+          pending.popleft()
+          results.put((filepath, downloads, None))
+
+    except paramiko.AuthenticationException as e:
+      # the other files would fail the same way
+      while pending:
+        results.put((pending.head[0], [], e))
+        pending.popleft()
+
+    except _connection_errors as e:
+
+      failures += 1
+      if failures > retries:
+        results.put((pending.head[0], [], e))
+        pending.popleft()
+        failures = 0
+
+    except Exception as e:
+      # keep going with the other files
+      results.put((pending.head[0], [], e))
+      pending.popleft()
+
+  results.put(None)
+
+def sync_results (file_list, destination_dir, params, remote_config, state_file=None, workers=4, retries=3, codec=None):
+  """
+  download only the results which are new or changed since the
+  previous synchronization, using parallel connections.
+
+  The results already retrieved are stored (as remote path, size and
+  modification time) in a local state file, so polling the server for
+  the finished results costs a single listing of the done directory.
+
+  Parameters
+  ----------
+  file_list : list of path
+    origin files to pull from the server
+
+  destination_dir : path
+    the directory in which to copy the files (created if needed)
+
+  params : dict
+    parameters of the connection host
+
+  remote_config : dict
+    parameters of the remote server
+
+  state_file : path
+    the file which stores the results already retrieved.
+    Default is a hidden file in the destination directory.
+
+  workers : int
+    number of parallel connections used for the downloads
+
+  retries : int
+    number of reconnections allowed to each worker if the connection drops
+
+  codec : TransferCodec
+    if given, the files are compressed on the wire when convenient
+
+  Yields
+  ------
+  filepath : path
+    the origin file processed
+
+  pulled_file : List[path]
+    the list of filepaths downloaded from the server (empty if
+    there are no new results)
+
+  error : Exception or None
+    the error raised by the download of the results
+
+  """
+  destination_dir = local.path(str(destination_dir))
+  destination_dir.mkdir()
+
+  if state_file is None:
+    state_file = destination_dir / _sync_state_name
+
+  state = _load_sync_state(state_file)
+
+  with get_destination_local(params, remote_config) as (rem, todo, done):
+    # the listing must be fresh, otherwise the new results are not seen
+    index = index_remote_directory(done, ttl=0)
+
+  tasks = Queue()
+  results = Queue()
+  up_to_date = []
+  scheduled = 0
+
+  for filepath in file_list:
+    origin_hash = get_sha1(filepath)
+    downloads = []
+
+    for entry in index.get(origin_hash, []):
+      # the name and extension might be changed, so replace only the hash part
+      destination = destination_dir / entry.name.replace(origin_hash, filepath.stem)
+      known = state.get(entry.path)
+
+      if known != [entry.size, entry.mtime, str(destination)] or not destination.exists():
+        downloads.append((entry, destination))
+
+    if downloads:
+      tasks.put((filepath, downloads))
+      scheduled += 1
+    else:
+      up_to_date.append(filepath)
+
+  workers = max(1, min(workers, scheduled))
+
+  for _ in range(workers):
+    tasks.put(None)
+
+  threads = [threading.Thread(target=_sync_worker, args=(tasks, results, params, remote_config, retries, codec))
+             for _ in range(workers if scheduled else 0)]
+
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+
+  for filepath in up_to_date:
+    yield filepath, [], None
+
+  running = len(threads)
+  done_files = 0
+
+  try:
+
+    while running:
+
+      item = results.get()
+
+      if item is None:
+        running -= 1
+        continue
+
+      filepath, downloads, error = item
+
+      if error is not None:
+        metrics.file_processed(filepath, 0., succeeded=False, operation='sync', nbytes=0)
+
+      for entry, destination in downloads:
+        state[entry.path] = [entry.size, entry.mtime, str(destination)]
+
+      done_files += 1
+      # keep the progress in case of interruption
+      if done_files % 100 == 0:
+        _save_sync_state(state_file, state)
+
+      yield filepath, [destination for _, destination in downloads], error
+
+  finally:
+
+    if running:
+      # closed before the end (e.g. cancelled): drop the downloads not
+      # yet started and wait for the ones in flight
+      try:
+        while True:
+          tasks.get_nowait()
+      except Empty:
+        pass
+
+      for _ in threads:
+        tasks.put(None)
+
+      for thread in threads:
+        thread.join()
+
+      # keep track of the downloads completed in the meantime
+      while not results.empty():
+        item = results.get_nowait()
+        for entry, destination in item[1] if item is not None else ():
+          state[entry.path] = [entry.size, entry.mtime, str(destination)]
+
+    _save_sync_state(state_file, state)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import tkinter as tk
+from tkinter import ttk
+
+import os
+import time
+import threading
+import traceback
+from queue import Queue
+from queue import Empty
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+# end of task marker in the result queue
+_END = object()
+
+# default number of files processed in parallel by map
+_default_workers = min(4, os.cpu_count() or 1)
+
+
+def _format_seconds (seconds):
+  '''
+  seconds as H:MM:SS
+  '''
+  minutes, seconds = divmod(int(seconds), 60)
+  hours, minutes = divmod(minutes, 60)
+  return '{:d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+class _BackgroundTask (ttk.Frame):
+
+  def __init__ (self, *args, interval=100, max_results=500, **kwargs):
+    '''
+    Run the long operations of a tab out of the Tk main thread.
+
+    The work is done by background threads which put their results into
+    a queue; the queue is polled by the GUI every interval ms (see
+    after), so the callbacks which update the widgets always run in the
+    main thread. The frame shows a progress bar with throughput and ETA
+    and a Cancel button which stops the task after the files in flight.
+
+    Parameters
+    ----------
+      interval: int
+        polling period of the result queue in ms
+
+      max_results: int
+        maximum number of results handled at each poll, so the
+        window keeps responding even with very fast tasks
+    '''
+
+    super(_BackgroundTask, self).__init__(*args, **kwargs)
+
+    self._interval = interval
+    self._max_results = max_results
+
+    self._queue = Queue()
+    self._cancel = threading.Event()
+    self._running = False
+    self._on_result = None
+    self._on_done = None
+    self._handler_error = None
+    self._total = None
+    self._done = 0
+    self._start = 0.
+
+    # variables
+    self._status = tk.StringVar()
+
+    # add widgets
+    self._wbar = ttk.Progressbar(self, orient='horizontal', length=360, mode='determinate')
+    self._wstatus = tk.Label(self, textvariable=self._status)
+    self._wcancel = tk.Button(self, text='Cancel', state=tk.DISABLED, command=self.cancel)
+
+    # widget on grid
+    self._wbar.grid(column=0, row=0)
+    self._wcancel.grid(column=1, row=0)
+    self._wstatus.grid(column=0, row=1, columnspan=2)
+
+  @property
+  def running (self):
+    return self._running
+
+  @property
+  def processed (self):
+    '''
+    number of results handled by the current (or last) task
+    '''
+    return self._done
+
+  def map (self, function, items, on_result, on_done=None, workers=None):
+    '''
+    Apply the function to each item using a pool of threads
+
+    Parameters
+    ----------
+      function: callable
+        function applied to each item
+
+      items: list
+        the items to process (e.g. the files to anonymize)
+
+      on_result: callable
+        called in the main thread as on_result(item, result, error)
+        for each item, in order of completion (error is the exception
+        raised by the function or None)
+
+      on_done: callable
+        called in the main thread as on_done(cancelled, error) at the end
+
+      workers: int
+        number of threads of the pool
+    '''
+    workers = workers or _default_workers
+    self._begin(len(items), on_result, on_done)
+
+    feeder = threading.Thread(target=self._feed, args=(function, items, workers))
+    feeder.daemon = True
+    feeder.start()
+
+  def iterate (self, generator, total, on_result, on_done=None):
+    '''
+    Consume a generator (e.g. push_files) in a background thread
+
+    Parameters
+    ----------
+      generator: iterator
+        the task, which yields a value for each file processed. It is
+        closed when the task is cancelled, so its connections are released
+
+      total: int or None
+        number of values expected (None if unknown)
+
+      on_result: callable
+        called in the main thread as on_result(value) for each value
+
+      on_done: callable
+        called in the main thread as on_done(cancelled, error) at the
+        end (error is the exception which stopped the generator or None)
+    '''
+    self._begin(total, on_result, on_done)
+
+    thread = threading.Thread(target=self._drain, args=(generator, ))
+    thread.daemon = True
+    thread.start()
+
+  def cancel (self):
+    '''
+    Stop the task: the files in flight are completed, the others are dropped
+    '''
+    if self._running and not self._cancel.is_set():
+      self._cancel.set()
+      self._wcancel.configure(state=tk.DISABLED)
+      self._status.set('Cancelling after the files in flight...')
+
+  def _begin (self, total, on_result, on_done):
+
+    if self._running:
+      raise RuntimeError('A task is already running')
+
+    self._running = True
+    self._cancel.clear()
+    self._on_result = on_result
+    self._on_done = on_done
+    self._total = total
+    self._done = 0
+    self._start = time.perf_counter()
+    self._handler_error = None
+
+    if total is None:
+      self._wbar.configure(mode='indeterminate')
+      self._wbar.start()
+    else:
+      self._wbar.configure(mode='determinate', maximum=max(1, total), value=0)
+
+    self._wcancel.configure(state=tk.NORMAL)
+    self._status.set('Starting...')
+    self.after(self._interval, self._poll)
+
+  def _feed (self, function, items, workers):
+    '''
+    submit the items to the pool, with a bounded number in flight
+    '''
+    # the items are not submitted all together, so a cancel does
+    # not have to wait for the whole list
+    slots = threading.BoundedSemaphore(2 * workers)
+    pool = ThreadPoolExecutor(max_workers=workers)
+
+    try:
+
+      for item in items:
+
+        slots.acquire()
+
+        if self._cancel.is_set():
+          slots.release()
+          break
+
+        future = pool.submit(function, item)
+        future.add_done_callback(partial(self._collect, item, slots))
+
+    finally:
+      # wait for the files in flight
+      pool.shutdown(wait=True)
+      self._queue.put((_END, None))
+
+  def _collect (self, item, slots, future):
+
+    error = future.exception()
+    self._queue.put((item, None if error is not None else future.result(), error))
+    slots.release()
+
+  def _drain (self, generator):
+    '''
+    iterate the generator until the end or the cancel
+    '''
+    error = None
+
+    try:
+
+      for value in generator:
+
+        self._queue.put((value, ))
+
+        if self._cancel.is_set():
+          break
+
+    except Exception as e:
+      error = e
+
+    finally:
+      close = getattr(generator, 'close', None)
+
+      try:
+        if close is not None:
+          close()
+      except Exception as e:
+        error = error or e
+
+      self._queue.put((_END, error))
+
+  def _poll (self):
+    '''
+    handle the results available and reschedule itself
+    '''
+    for _ in range(self._max_results):
+
+      try:
+        message = self._queue.get_nowait()
+      except Empty:
+        break
+
+      if message[0] is _END:
+        self._finish(message[1] or self._handler_error)
+        return
+
+      self._done += 1
+
+      try:
+        self._on_result(*message)
+
+      except Exception as e:
+        # a failing handler must not stop the polling (the task would
+        # stay running forever): the error is reported at the end
+        traceback.print_exc()
+        self._handler_error = self._handler_error or e
+
+    self._show_progress()
+    self.after(self._interval, self._poll)
+
+  def _show_progress (self):
+
+    elapsed = time.perf_counter() - self._start
+    rate = self._done / elapsed if elapsed > 0 else 0.
+
+    if self._total is None:
+      self._status.set('{:d} files  {:.1f} files/s'.format(self._done, rate))
+      return
+
+    self._wbar.configure(value=self._done)
+
+    if self._cancel.is_set():
+      return
+
+    eta = _format_seconds((self._total - self._done) / rate) if rate > 0 else '-'
+    self._status.set('{:d}/{:d} files  {:.1f} files/s  ETA {}'.format(self._done, self._total, rate, eta))
+
+  def _finish (self, error):
+
+    cancelled = self._cancel.is_set()
+    elapsed = _format_seconds(time.perf_counter() - self._start)
+
+    self._wbar.stop()
+    self._wbar.configure(mode='determinate', value=self._done if self._total is not None else 0)
+    self._wcancel.configure(state=tk.DISABLED)
+
+    if error is not None:
+      self._status.set('Stopped after {:d} files: {}'.format(self._done, repr(error)))
+    elif cancelled:
+      self._status.set('Cancelled after {:d} files ({})'.format(self._done, elapsed))
+    else:
+      self._status.set('Done: {:d} files in {}'.format(self._done, elapsed))
+
+    self._running = False
+    on_done, self._on_result, self._on_done = self._on_done, None, None
+
+    if on_done is not None:
+      on_done(cancelled, error)
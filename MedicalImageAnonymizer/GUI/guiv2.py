@@ -21,7 +21,7 @@ class GUI:
 
     tabs = ttk.Notebook(self.window)
     tab_conf = _Config(self.window)
-    tab_load = _Anonymizer(self.window)
+    tab_load = _Anonymizer(self.window, config=tab_conf)
     tab_push = _Pusher([tab_conf, tab_load], self.window)
     tab_pull = _Puller([tab_conf, tab_load], self.window)
 
@@ -32,8 +32,20 @@ class GUI:
 
     tabs.pack(expand=1, fill='both')
 
+    self._tabs = [tab_load, tab_push, tab_pull]
+    self.window.protocol('WM_DELETE_WINDOW', self._close_cb)
+
     self.window.mainloop()
 
+  def _close_cb (self):
+    '''
+    Stop the running tasks before closing the window
+    '''
+    for tab in self._tabs:
+      tab._task.cancel()
+
+    self.window.destroy()
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import threading
+from functools import wraps
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer
+from http.server import BaseHTTPRequestHandler
+
+from MedicalImageAnonymizer.Profiler import profiler
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampier@unibo.it', 'nico.curti2@unibo.it']
+__package__ = 'Prometheus metrics export'
+
+
+def _format_labels (names, values, extra=()):
+  '''
+  Prometheus label set, e.g. {format="dcm",status="ok"}
+  '''
+  pairs = list(zip(names, values)) + list(extra)
+
+  if not pairs:
+    return ''
+
+  escape = lambda v : str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in pairs) + '}'
+
+
+class _ThreadingHTTPServer (ThreadingMixIn, HTTPServer):
+  '''
+  HTTP server with a thread for each request
+  (http.server.ThreadingHTTPServer is available only from python 3.7)
+  '''
+  daemon_threads = True
+
+
+class _Metric (object):
+
+  kind = 'untyped'
+
+  def __init__ (self, name, description, labels=()):
+    '''
+    Base metric: a value for each combination of the label values
+
+    Parameters
+    ----------
+      name: str
+        name of the metric
+
+      description: str
+        help text of the metric
+
+      labels: tuple of str
+        names of the labels
+    '''
+
+    self.name = name
+    self.description = description
+    self.labels = tuple(labels)
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def _key (self, labels):
+    return tuple(labels.get(k, '') for k in self.labels)
+
+  def _samples (self):
+    with self._lock:
+      return [(self.name, self._format(key), value) for key, value in sorted(self._values.items())]
+
+  def _format (self, key, extra=()):
+    return _format_labels(self.labels, key, extra)
+
+  def render (self):
+    '''
+    metric in the Prometheus text format
+    '''
+    lines = ['# HELP {} {}'.format(self.name, self.description),
+             '# TYPE {} {}'.format(self.name, self.kind)]
+    lines.extend('{}{} {}'.format(name, labels, repr(float(value))) for name, labels, value in self._samples())
+    return '\n'.join(lines)
+
+
+class Counter (_Metric):
+
+  kind = 'counter'
+
+  def inc (self, value=1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge (_Metric):
+
+  kind = 'gauge'
+
+  def set (self, value, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = value
+
+
+class Histogram (_Metric):
+
+  kind = 'histogram'
+
+  # seconds, from 1 ms to 5 min
+  default_buckets = (.001, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 300.)
+
+  def __init__ (self, name, description, labels=(), buckets=default_buckets):
+    super(Histogram, self).__init__(name, description, labels)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe (self, value, **labels):
+    key = self._key(labels)
+
+    with self._lock:
+      counts, total, observations = self._values.get(key, ([0] * len(self.buckets), 0., 0))
+
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+
+      self._values[key] = (counts, total + value, observations + 1)
+
+  def _samples (self):
+
+    samples = []
+
+    with self._lock:
+
+      for key, (counts, total, observations) in sorted(self._values.items()):
+
+        for bound, count in zip(self.buckets, counts):
+          samples.append((self.name + '_bucket', self._format(key, [('le', repr(bound))]), count))
+
+        samples.append((self.name + '_bucket', self._format(key, [('le', '+Inf')]), observations))
+        samples.append((self.name + '_sum', self._format(key), total))
+        samples.append((self.name + '_count', self._format(key), observations))
+
+    return samples
+
+
+class _Handler (BaseHTTPRequestHandler):
+  '''
+  Serve the metrics on GET /metrics
+  '''
+
+  registry = None
+
+  def do_GET (self):
+
+    if self.path.split('?')[0] not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+
+    body = self.registry.render().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message (self, *args):
+    # keep the console clean
+    pass
+
+
+class Metrics (object):
+
+  # stages of the transfers and their direction
+  _transfers = {'upload' : 'upload', 'upload.compressed' : 'upload',
+                'download' : 'download', 'download.compressed' : 'download'}
+
+  def __init__ (self):
+    '''
+    Metrics of the batch runs, exported in the Prometheus text format
+    through a text file (e.g. for the node_exporter textfile collector)
+    and/or a local HTTP endpoint.
+
+    The per-stage latencies, bytes, failures and transfer rates are fed
+    by the profiler (see Profiler.py), the per-file results by the
+    anonymizers (see per_file) and by the push/pull batch functions
+    (see file_processed) and the queue depths by the pipeline.
+    '''
+
+    self.enabled = False
+
+    self.files = Counter('mia_files_total', 'Files anonymized, pushed or pulled', ('operation', 'format', 'status'))
+    self.file_bytes = Counter('mia_file_bytes_total', 'Bytes of the files anonymized, pushed or pulled',
+                              ('operation', 'format'))
+    self.file_seconds = Histogram('mia_file_seconds', 'Processing time of each file', ('operation', 'format'))
+    self.stage_seconds = Histogram('mia_stage_seconds', 'Duration of each stage', ('stage',))
+    self.stage_bytes = Counter('mia_stage_bytes_total', 'Bytes read and written by each stage', ('stage', 'direction'))
+    self.stage_failures = Counter('mia_stage_failures_total', 'Failed executions of each stage', ('stage',))
+    self.transfer_rate = Gauge('mia_transfer_megabytes_per_second', 'Rate of the last transfer', ('direction',))
+    self.queue_depth = Gauge('mia_queue_depth', 'Items waiting in the queues of the pipeline', ('queue',))
+
+    self._metrics = [self.files, self.file_bytes, self.file_seconds, self.stage_seconds,
+                     self.stage_bytes, self.stage_failures, self.transfer_rate, self.queue_depth]
+
+    self._server = None
+    self._writer = None
+    self._stop = threading.Event()
+    self._enabled_profiler = False
+
+  def enable (self, port=None, textfile=None, interval=15., host='127.0.0.1'):
+    '''
+    Start collecting and exporting the metrics
+
+    Parameters
+    ----------
+      port: int
+        if given, serve the metrics on http://host:port/metrics
+
+      textfile: str
+        if given, the metrics are periodically written into this file
+
+      interval: float
+        seconds between two updates of the text file
+
+      host: str
+        address of the HTTP endpoint (local only by default)
+    '''
+
+    if not self.enabled:
+      # the stage measurements come from the profiler
+      if not profiler.enabled:
+        profiler.enable()
+        self._enabled_profiler = True
+
+      profiler.subscribe(self._on_stage)
+      self.enabled = True
+
+    if port and self._server is None:
+      handler = type('Handler', (_Handler, ), {'registry' : self})
+      self._server = _ThreadingHTTPServer((host, int(port)), handler)
+      thread = threading.Thread(target=self._server.serve_forever)
+      thread.daemon = True
+      thread.start()
+
+    if textfile and self._writer is None:
+      self._stop.clear()
+      self._writer = threading.Thread(target=self._write_periodically, args=(textfile, interval))
+      self._writer.daemon = True
+      self._writer.start()
+
+  def disable (self):
+    '''
+    Stop the collection and the export of the metrics
+    '''
+
+    if self.enabled:
+      profiler.unsubscribe(self._on_stage)
+
+      if self._enabled_profiler:
+        profiler.disable()
+        self._enabled_profiler = False
+
+      self.enabled = False
+
+    if self._server is not None:
+      self._server.shutdown()
+      self._server.server_close()
+      self._server = None
+
+    if self._writer is not None:
+      self._stop.set()
+      self._writer.join()
+      self._writer = None
+
+  def _write_periodically (self, textfile, interval):
+
+    while not self._stop.wait(interval):
+      self.write_textfile(textfile)
+
+    self.write_textfile(textfile)
+
+  def _on_stage (self, name, filename, seconds, succeeded, counters):
+    '''
+    profiler listener: update the metrics of the stage
+    '''
+
+    self.stage_seconds.observe(seconds, stage=name)
+
+    if not succeeded:
+      self.stage_failures.inc(stage=name)
+
+    for direction in ('read', 'written'):
+      nbytes = counters.get('bytes_' + direction, 0)
+      if nbytes:
+        self.stage_bytes.inc(nbytes, stage=name, direction=direction)
+
+    direction = self._transfers.get(name)
+
+    if direction is not None and succeeded and seconds > 0:
+      nbytes = counters.get('bytes_written' if direction == 'upload' else 'bytes_read', 0)
+      self.transfer_rate.set(nbytes / 2**20 / seconds, direction=direction)
+
+  def file_processed (self, filename, seconds, succeeded=True, operation='anonymize', nbytes=None):
+    '''
+    Record the result of a file
+
+    Parameters
+    ----------
+      filename: str
+        the original file
+
+      seconds: float
+        time spent on the file
+
+      succeeded: bool
+        False if the processing failed
+
+      operation: str
+        what was done on the file ('anonymize', 'push', 'pull' or 'sync')
+
+      nbytes: int
+        bytes processed (default the size of the file)
+    '''
+
+    if not self.enabled:
+      return
+
+    fmt = os.path.splitext(str(filename))[-1][1:].lower() or 'unknown'
+
+    self.files.inc(operation=operation, format=fmt, status='ok' if succeeded else 'failed')
+    self.file_seconds.observe(seconds, operation=operation, format=fmt)
+
+    try:
+      nbytes = os.path.getsize(str(filename)) if nbytes is None else nbytes
+      self.file_bytes.inc(nbytes, operation=operation, format=fmt)
+    except OSError:
+      pass
+
+  def set_queue_depth (self, queue, depth):
+    '''
+    Record the number of items waiting in a queue
+    '''
+
+    if self.enabled:
+      self.queue_depth.set(depth, queue=queue)
+
+  def render (self):
+    '''
+    All the metrics in the Prometheus text format
+    '''
+    return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+  def write_textfile (self, textfile):
+    '''
+    Atomically write the metrics into the given file
+    '''
+    partial = '{}.{}.tmp'.format(textfile, os.getpid())
+
+    with open(partial, 'w', encoding='utf-8') as fp:
+      fp.write(self.render())
+
+    os.replace(partial, textfile)
+
+
+def per_file (operation='anonymize'):
+  '''
+  Decorator of the per-file entry points (e.g. the anonymize method of
+  the anonymizers): the duration and the outcome of each call are
+  recorded for the file of the object (self._filename)
+  '''
+
+  def decorator (method):
+
+    @wraps(method)
+    def wrapper (self, *args, **kwargs):
+
+      if not metrics.enabled:
+        return method(self, *args, **kwargs)
+
+      tic = time.perf_counter()
+
+      try:
+        result = method(self, *args, **kwargs)
+
+      except Exception:
+        metrics.file_processed(self._filename, time.perf_counter() - tic, succeeded=False, operation=operation)
+        raise
+
+      metrics.file_processed(self._filename, time.perf_counter() - tic, operation=operation)
+
+      return result
+
+    return wrapper
+
+  return decorator
+
+
+# shared metrics: enabled at import time by the MIA_METRICS_PORT
+# and/or MIA_METRICS_FILE environment variables
+metrics = Metrics()
+
+if os.environ.get('MIA_METRICS_PORT') or os.environ.get('MIA_METRICS_FILE'):
+  metrics.enable(port=os.environ.get('MIA_METRICS_PORT'), textfile=os.environ.get('MIA_METRICS_FILE'))
@@ -9,6 +9,9 @@ from enum import Enum
 from ast import literal_eval
 
 from MedicalImageAnonymizer.Anonymizer import Anonymizer
+from MedicalImageAnonymizer.Anonymizer import OutputStream
+from MedicalImageAnonymizer.Profiler import profiler
+from MedicalImageAnonymizer.Metrics import per_file
 
 __author__ = ['Enrico Giampieri', 'Nico Curti']
 __email__ = ['enrico.giampier@unibo.it', 'nico.curti2@unibo.it']
@@ -26,6 +29,11 @@ class NiftiAnonymize (Anonymizer):
     ----------
       filename: str
         nifti filename to anonymize
+
+      alias: str or alias table
+        the alias of the patient, or a look up table of the aliases
+        (e.g. AliasTable) indexed by the original header fields or
+        by the name of the file (without extension)
     '''
 
     super(NiftiAnonymize, self).__init__(filename)
@@ -75,18 +83,52 @@ class NiftiAnonymize (Anonymizer):
           pass
 
     else:
+      alias = self._patient_alias(img)
+
       for tag in self.TAG_CODES:
         try:
-          img.header[tag.value] = b'anonymous' # TODO: add alias here for the patient name
+          img.header[tag.value] = alias if isinstance(alias, bytes) else alias.encode('utf-8')
         except KeyError:
           pass
 
+  def _patient_alias (self, img):
+    '''
+    Alias of the patient of the given image
+    '''
+    keys = [img.header[tag.value].item().decode('utf-8', 'replace').strip() for tag in self.TAG_CODES]
+
+    stem, ext = os.path.splitext(os.path.basename(self._filename))
+    keys.append(os.path.splitext(stem)[0] if ext == '.gz' else stem)
+
+    return self._lookup_alias(self.alias, keys)
+
+  def _save (self, img, outfile):
+    '''
+    Save the nifti image to the given filename or writable file-like object
+    '''
+
+    # the image data are loaded lazily, so the read is part of this stage
+    with profiler.stage('nifti.write', self._filename) as stage:
+
+      if self._is_stream(outfile):
+        stream = OutputStream(outfile)
+        img.to_file_map({k : nib.FileHolder(fileobj=stream) for k in img.file_map})
+        stage.add(bytes_written=stream.tell())
+
+      else:
+        nib.save(img, outfile)
+        stage.add(bytes_written=os.path.getsize(outfile))
+
+  @per_file('anonymize')
   def anonymize (self, outfile=None, outlog=None, infolog=False):
 
-    img = nib.load(self._filename)
+    with profiler.stage('nifti.read', self._filename) as stage:
+      img = nib.load(self._filename)
+      stage.add(bytes_read=os.path.getsize(self._filename))
 
-    infos = self._get_value_from_tag(img)
-    self._set_value_from_tag(img)
+    with profiler.stage('nifti.scrub', self._filename):
+      infos = self._get_value_from_tag(img)
+      self._set_value_from_tag(img)
 
     if infolog is not None:
       root, _ = os.path.splitext(self._filename)
@@ -94,17 +136,18 @@ class NiftiAnonymize (Anonymizer):
       if outfile is None:
         outfile = root + '_anonym.nii'
 
-      nib.save(img, outfile)
+      self._save(img, outfile)
 
       if outlog is None:
         outlog = root + '_info.json'
 
-      with open(outlog, 'w', encoding='utf-8') as log:
-        json.dump(infos, log)
-        log.write('\n')
+      with profiler.stage('log.write', self._filename):
+        with open(outlog, 'w', encoding='utf-8') as log:
+          json.dump(infos, log)
+          log.write('\n')
 
     else:
-      nib.save(img, self._filename)
+      self._save(img, self._filename)
 
 
   def deanonymize (self, infolog=False):
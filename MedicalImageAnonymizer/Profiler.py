@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import threading
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampier@unibo.it', 'nico.curti2@unibo.it']
+__package__ = 'Stage timers and counters'
+
+
+class _NullStage (object):
+  '''
+  Stage used when the profiler is disabled: it does nothing
+  '''
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, *args):
+    return False
+
+  def add (self, **counters):
+    pass
+
+_null_stage = _NullStage()
+
+
+class _Stage (object):
+  '''
+  Timer of a single execution of a stage
+  '''
+
+  def __init__ (self, profiler, name, filename, counters):
+    self._profiler = profiler
+    self.name = name
+    self.filename = filename
+    self.counters = counters
+    self._start = None
+
+  def __enter__ (self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__ (self, exc_type, *args):
+    seconds = time.perf_counter() - self._start
+    self._profiler._record(self, seconds, exc_type is None)
+    return False
+
+  def add (self, **counters):
+    '''
+    increment the counters of the stage (e.g. bytes_read, bytes_written, calls)
+    '''
+    for k, v in counters.items():
+      self.counters[k] = self.counters.get(k, 0) + v
+
+
+class Profiler (object):
+
+  def __init__ (self):
+    '''
+    Per-stage timers and counters.
+
+    Each stage (read, scrub, write, hash, upload, ...) is timed with
+    a context manager which also collects counters such as the bytes
+    read and written. The measurements are aggregated by stage and can
+    be written, one per line, into a JSON trace file.
+    When the profiler is disabled, the stages cost a single attribute check.
+
+    Example
+    -------
+    >>> from MedicalImageAnonymizer.Profiler import profiler
+    >>> profiler.enable()
+    >>> with profiler.stage('dicom.read', filename) as stage:
+    ...   stage.add(bytes_read=size)
+    >>> print(profiler.table())
+    '''
+
+    self.enabled = False
+    self._lock = threading.Lock()
+    self._stats = {}
+    self._trace = None
+    self._listeners = []
+
+  def enable (self, trace=None):
+    '''
+    Start the measurements
+
+    Parameters
+    ----------
+      trace: str
+        filename of the JSON-lines trace (one line for each stage
+        execution). If None, the measurements are only aggregated.
+    '''
+
+    with self._lock:
+
+      if self._trace is not None:
+        self._trace.close()
+
+      self._trace = open(trace, 'a', encoding='utf-8') if trace else None
+      self.enabled = True
+
+  def disable (self):
+    '''
+    Stop the measurements (the aggregated ones are kept)
+    '''
+
+    with self._lock:
+
+      self.enabled = False
+
+      if self._trace is not None:
+        self._trace.close()
+        self._trace = None
+
+  def subscribe (self, listener):
+    '''
+    Call listener(name, filename, seconds, succeeded, counters) at the
+    end of each stage (e.g. to export the metrics)
+    '''
+
+    with self._lock:
+      self._listeners.append(listener)
+
+  def unsubscribe (self, listener):
+
+    with self._lock:
+      self._listeners.remove(listener)
+
+  def reset (self):
+    '''
+    Drop the aggregated measurements
+    '''
+
+    with self._lock:
+      self._stats = {}
+
+  def stage (self, name, filename=None, **counters):
+    '''
+    Context manager which times a stage
+
+    Parameters
+    ----------
+      name: str
+        name of the stage (e.g. 'dicom.read')
+
+      filename: str
+        the file processed by the stage
+
+      counters: int
+        initial values of the counters of the stage
+
+    Returns
+    -------
+      stage: context manager
+        its add method increments the counters of the stage
+    '''
+
+    if not self.enabled:
+      return _null_stage
+
+    return _Stage(self, name, None if filename is None else str(filename), counters)
+
+  def _record (self, stage, seconds, succeeded):
+
+    with self._lock:
+
+      stats = self._stats.setdefault(stage.name, {'count' : 0, 'failures' : 0, 'seconds' : 0.})
+      stats['count'] += 1
+      stats['failures'] += not succeeded
+      stats['seconds'] += seconds
+
+      for k, v in stage.counters.items():
+        stats[k] = stats.get(k, 0) + v
+
+      if self._trace is not None:
+        record = dict(stage=stage.name, file=stage.filename, seconds=seconds, ok=succeeded, **stage.counters)
+        self._trace.write(json.dumps(record) + '\n')
+        self._trace.flush()
+
+      listeners = list(self._listeners)
+
+    for listener in listeners:
+      listener(stage.name, stage.filename, seconds, succeeded, stage.counters)
+
+  def summary (self):
+    '''
+    Aggregated measurements as dict stage : {count, failures, seconds, counters...}
+    '''
+
+    with self._lock:
+      return {name : dict(stats) for name, stats in self._stats.items()}
+
+  def table (self):
+    '''
+    Aggregated measurements as a printable table
+    '''
+
+    header = '{:<24} {:>8} {:>10} {:>10} {:>10} {:>10} {:>9}'.format('stage', 'count', 'seconds', 'ms/call',
+                                                                  'MB read', 'MB write', 'MB/s')
+    rows = [header, '-' * len(header)]
+
+    for name, stats in sorted(self.summary().items()):
+      nbytes = stats.get('bytes_read', 0) + stats.get('bytes_written', 0)
+      seconds = stats['seconds']
+      rows.append('{:<24} {:>8d} {:>10.3f} {:>10.2f} {:>10.1f} {:>10.1f} {:>9.1f}'.format(
+                  name, stats['count'], seconds, seconds / stats['count'] * 1e3,
+                  stats.get('bytes_read', 0) / 2**20, stats.get('bytes_written', 0) / 2**20,
+                  nbytes / 2**20 / seconds if seconds > 0 else 0.))
+
+    return '\n'.join(rows)
+
+
+# shared profiler: enabled at import time by the MIA_PROFILE environment
+# variable (1 to aggregate only, a filename to write the JSON-lines trace too)
+profiler = Profiler()
+
+_env = os.environ.get('MIA_PROFILE', '')
+
+if _env:
+  profiler.enable(None if _env == '1' else _env)
@@ -13,6 +13,8 @@ from functools import partial
 from ast import literal_eval
 
 from MedicalImageAnonymizer.Anonymizer import Anonymizer
+from MedicalImageAnonymizer.Profiler import profiler
+from MedicalImageAnonymizer.Metrics import per_file
 
 __author__ = ['Enrico Giampieri', 'Nico Curti']
 __email__ = ['enrico.giampier@unibo.it', 'nico.curti2@unibo.it']
@@ -218,6 +220,30 @@ class SVSAnonymize (Anonymizer):
     return (ID_is_label, to_nuke_offsets, to_nuke_byte_counts)
 
 
+  def _get_ranges_to_nuke (self, ifd_seq, ID_is_label, to_nuke_offsets, to_nuke_byte_counts):
+    '''
+    list of (offset, byte_count) of the file regions to nuke:
+    the label strips and the pointer to the first label
+    '''
+
+    ranges = []
+
+    for offsets, byte_counts in zip(to_nuke_offsets, to_nuke_byte_counts):
+      for offset, byte_count in zip(offsets, byte_counts):
+        # TODO: offset[1] - offset[0] == byte_count[0]
+        ranges.append((offset, byte_count))
+
+    # FIXME: here I'm working under the assumption that all the images are at the
+    # beginning, all the labels are at the end
+    # we need to be smarter than this
+    position_last_image = sum(not i for i in ID_is_label) - 1
+    last_image_id = ifd_seq[position_last_image]
+    last_offset = last_image_id['NextOffsetPosition']
+
+    ranges.append((last_offset, 4))
+
+    return ranges
+
   def _nuke (self, filename, ifd_seq, ID_is_label, to_nuke_offsets, to_nuke_byte_counts, infolog=False):
 
     infos = dict()
@@ -225,31 +251,54 @@ class SVSAnonymize (Anonymizer):
     with open(filename, 'r+b') as bfile:
       EMPTY = b'\x00'
 
-      for offsets, byte_counts in zip(to_nuke_offsets, to_nuke_byte_counts):
-        for offset, byte_count in zip(offsets, byte_counts):
-          # TODO: offset[1] - offset[0] == byte_count[0]
-          if infolog is not None:
-            bfile.seek(offset)
-            temp = bfile.read(byte_count)
-            infos[offset] = temp
+      for offset, byte_count in self._get_ranges_to_nuke(ifd_seq, ID_is_label, to_nuke_offsets, to_nuke_byte_counts):
 
+        if infolog is not None:
           bfile.seek(offset)
-          bfile.write(EMPTY * byte_count)
+          temp = bfile.read(byte_count)
+          infos[offset] = temp
 
-      # FIXME: here I'm working under the assumption that all the images are at the
-      # beginning, all the labels are at the end
-      # we need to be smarter than this
-      position_last_image = sum(not i for i in ID_is_label) - 1
-      last_image_id = ifd_seq[position_last_image]
-      last_offset = last_image_id['NextOffsetPosition']
+        bfile.seek(offset)
+        bfile.write(EMPTY * byte_count)
+
+    return infos
+
+  def _stream (self, filename, sink, ifd_seq, ID_is_label, to_nuke_offsets, to_nuke_byte_counts, infolog=False):
+    '''
+    copy the file into the writable sink nuking the label
+    regions on the fly, without any intermediate copy
+    '''
+
+    infos = dict()
+    chunk_size = 2**20
+    ranges = self._get_ranges_to_nuke(ifd_seq, ID_is_label, to_nuke_offsets, to_nuke_byte_counts)
+
+    with open(filename, 'rb') as bfile:
+      EMPTY = b'\x00'
 
       if infolog is not None:
-        bfile.seek(last_offset)
-        temp = bfile.read(4)
-        infos[last_offset] = temp
+        for offset, byte_count in ranges:
+          bfile.seek(offset)
+          infos[offset] = bfile.read(byte_count)
 
-      bfile.seek(last_offset)
-      bfile.write(EMPTY * 4)
+      bfile.seek(0)
+      position = 0
+
+      for offset, byte_count in sorted(ranges) + [(float('inf'), 0)]:
+
+        # copy the data up to the next region to nuke
+        while position < offset:
+          block = bfile.read(int(min(chunk_size, offset - position)))
+          if not block:
+            break
+          sink.write(block)
+          position += len(block)
+
+        if byte_count > position - offset:
+          skip = byte_count - max(position - offset, 0)
+          sink.write(EMPTY * skip)
+          position += skip
+          bfile.seek(position)
 
     return infos
 
@@ -274,40 +323,52 @@ class SVSAnonymize (Anonymizer):
       bfile.write(literal_eval(infos[str(last_offset)]))
 
 
+  @per_file('anonymize')
   def anonymize (self, outfile=None, outlog=None, infolog=False):
 
-    TifIfd_seq = self._get_ifd(self._filename)
+    with profiler.stage('svs.parse', self._filename):
 
-    if __debug__:
-      self._check(self._filename, TifIfd_seq)
+      TifIfd_seq = self._get_ifd(self._filename)
 
-    ID_is_label, to_nuke_offsets, to_nuke_byte_counts = self._get_position_to_nuke(self._filename, TifIfd_seq)
+      if __debug__:
+        self._check(self._filename, TifIfd_seq)
 
+      ID_is_label, to_nuke_offsets, to_nuke_byte_counts = self._get_position_to_nuke(self._filename, TifIfd_seq)
 
-    if infolog:
+    root, ext = os.path.splitext(self._filename)
+    size = os.path.getsize(self._filename)
 
-      root, ext = os.path.splitext(self._filename)
+    if self._is_stream(outfile):
 
-      if outfile is None:
-        outfile = root + '_anonym.svs'
+      with profiler.stage('svs.stream', self._filename, bytes_read=size, bytes_written=size):
+        infos = self._stream(self._filename, outfile, TifIfd_seq, ID_is_label, to_nuke_offsets, to_nuke_byte_counts, infolog)
 
-      shutil.copyfile(self._filename, outfile)
-      filename = outfile
+    else:
 
-      infos = dict()
+      if infolog:
 
-    else:
-      filename = self._filename
+        if outfile is None:
+          outfile = root + '_anonym.svs'
+
+        with profiler.stage('svs.copy', self._filename, bytes_read=size, bytes_written=size):
+          shutil.copyfile(self._filename, outfile)
+
+        filename = outfile
+
+      else:
+        filename = self._filename
 
-    infos = self._nuke(filename, TifIfd_seq, ID_is_label, to_nuke_offsets, to_nuke_byte_counts, infolog)
+      with profiler.stage('svs.nuke', self._filename):
+        infos = self._nuke(filename, TifIfd_seq, ID_is_label, to_nuke_offsets, to_nuke_byte_counts, infolog)
 
     if infolog:
 
       if outlog is None:
         outlog = root + '_info.json'
 
-      with open(outlog, 'w', encoding='utf-8') as log:
-        json.dump({str(k) : str(v) for k, v in infos.items()}, log)
+      with profiler.stage('log.write', self._filename):
+        with open(outlog, 'w', encoding='utf-8') as log:
+          json.dump({str(k) : str(v) for k, v in infos.items()}, log)
 
 
   def deanonymize (self, infolog=False):
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import sqlite3
+import threading
+from functools import lru_cache
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampier@unibo.it', 'nico.curti2@unibo.it']
+__package__ = 'DICOM UID remapping'
+
+
+# root of the UIDs derived from a 128 bit integer (PS3.5 B.2)
+_uid_root = '2.25.'
+# root of the UIDs defined by the standard (SOP classes, transfer
+# syntaxes, ...): they do not identify anything and they are kept
+_standard_root = '1.2.840.10008.'
+
+
+class UIDMap (object):
+
+  def __init__ (self, database=None, salt=None, cache_size=2**16):
+    '''
+    Consistent remapping of the DICOM UIDs.
+
+    Each UID is replaced by '2.25.' followed by the integer given by the
+    first 128 bits of sha256(salt + UID), so the same UID is always
+    mapped to the same new UID: all the files of a study (and the
+    references among them, inside the sequences too) stay consistent
+    without any coordination among threads or worker processes.
+
+    The UIDs already seen are kept in an LRU cache and, if a database is
+    given, the pairs are appended to a SQLite map (in WAL mode, so many
+    processes can write and read it concurrently) which stores the salt
+    too and allows to restore the original UIDs.
+
+    Parameters
+    ----------
+      database: str
+        SQLite file of the map. If it already stores a salt, that salt
+        is used, otherwise a new random one is stored.
+
+      salt: bytes or str
+        secret salt of the hash. If None, the salt of the database (or
+        a random one, if no database is given) is used.
+
+      cache_size: int
+        maximum number of UIDs in the LRU cache
+    '''
+
+    self.database = database
+    self._cache_size = cache_size
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._pending = []
+
+    if isinstance(salt, str):
+      salt = salt.encode('utf-8')
+
+    if database is not None:
+      salt = self._load_salt(salt)
+
+    self._salt = salt if salt is not None else os.urandom(32)
+    self._remap = lru_cache(maxsize=cache_size)(self._new_uid)
+
+  def _connection (self):
+    '''
+    connection to the database of the current thread
+    '''
+
+    db = getattr(self._local, 'db', None)
+
+    if db is None:
+      db = sqlite3.connect(self.database, timeout=60.)
+      db.execute('PRAGMA journal_mode = WAL')
+      db.execute('PRAGMA synchronous = NORMAL')
+      self._local.db = db
+
+    return db
+
+  def _load_salt (self, salt):
+
+    db = self._connection()
+
+    with db:
+      db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB NOT NULL)')
+      db.execute('CREATE TABLE IF NOT EXISTS uids (original TEXT PRIMARY KEY, remapped TEXT NOT NULL) WITHOUT ROWID')
+      db.execute('CREATE INDEX IF NOT EXISTS uids_remapped ON uids (remapped)')
+      # the first process stores the salt, the others use it
+      db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('salt', salt if salt is not None else os.urandom(32)))
+
+    stored = bytes(db.execute('SELECT value FROM meta WHERE name = ?', ('salt', )).fetchone()[0])
+
+    if salt is not None and salt != stored:
+      raise ValueError('The salt does not match the one stored in {}'.format(self.database))
+
+    return stored
+
+  def _new_uid (self, uid):
+
+    digest = hashlib.sha256(self._salt + uid.encode('utf-8')).digest()
+    new = _uid_root + str(int.from_bytes(digest[:16], 'big'))
+
+    if self.database is not None:
+      with self._lock:
+        self._pending.append((uid, new))
+
+    return new
+
+  def remap (self, uid):
+    '''
+    The new UID of the given one (the UIDs defined by the standard are kept)
+    '''
+
+    # the values read from the files can be padded with a null
+    uid = str(uid).rstrip('\x00 ')
+
+    if not uid or uid.startswith(_standard_root):
+      return uid
+
+    return self._remap(uid)
+
+  def commit (self):
+    '''
+    Store the new pairs into the database (a single transaction)
+    '''
+
+    with self._lock:
+      pending, self._pending = self._pending, []
+
+    if pending and self.database is not None:
+      db = self._connection()
+      with db:
+        db.executemany('INSERT OR IGNORE INTO uids VALUES (?, ?)', pending)
+
+  def original (self, uid):
+    '''
+    The original UID of a remapped one (None if it is not in the database)
+    '''
+
+    if self.database is None:
+      return None
+
+    self.commit()
+
+    row = self._connection().execute('SELECT original FROM uids WHERE remapped = ?', (str(uid).rstrip('\x00 '), )).fetchone()
+    return row[0] if row is not None else None
+
+  def __getstate__ (self):
+    # each process opens its own connection and cache
+    self.commit()
+    return {'database' : self.database, 'salt' : self._salt, 'cache_size' : self._cache_size}
+
+  def __setstate__ (self, state):
+    self.__init__(**state)
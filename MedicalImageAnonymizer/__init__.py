@@ -3,14 +3,49 @@
 
 # Import all the objects in the package
 
-from .DICOM_anonymizer import DICOMAnonymize
-from .Nifti_anonymizer import NiftiAnonymize
-from .SVS_anonymizer import SVSAnonymize
-from .GUI.gui import GUI
+import sys
+import importlib
 
 __package__ = 'MedicalImageAnonymizer'
 __author__  = ['Enrico Giampieri', 'Nico Curti']
 __email__ = ['enrico.giampier@unibo.it', 'nico.curti2@unibo.it']
 
-# aliases
+# the objects are imported at their first use, so the package starts
+# fast and the dependencies of a format (pydicom, nibabel) or of the GUI
+# (tkinter, plumbum, paramiko) are loaded only if they are needed
+_lazy_objects = {'DICOMAnonymize' : '.DICOM_anonymizer',
+                 'NiftiAnonymize' : '.Nifti_anonymizer',
+                 'SVSAnonymize'   : '.SVS_anonymizer',
+                 'GUI'            : '.GUI.gui',
+                 }
+
+__all__ = list(_lazy_objects)
+
+
+if sys.version_info >= (3, 7):
+
+  def __getattr__ (name):
+
+    try:
+      module = _lazy_objects[name]
+    except KeyError:
+      raise AttributeError('module {} has no attribute {}'.format(__name__, name))
 
+    obj = getattr(importlib.import_module(module, __name__), name)
+    # cache the object: the next accesses do not pass from here
+    globals()[name] = obj
+
+    return obj
+
+  def __dir__ ():
+    return sorted(set(globals()).union(__all__))
+
+else:
+
+  # module __getattr__ is not supported (PEP 562)
+  from .DICOM_anonymizer import DICOMAnonymize
+  from .Nifti_anonymizer import NiftiAnonymize
+  from .SVS_anonymizer import SVSAnonymize
+  from .GUI.gui import GUI
+
+# aliases
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+End-to-end anonymization benchmark over a synthetic corpus.
+
+Each format is anonymized in a fresh process, measuring the throughput
+(files/s and MB/s), the per-file latency percentiles and the peak
+resident memory. The results can be stored as baseline and the following
+runs are compared against it to flag the regressions.
+
+Example
+-------
+  python benchmarks/anonymization_benchmark.py --save-baseline
+  python benchmarks/anonymization_benchmark.py --check
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+  import resource
+
+except ImportError: # Windows
+  resource = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+from corpus import make_corpus
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+_baselines = os.path.join(here, 'baselines.json')
+
+# anonymizer of each format of the corpus
+_anonymizers = {'dcm' : ('MedicalImageAnonymizer.DICOM_anonymizer', 'DICOMAnonymize'),
+                'nii' : ('MedicalImageAnonymizer.Nifti_anonymizer', 'NiftiAnonymize'),
+                'svs' : ('MedicalImageAnonymizer.SVS_anonymizer', 'SVSAnonymize'),
+                }
+
+
+def _peak_rss ():
+  '''
+  peak resident memory of the current process in MB (None if unknown)
+  '''
+  if resource is None:
+    return None
+
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # bytes on macOS, kilobytes on Linux
+  return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def _run_format (ext, files, outdir, repeat):
+  '''
+  anonymize the files of a format (in a dedicated process)
+  '''
+  import warnings
+  import importlib
+
+  module, name = _anonymizers[ext]
+  anonymizer = getattr(importlib.import_module(module), name)
+
+  latencies = []
+  nbytes = 0
+
+  with warnings.catch_warnings():
+    # the scrubbed values are not valid for the date/time VRs
+    warnings.simplefilter('ignore')
+
+    for _ in range(repeat):
+      for filename in files:
+        root = os.path.join(outdir, os.path.splitext(os.path.basename(filename))[0])
+
+        tic = time.perf_counter()
+        anonymizer(filename).anonymize(outfile=root + '_anonym.' + ext, outlog=root + '_info.json', infolog=True)
+        latencies.append(time.perf_counter() - tic)
+
+        nbytes += os.path.getsize(filename)
+
+  elapsed = sum(latencies)
+
+  return dict(files=len(latencies),
+              megabytes=nbytes / 2**20,
+              files_per_second=len(latencies) / elapsed,
+              mb_per_second=nbytes / 2**20 / elapsed,
+              p50_ms=float(np.percentile(latencies, 50) * 1e3),
+              p90_ms=float(np.percentile(latencies, 90) * 1e3),
+              p99_ms=float(np.percentile(latencies, 99) * 1e3),
+              peak_rss_mb=_peak_rss())
+
+def run (dicom=20, nifti=20, svs=4, repeat=3, frames=8, volumes=10, levels=3, seed=42):
+  '''
+  Generate the corpus and benchmark every format
+
+  Returns
+  -------
+    results: dict
+      the measurements of each format ('dcm', 'nii', 'svs')
+  '''
+  root = tempfile.mkdtemp(prefix='mia_bench_')
+
+  try:
+    files = make_corpus(os.path.join(root, 'corpus'), dicom=dicom, nifti=nifti, svs=svs,
+                        dicom_params={'frames' : frames},
+                        nifti_params={'shape' : (64, 64, 32, volumes)},
+                        svs_params={'levels' : levels},
+                        seed=seed)
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+
+    for ext, names in files.items():
+
+      if not names:
+        continue
+
+      outdir = os.path.join(root, 'anonym_' + ext)
+      os.makedirs(outdir)
+
+      # a fresh process for each format: the peak memory is not shared
+      with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        results[ext] = pool.submit(_run_format, ext, names, outdir, repeat).result()
+
+  finally:
+    shutil.rmtree(root, ignore_errors=True)
+
+  return results
+
+def compare (results, baselines, tolerance=.2):
+  '''
+  Find the regressions with respect to the baselines
+
+  Parameters
+  ----------
+    results: dict
+      the current measurements
+
+    baselines: dict
+      the stored measurements
+
+    tolerance: float
+      relative worsening allowed
+
+  Returns
+  -------
+    regressions: list of str
+      description of each metric out of tolerance
+  '''
+  regressions = []
+
+  # (metric, True if higher is better)
+  metrics = (('mb_per_second', True), ('p90_ms', False), ('peak_rss_mb', False))
+
+  for ext, current in results.items():
+
+    baseline = baselines.get(ext)
+
+    if baseline is None:
+      continue
+
+    for metric, higher_is_better in metrics:
+
+      old, new = baseline.get(metric), current.get(metric)
+
+      if old is None or new is None:
+        continue
+
+      if higher_is_better:
+        worse = new < old * (1. - tolerance)
+      else:
+        worse = new > old * (1. + tolerance)
+
+      if worse:
+        regressions.append('{}: {} {:.2f} (baseline {:.2f})'.format(ext, metric, new, old))
+
+  return regressions
+
+def parse_args ():
+
+  description = 'Anonymization benchmark over a synthetic corpus'
+
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument('--dicom', dest='dicom', type=int, default=20, help='number of DICOM files')
+  parser.add_argument('--nifti', dest='nifti', type=int, default=20, help='number of NIfTI files')
+  parser.add_argument('--svs', dest='svs', type=int, default=4, help='number of SVS files')
+  parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='times each file is anonymized')
+  parser.add_argument('--frames', dest='frames', type=int, default=8, help='frames of each DICOM file')
+  parser.add_argument('--volumes', dest='volumes', type=int, default=10, help='volumes of each NIfTI file')
+  parser.add_argument('--levels', dest='levels', type=int, default=3, help='pyramid levels of each SVS file')
+  parser.add_argument('--baselines', dest='baselines', type=str, default=_baselines, help='baselines file')
+  parser.add_argument('--save-baseline', dest='save', action='store_true', help='store the results as baselines')
+  parser.add_argument('--check', dest='check', action='store_true', help='exit with error on regressions')
+  parser.add_argument('--tolerance', dest='tolerance', type=float, default=.2, help='relative worsening allowed')
+  parser.add_argument('--json', dest='json', action='store_true', help='print the results as JSON')
+
+  return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+  args = parse_args()
+
+  results = run(dicom=args.dicom, nifti=args.nifti, svs=args.svs, repeat=args.repeat,
+                frames=args.frames, volumes=args.volumes, levels=args.levels)
+
+  if args.json:
+    print(json.dumps(results, indent=2))
+
+  else:
+    print('{:<6} {:>7} {:>10} {:>8} {:>9} {:>9} {:>9} {:>9}'.format('format', 'files', 'files/s', 'MB/s',
+                                                                  'p50 ms', 'p90 ms', 'p99 ms', 'RSS MB'))
+    for ext, r in results.items():
+      print('{:<6} {files:>7d} {files_per_second:>10.1f} {mb_per_second:>8.1f} '
+            '{p50_ms:>9.2f} {p90_ms:>9.2f} {p99_ms:>9.2f} {rss:>9}'.format(ext, rss='{:.1f}'.format(r['peak_rss_mb'])
+                                                                                if r['peak_rss_mb'] is not None else '-', **r))
+
+  if args.save:
+    with open(args.baselines, 'w') as fp:
+      json.dump(results, fp, indent=2)
+      fp.write('\n')
+
+  elif os.path.isfile(args.baselines):
+
+    with open(args.baselines, 'r') as fp:
+      baselines = json.load(fp)
+
+    regressions = compare(results, baselines, args.tolerance)
+
+    for regression in regressions:
+      print('REGRESSION {}'.format(regression))
+
+    if regressions and args.check:
+      sys.exit(1)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Synthetic corpus of medical images for the benchmarks.
+
+  * multi-frame DICOM files carrying all the sensitive tags listed in
+    dicom_tags.ini (private ones included)
+  * 4D NIfTI files with patient informations in the header
+  * pyramidal Aperio-like SVS files with label and macro images
+
+The content is random but deterministic (given the seed).
+
+Example
+-------
+  python benchmarks/corpus.py ./corpus --dicom 10 --nifti 10 --svs 2
+'''
+
+import os
+import struct
+import argparse
+from ast import literal_eval
+from configparser import ConfigParser
+
+import numpy as np
+import pydicom
+import nibabel as nib
+from pydicom.dataset import Dataset
+from pydicom.dataset import FileMetaDataset
+from pydicom.datadict import dictionary_VR
+from pydicom.uid import ExplicitVRLittleEndian
+from pydicom.uid import generate_uid
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+_dicom_tags = os.path.join(here, '..', 'MedicalImageAnonymizer', 'GUI', 'dicom_tags.ini')
+
+# plausible values of the sensitive fields, by VR
+_phi_values = {'PN' : 'Rossi^Mario',
+               'DA' : '19700101',
+               'TM' : '120000',
+               'DT' : '19700101120000',
+               'LO' : 'Ospedale S. Orsola',
+               'SH' : 'PHI',
+               'IS' : '1',
+               'DS' : '1.0',
+               'UI' : '1.2.3.4',
+               'CS' : 'PHI',
+               }
+
+
+def _load_dicom_tags (filename=_dicom_tags):
+  '''
+  list of the (group, element) tags of the configuration file
+  '''
+  parser = ConfigParser()
+  parser.read(filename)
+
+  return [tuple(int(x, 16) for x in literal_eval(tag)) for tag in parser['DICOM_TAGS'].values()]
+
+def make_dicom (filename, rows=256, columns=256, frames=8, rng=None):
+  '''
+  Write a multi-frame (16 bit, uncompressed) DICOM file with all the
+  tags of dicom_tags.ini filled with sensitive-looking values
+  '''
+  rng = rng or np.random.default_rng()
+
+  meta = FileMetaDataset()
+  meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7.3'
+  meta.MediaStorageSOPInstanceUID = generate_uid()
+  meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+  ds = Dataset()
+  ds.file_meta = meta
+  ds.SOPClassUID = meta.MediaStorageSOPClassUID
+  ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+  ds.StudyInstanceUID = generate_uid()
+  ds.SeriesInstanceUID = generate_uid()
+  ds.Modality = 'OT'
+  ds.PatientSex = 'M'
+  ds.StudyDate = '20200101'
+
+  for group, element in _load_dicom_tags():
+    tag = (group << 16) | element
+
+    if group % 2:
+      # private tags: creators are LO, data are stored as LO as well
+      vr = 'LO'
+      value = 'MIA SYNTHETIC' if element <= 0xff else _phi_values['LO']
+    else:
+      vr = dictionary_VR(tag)
+      value = _phi_values.get(vr, 'PHI')
+
+    ds.add_new(tag, vr, value)
+
+  ds.SamplesPerPixel = 1
+  ds.PhotometricInterpretation = 'MONOCHROME2'
+  ds.Rows = rows
+  ds.Columns = columns
+  ds.NumberOfFrames = frames
+  ds.BitsAllocated = 16
+  ds.BitsStored = 12
+  ds.HighBit = 11
+  ds.PixelRepresentation = 0
+
+  # smooth images with noise, as compressible as a real acquisition
+  y, x = np.mgrid[:rows, :columns]
+  base = (np.sin(x / 17.) * np.cos(y / 23.) + 1.) * 1000.
+  pixels = base[None] + rng.normal(0., 50., size=(frames, rows, columns))
+  ds.PixelData = np.clip(pixels, 0, 4095).astype('<u2').tobytes()
+
+  ds.save_as(filename, enforce_file_format=True)
+
+def make_nifti (filename, shape=(64, 64, 32, 10), rng=None):
+  '''
+  Write a 4D NIfTI file with patient informations in the header
+  '''
+  rng = rng or np.random.default_rng()
+
+  data = rng.normal(500., 100., size=shape).astype(np.int16)
+  img = nib.Nifti1Image(data, np.eye(4))
+  img.header['descrip'] = b'Rossi Mario 19700101'
+  img.header['db_name'] = b'S.Orsola'
+
+  nib.save(img, filename)
+
+def make_svs (filename, levels=3, strip_size=2**16, strips=16, labels=('label', 'macro'), rng=None):
+  '''
+  Write a pyramidal Aperio-like SVS (little endian TIFF) file.
+
+  The image levels come first (each level has half the strips of the
+  previous one) and the label and macro images follow, as written by
+  the Aperio scanners. All the images are stored in strips.
+  '''
+  rng = rng or np.random.default_rng()
+
+  # header with the offset of the first IFD filled at the end
+  buffer = bytearray(b'II*\x00\x00\x00\x00\x00')
+  ifds = []
+
+  width = 1 << (12 + levels)
+  descriptions = ['{0}x{0} [0,0 {0}x{0}] (240x240) JPEG/RGB Q=70'.format(width >> i) for i in range(levels)]
+  descriptions += ['{} {}x{}'.format(name, 1024, 768) for name in labels]
+  nstrips = [max(1, strips >> i) for i in range(levels)] + [max(1, strips // 4)] * len(labels)
+
+  for description, count in zip(descriptions, nstrips):
+    description = 'Aperio Image Library v11.2.1\n{}|AppMag = 40|Patient = Rossi Mario'.format(description)
+    description = description.encode('utf-8') + b'\x00'
+    offsets = []
+
+    for _ in range(count):
+      offsets.append(len(buffer))
+      buffer += rng.integers(0, 256, strip_size, dtype=np.uint8).tobytes()
+
+    description_offset = len(buffer)
+    buffer += description
+
+    offsets_offset = len(buffer)
+    buffer += struct.pack('<{:d}I'.format(count), *offsets)
+
+    counts_offset = len(buffer)
+    buffer += struct.pack('<{:d}I'.format(count), *[strip_size] * count)
+
+    # (tag, type, count, value/offset); the strip arrays are always
+    # stored out of the IFD so the anonymizer can read them back
+    ifds.append([(256, 4, 1, 1024), (257, 4, 1, 768),
+                 (270, 2, len(description), description_offset),
+                 (273, 4, count, offsets_offset if count > 1 else offsets[0]),
+                 (279, 4, count, counts_offset if count > 1 else strip_size)])
+
+  if len(buffer) % 2:
+    buffer += b'\x00'
+
+  positions = []
+  position = len(buffer)
+
+  for tags in ifds:
+    positions.append(position)
+    position += 2 + 12 * len(tags) + 4
+
+  for i, tags in enumerate(ifds):
+    buffer += struct.pack('<H', len(tags))
+
+    for tag in tags:
+      buffer += struct.pack('<HHII', *tag)
+
+    buffer += struct.pack('<I', positions[i + 1] if i + 1 < len(positions) else 0)
+
+  buffer[4:8] = struct.pack('<I', positions[0])
+
+  with open(filename, 'wb') as fp:
+    fp.write(bytes(buffer))
+
+def make_corpus (directory, dicom=10, nifti=10, svs=2, dicom_params=None, nifti_params=None, svs_params=None, seed=42):
+  '''
+  Generate the synthetic corpus
+
+  Parameters
+  ----------
+    directory: str
+      output directory (created if needed)
+
+    dicom, nifti, svs: int
+      number of files of each format
+
+    dicom_params, nifti_params, svs_params: dict
+      keyword arguments of make_dicom, make_nifti and make_svs
+
+    seed: int
+      seed of the random generator
+
+  Returns
+  -------
+    files: dict
+      the list of files generated for each format ('dcm', 'nii', 'svs')
+  '''
+  rng = np.random.default_rng(seed)
+  os.makedirs(directory, exist_ok=True)
+
+  makers = (('dcm', dicom, make_dicom, dicom_params),
+            ('nii', nifti, make_nifti, nifti_params),
+            ('svs', svs, make_svs, svs_params))
+
+  files = {}
+
+  for ext, number, maker, params in makers:
+    files[ext] = []
+
+    for i in range(number):
+      filename = os.path.join(directory, '{}_{:05d}.{}'.format(ext, i, ext))
+      maker(filename, rng=rng, **(params or {}))
+      files[ext].append(filename)
+
+  return files
+
+def parse_args ():
+
+  description = 'Synthetic corpus of DICOM, NIfTI and SVS files'
+
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument('directory', type=str, help='output directory')
+  parser.add_argument('--dicom', dest='dicom', type=int, default=10, help='number of DICOM files')
+  parser.add_argument('--nifti', dest='nifti', type=int, default=10, help='number of NIfTI files')
+  parser.add_argument('--svs', dest='svs', type=int, default=2, help='number of SVS files')
+  parser.add_argument('--frames', dest='frames', type=int, default=8, help='frames of each DICOM file')
+  parser.add_argument('--volumes', dest='volumes', type=int, default=10, help='volumes of each NIfTI file')
+  parser.add_argument('--levels', dest='levels', type=int, default=3, help='pyramid levels of each SVS file')
+  parser.add_argument('--seed', dest='seed', type=int, default=42, help='seed of the random generator')
+
+  return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+  args = parse_args()
+
+  files = make_corpus(args.directory, dicom=args.dicom, nifti=args.nifti, svs=args.svs,
+                      dicom_params={'frames' : args.frames},
+                      nifti_params={'shape' : (64, 64, 32, args.volumes)},
+                      svs_params={'levels' : args.levels},
+                      seed=args.seed)
+
+  for ext, names in files.items():
+    print('{}: {:d} files'.format(ext, len(names)))
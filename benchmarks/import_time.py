@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Import time of the package, measured with python -X importtime.
+
+Each statement is executed in a fresh interpreter: the cumulative
+import time of the package and the heavy dependencies loaded are
+reported. The bare package import must not load any of them.
+
+Example
+-------
+  python benchmarks/import_time.py --check
+'''
+
+import os
+import sys
+import argparse
+import subprocess
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.abspath(os.path.join(here, '..'))
+
+# dependencies which must be loaded only when needed
+_heavy = ('pydicom', 'nibabel', 'numpy', 'tkinter', 'plumbum', 'paramiko')
+
+# statement : heavy modules allowed
+_statements = {'import MedicalImageAnonymizer' : (),
+               'from MedicalImageAnonymizer import SVSAnonymize' : (),
+               'from MedicalImageAnonymizer import DICOMAnonymize' : ('pydicom', 'numpy'),
+               # nibabel imports pydicom on its own
+               'from MedicalImageAnonymizer import NiftiAnonymize' : ('nibabel', 'pydicom', 'numpy'),
+               }
+
+
+def import_time (statement, repeat=5):
+  '''
+  Measure the import time of the statement
+
+  Returns
+  -------
+    microseconds: int
+      best cumulative import time (over repeat runs) of the top level modules
+
+    loaded: list of str
+      heavy dependencies imported by the statement
+  '''
+  best = None
+  loaded = []
+
+  for _ in range(repeat):
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                         cwd=root, stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+
+    total = 0
+    modules = []
+
+    for line in out.splitlines():
+
+      if not line.startswith('import time:') or 'cumulative' in line:
+        continue
+
+      _, cumulative, name = line[len('import time:'):].split('|')
+      modules.append(name.strip())
+
+      # the top level imports are not indented
+      if not name.startswith('  '):
+        total += int(cumulative)
+
+    best = total if best is None else min(best, total)
+    loaded = [m for m in _heavy if m in modules]
+
+  return best, loaded
+
+def parse_args ():
+
+  description = 'Import time of the package'
+
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument('--repeat', dest='repeat', type=int, default=5, help='runs of each statement')
+  parser.add_argument('--check', dest='check', action='store_true', help='exit with error if unexpected dependencies are loaded')
+
+  return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+  args = parse_args()
+  failures = 0
+
+  print('{:<52} {:>10}  {}'.format('statement', 'ms', 'heavy dependencies'))
+
+  for statement, allowed in _statements.items():
+    microseconds, loaded = import_time(statement, args.repeat)
+    unexpected = [m for m in loaded if m not in allowed]
+    failures += bool(unexpected)
+
+    print('{:<52} {:>10.1f}  {}{}'.format(statement, microseconds / 1e3, ', '.join(loaded) or '-',
+                                          '  UNEXPECTED: {}'.format(', '.join(unexpected)) if unexpected else ''))
+
+  if failures and args.check:
+    sys.exit(1)
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Local stand-in for the remote server used by the push/pull functions.
+
+A paramiko based SSH server listening on the loopback interface which
+serves the local filesystem through SFTP and runs the shell and exec
+requests as local processes (as plumbum's ParamikoMachine requires).
+Latency and bandwidth limits can be injected to simulate a slow link.
+'''
+
+import os
+import time
+import socket
+import select
+import threading
+import subprocess
+import paramiko
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+class _Link (object):
+  '''
+  Simulated network link: fixed round trip latency and
+  bandwidth shared by all the channels of the server.
+  '''
+
+  def __init__ (self, latency=0., bandwidth=None):
+    '''
+    Parameters
+    ----------
+      latency: float
+        seconds waited for each remote request
+
+      bandwidth: float or None
+        maximum number of bytes per second transferred by the link.
+        None means unlimited
+    '''
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self._lock = threading.Lock()
+    self._next_free = 0.
+
+  def request (self):
+    if self.latency:
+      time.sleep(self.latency)
+
+  def transfer (self, nbytes):
+    if not self.bandwidth:
+      return
+
+    # the link is shared: reserve the time slot needed by the transfer
+    with self._lock:
+      start = max(time.time(), self._next_free)
+      self._next_free = start + nbytes / self.bandwidth
+
+    delay = self._next_free - time.time()
+    if delay > 0:
+      time.sleep(delay)
+
+
+class _Handle (paramiko.SFTPHandle):
+
+  def __init__ (self, link, flags=0):
+    super(_Handle, self).__init__(flags)
+    self._link = link
+
+  def read (self, offset, length):
+    data = super(_Handle, self).read(offset, length)
+    if isinstance(data, bytes):
+      self._link.transfer(len(data))
+    return data
+
+  def write (self, offset, data):
+    self._link.transfer(len(data))
+    return super(_Handle, self).write(offset, data)
+
+  def stat (self):
+    try:
+      return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+  def chattr (self, attr):
+    try:
+      paramiko.SFTPServer.set_file_attr(self.filename, attr)
+      return paramiko.SFTP_OK
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class _SFTPInterface (paramiko.SFTPServerInterface):
+  '''
+  SFTP access to the local filesystem (paths are used as they are)
+  '''
+
+  def __init__ (self, server, *args, **kwargs):
+    super(_SFTPInterface, self).__init__(server, *args, **kwargs)
+    self._link = server.link
+
+  def _call (self, func, *args):
+    self._link.request()
+    try:
+      return func(*args)
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+  def canonicalize (self, path):
+    return os.path.abspath(path)
+
+  def list_folder (self, path):
+
+    def _list (path):
+      out = []
+      for name in os.listdir(path):
+        attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+        attr.filename = name
+        out.append(attr)
+      return out
+
+    return self._call(_list, path)
+
+  def stat (self, path):
+    return self._call(lambda p: paramiko.SFTPAttributes.from_stat(os.stat(p)), path)
+
+  def lstat (self, path):
+    return self._call(lambda p: paramiko.SFTPAttributes.from_stat(os.lstat(p)), path)
+
+  def open (self, path, flags, attr):
+
+    def _open (path, flags, attr):
+      binary_flag = getattr(os, 'O_BINARY', 0)
+      fd = os.open(path, flags | binary_flag, 0o666)
+
+      if flags & os.O_WRONLY:
+        mode = 'ab' if flags & os.O_APPEND else 'wb'
+      elif flags & os.O_RDWR:
+        mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+      else:
+        mode = 'rb'
+
+      fobj = os.fdopen(fd, mode)
+      handle = _Handle(self._link, flags)
+      handle.filename = path
+      handle.readfile = fobj
+      handle.writefile = fobj
+      return handle
+
+    return self._call(_open, path, flags, attr)
+
+  def remove (self, path):
+    return self._call(lambda p: os.remove(p) or paramiko.SFTP_OK, path)
+
+  def rename (self, oldpath, newpath):
+    return self._call(lambda o, n: os.rename(o, n) or paramiko.SFTP_OK, oldpath, newpath)
+
+  def posix_rename (self, oldpath, newpath):
+    return self._call(lambda o, n: os.replace(o, n) or paramiko.SFTP_OK, oldpath, newpath)
+
+  def mkdir (self, path, attr):
+    return self._call(lambda p: os.mkdir(p) or paramiko.SFTP_OK, path)
+
+  def rmdir (self, path):
+    return self._call(lambda p: os.rmdir(p) or paramiko.SFTP_OK, path)
+
+  def chattr (self, path, attr):
+    return self._call(lambda p: paramiko.SFTPServer.set_file_attr(p, attr) or paramiko.SFTP_OK, path)
+
+
+class _ServerInterface (paramiko.ServerInterface):
+  '''
+  Accept every user and run the shell/exec requests as local processes
+  '''
+
+  def __init__ (self, link, cwd):
+    self.link = link
+    self._cwd = cwd
+
+  def get_allowed_auths (self, username):
+    return 'publickey,password'
+
+  def check_auth_password (self, username, password):
+    return paramiko.AUTH_SUCCESSFUL
+
+  def check_auth_publickey (self, username, key):
+    return paramiko.AUTH_SUCCESSFUL
+
+  def check_channel_request (self, kind, chanid):
+    if kind == 'session':
+      return paramiko.OPEN_SUCCEEDED
+    return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_REQUEST
+
+  def check_channel_pty_request (self, *args):
+    return True
+
+  def check_channel_shell_request (self, channel):
+    self._spawn(channel, ['sh'])
+    return True
+
+  def check_channel_exec_request (self, channel, command):
+    self.link.request()
+    self._spawn(channel, ['sh', '-c', command.decode('utf-8')])
+    return True
+
+  def _spawn (self, channel, argv):
+    proc = subprocess.Popen(argv, cwd=self._cwd,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            bufsize=0)
+    thread = threading.Thread(target=_pump, args=(channel, proc, self.link))
+    thread.daemon = True
+    thread.start()
+
+
+def _pump (channel, proc, link):
+  '''
+  Move the data between the channel and the local process until
+  the process ends
+  '''
+  try:
+    _pump_until_exit(channel, proc, link)
+  except OSError:
+    # the client closed the channel before the end of the process
+    proc.kill()
+
+  proc.wait()
+  channel.close()
+
+def _pump_until_exit (channel, proc, link):
+
+  outputs = {proc.stdout.fileno(): channel.sendall,
+             proc.stderr.fileno(): channel.sendall_stderr}
+  stdin_open = True
+
+  while outputs:
+
+    if stdin_open and channel.recv_ready():
+      data = channel.recv(2**15)
+      if data:
+        link.transfer(len(data))
+        proc.stdin.write(data)
+      else:
+        stdin_open = False
+        proc.stdin.close()
+
+    elif stdin_open and channel.eof_received:
+      stdin_open = False
+      proc.stdin.close()
+
+    ready, _, _ = select.select(list(outputs), [], [], 0.01)
+
+    for fd in ready:
+      data = os.read(fd, 2**15)
+      if data:
+        link.transfer(len(data))
+        outputs[fd](data)
+      else:
+        del outputs[fd]
+
+  channel.send_exit_status(proc.wait())
+  channel.shutdown_write()
+
+
+class StandInServer (object):
+  '''
+  SSH/SFTP server on the loopback interface
+
+  Example
+  -------
+  >>> with StandInServer(latency=0.01, bandwidth=10 * 2**20) as server:
+  ...   params = server.connection_params
+  '''
+
+  def __init__ (self, latency=0., bandwidth=None, cwd=None, host='127.0.0.1', port=0):
+    '''
+    Parameters
+    ----------
+      latency: float
+        seconds waited for each remote request (SFTP operation or command)
+
+      bandwidth: float or None
+        maximum number of bytes per second moved by the server.
+        None means unlimited
+
+      cwd: str
+        working directory of the remote shell (default: current directory)
+
+      host: str
+        listening address
+
+      port: int
+        listening port (0 means a random free port)
+    '''
+    self.link = _Link(latency, bandwidth)
+    self._cwd = cwd or os.getcwd()
+    self._host_key = paramiko.RSAKey.generate(2048)
+
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._socket.bind((host, port))
+    self._socket.listen(16)
+    self.host, self.port = self._socket.getsockname()
+
+    self._transports = []
+    self._running = False
+    self._thread = None
+
+  def _serve (self):
+
+    while self._running:
+
+      try:
+        client, _ = self._socket.accept()
+      except OSError:
+        break
+
+      # avoid the delayed acknowledgements of the small SFTP replies
+      client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      transport = paramiko.Transport(client)
+      transport.add_server_key(self._host_key)
+      transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTPInterface)
+      transport.start_server(server=_ServerInterface(self.link, self._cwd))
+      self._transports.append(transport)
+
+  def start (self):
+    self._running = True
+    self._thread = threading.Thread(target=self._serve)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def stop (self):
+    self._running = False
+    self._socket.close()
+
+    for transport in self._transports:
+      transport.close()
+
+  def __enter__ (self):
+    return self.start()
+
+  def __exit__ (self, *args):
+    self.stop()
+
+  @property
+  def connection_params (self):
+    '''
+    Connection parameters in the format used by the push/pull functions
+    '''
+    return dict(host=self.host, port=self.port, user=os.environ.get('USER', 'mia'),
+                password='mia', look_for_keys=False, load_system_host_keys=False)
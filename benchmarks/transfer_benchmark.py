@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Push/pull benchmark against the local stand-in server.
+
+A synthetic corpus is pushed and pulled through the loopback SSH/SFTP
+server of sftp_server.py (with the given latency and bandwidth) using
+both the single-file functions and the batched ones, reporting files/s
+and MB/s for each of them.
+
+Example
+-------
+  python benchmarks/transfer_benchmark.py --files 200 --size 256 --latency 0.005
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'MedicalImageAnonymizer', 'GUI'))
+
+from plumbum import local
+from plumbum.path import Path
+from sftp_server import StandInServer
+from _ssh_utils import push_single_file
+from _ssh_utils import pull_single_file
+from _ssh_utils import push_files
+from _ssh_utils import pull_files
+from _ssh_utils import sync_results
+from _ssh_codec import TransferCodec
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+def make_corpus (directory, nfiles, size, ext='.dcm', seed=42):
+  '''
+  Write nfiles files of size bytes: half random data and half
+  smooth gradients, roughly as compressible as raw medical images.
+  '''
+  rng = np.random.default_rng(seed)
+  os.makedirs(directory, exist_ok=True)
+  files = []
+
+  for i in range(nfiles):
+    noise = rng.integers(0, 256, size // 2, dtype=np.uint8).tobytes()
+    ramp = (np.arange(size - size // 2) // 64 % 256).astype(np.uint8).tobytes()
+    filename = os.path.join(directory, '{:06d}{}'.format(i, ext))
+
+    with open(filename, 'wb') as fp:
+      fp.write(noise + ramp)
+
+    files.append(filename)
+
+  return files
+
+def _move_to_done (base):
+  '''
+  simulate the remote processing: every pushed file becomes a result
+  '''
+  todo, done = os.path.join(base, 'todo'), os.path.join(base, 'done')
+
+  for name in os.listdir(todo):
+    os.replace(os.path.join(todo, name), os.path.join(done, name))
+
+def _reset (base, out):
+
+  for directory in (os.path.join(base, 'todo'), os.path.join(base, 'done'), out):
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+def _measure (name, func, nfiles, nbytes):
+
+  tic = time.perf_counter()
+  func()
+  elapsed = time.perf_counter() - tic
+
+  return dict(name=name, seconds=elapsed,
+              files_per_second=nfiles / elapsed,
+              mb_per_second=nbytes / elapsed / 2**20)
+
+def run (nfiles=100, size=2**18, latency=0., bandwidth=None, workers=4, compression=False, skip_single=False):
+  '''
+  Run the benchmark and return the list of measurements
+
+  Parameters
+  ----------
+    nfiles: int
+      number of files of the corpus
+
+    size: int
+      size in bytes of each file
+
+    latency: float
+      seconds waited by the server for each request
+
+    bandwidth: float or None
+      bytes per second of the simulated link (None means unlimited)
+
+    workers: int
+      parallel connections used by the incremental sync
+
+    compression: bool
+      use the on-the-wire compression in the batched functions
+
+    skip_single: bool
+      skip the (slow) single-file functions
+  '''
+  root = tempfile.mkdtemp(prefix='mia_bench_')
+  base = os.path.join(root, 'server')
+  out = os.path.join(root, 'pulled')
+  files = make_corpus(os.path.join(root, 'corpus'), nfiles, size)
+  nbytes = nfiles * size
+  remote = dict(base_dir=base, todo_subdir='todo', done_subdir='done')
+  results = []
+
+  try:
+
+    with StandInServer(latency=latency, bandwidth=bandwidth, cwd=root) as server:
+
+      params = server.connection_params
+
+      def _push_single ():
+        for f in files:
+          push_single_file(Path(f), params, remote)
+
+      def _pull_single ():
+        for f in files:
+          pull_single_file(local.path(f), local.path(out), params, remote)
+
+      def _push_batch ():
+        codec = TransferCodec() if compression else None
+        for _ in push_files(map(Path, files), params, remote, codec=codec):
+          pass
+
+      def _pull_batch ():
+        codec = TransferCodec() if compression else None
+        for _ in pull_files(map(local.path, files), local.path(out), params, remote, ttl=0., codec=codec):
+          pass
+
+      def _sync ():
+        codec = TransferCodec() if compression else None
+        for _ in sync_results(map(local.path, files), out, params, remote, workers=workers, codec=codec):
+          pass
+
+      if not skip_single:
+        _reset(base, out)
+        results.append(_measure('push_single_file', _push_single, nfiles, nbytes))
+        _move_to_done(base)
+        results.append(_measure('pull_single_file', _pull_single, nfiles, nbytes))
+
+      _reset(base, out)
+      results.append(_measure('push_files', _push_batch, nfiles, nbytes))
+      _move_to_done(base)
+      results.append(_measure('pull_files', _pull_batch, nfiles, nbytes))
+
+      shutil.rmtree(out)
+      results.append(_measure('sync_results', _sync, nfiles, nbytes))
+      # nothing new on the server: the cost of a polling round
+      results.append(_measure('sync_results (no changes)', _sync, nfiles, 0))
+
+  finally:
+    shutil.rmtree(root, ignore_errors=True)
+
+  return results
+
+def parse_args ():
+
+  description = 'Push/pull benchmark against a local SSH/SFTP stand-in server'
+
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument('--files', dest='nfiles', type=int, default=100, help='number of files of the corpus')
+  parser.add_argument('--size', dest='size', type=int, default=256, help='size of each file in KB')
+  parser.add_argument('--latency', dest='latency', type=float, default=0., help='seconds waited for each remote request')
+  parser.add_argument('--bandwidth', dest='bandwidth', type=float, default=0., help='link bandwidth in MB/s (0 means unlimited)')
+  parser.add_argument('--workers', dest='workers', type=int, default=4, help='parallel connections of the sync')
+  parser.add_argument('--compression', dest='compression', action='store_true', help='enable the on-the-wire compression')
+  parser.add_argument('--skip-single', dest='skip_single', action='store_true', help='skip the single-file functions')
+  parser.add_argument('--json', dest='json', action='store_true', help='print the results as JSON')
+
+  return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+  args = parse_args()
+
+  results = run(nfiles=args.nfiles, size=args.size * 2**10, latency=args.latency,
+                bandwidth=args.bandwidth * 2**20 if args.bandwidth > 0 else None,
+                workers=args.workers, compression=args.compression, skip_single=args.skip_single)
+
+  if args.json:
+    print(json.dumps(results, indent=2))
+
+  else:
+    print('{:<28} {:>10} {:>10} {:>10}'.format('function', 'seconds', 'files/s', 'MB/s'))
+    for r in results:
+      print('{name:<28} {seconds:>10.3f} {files_per_second:>10.1f} {mb_per_second:>10.2f}'.format(**r))
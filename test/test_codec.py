@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+The transfer codec shared by the threads of the parallel transfers
+'''
+
+import os
+import sys
+import threading
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'MedicalImageAnonymizer', 'GUI'))
+
+from _ssh_codec import TransferCodec
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+def test_shared_codec ():
+
+  codec = TransferCodec(methods=('gzip', ))
+  errors = []
+  start = threading.Barrier(8)
+
+  def worker (i):
+
+    start.wait()
+
+    try:
+      for _ in range(2000):
+        codec.select_remote('result.dcm')
+        codec.record_link(2**20, .01)
+        codec.record_codec(2**20, .02)
+
+      # the servers without gzip are found by all the workers at once
+      codec.disable('gzip')
+      assert codec.select_remote('result.dcm') is None
+
+    except Exception as e:
+      errors.append(e)
+
+  threads = [threading.Thread(target=worker, args=(i, )) for i in range(8)]
+
+  for thread in threads:
+    thread.start()
+
+  for thread in threads:
+    thread.join()
+
+  assert errors == []
+  assert codec.link_speed > 0 and codec.codec_speed > 0
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+The steps of the files shared by the GUI tabs are independent
+and the anonymization is scoped to its output directory.
+'''
+
+import os
+import sys
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'MedicalImageAnonymizer', 'GUI'))
+
+from _file_registry import FileRegistry
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+def test_pushed_raw_files_are_still_anonymized (tmp_path):
+
+  files = [str(tmp_path / name) for name in ('a.dcm', 'b.dcm', 'c.dcm')]
+  registry = FileRegistry()
+
+  assert registry.add(files) == 3
+  assert registry.add(files[:1]) == 0
+
+  # pushed (or pulled) raw from the other tabs
+  registry.mark(files[0], 'pushed')
+  registry.mark(files[1], 'pulled')
+
+  assert registry.todo('anonymized', files, scope='out') == files
+  assert registry.todo('pushed') == [os.path.realpath(f) for f in files[1:]]
+  assert registry.steps(files[0]) == {'pushed'}
+  assert registry.steps(str(tmp_path / 'missing.dcm')) is None
+
+
+def test_anonymized_is_scoped_to_the_output (tmp_path):
+
+  files = [str(tmp_path / name) for name in ('a.dcm', 'b.dcm')]
+  registry = FileRegistry()
+  registry.add(files)
+
+  registry.mark(files[0], 'anonymized', scope='out')
+
+  assert registry.todo('anonymized', files, scope='out') == files[1:]
+  # a new output directory (or alias table) processes all the files again
+  assert registry.todo('anonymized', files, scope='other') == files
+
+
+def test_unknown_state ():
+
+  with pytest.raises(ValueError):
+    FileRegistry().todo('loaded')
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+The bare package import must not load the dependencies of the
+formats and of the GUI (see benchmarks/import_time.py)
+'''
+
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+
+from import_time import root
+from import_time import _heavy
+from import_time import _statements
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+# the reader of the whole slide images is checked too
+_modules = _heavy + ('openslide', )
+
+
+def _loaded_modules (statement):
+  '''
+  heavy modules in sys.modules after the statement, run in a fresh interpreter
+  '''
+  script = '{}\nimport sys, json\nprint(json.dumps(sorted(sys.modules)))'.format(statement)
+  out = subprocess.run([sys.executable, '-c', script], cwd=root, stdout=subprocess.PIPE,
+                       universal_newlines=True, check=True).stdout
+
+  loaded = json.loads(out.splitlines()[-1])
+  return {name for name in _modules if name in loaded}
+
+
+def _import_tree (statement):
+  '''
+  top level packages in the -X importtime tree of the statement, run in a fresh interpreter
+  '''
+  err = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=root,
+                       stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+
+  # import time: self [us] | cumulative | imported package
+  names = [line.split('|')[-1].strip() for line in err.splitlines()
+           if line.startswith('import time:') and 'cumulative' not in line]
+
+  return {name.split('.')[0] for name in names}
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='the lazy imports require python 3.7 (PEP 562)')
+@pytest.mark.parametrize('statement', sorted(_statements))
+def test_import_loads_only_allowed_modules (statement):
+
+  assert _loaded_modules(statement) <= set(_statements[statement])
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='the lazy imports require python 3.7 (PEP 562)')
+def test_bare_import_loads_no_dependency ():
+
+  assert _loaded_modules('import MedicalImageAnonymizer') == set()
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime requires python 3.7')
+def test_bare_import_tree ():
+
+  tree = _import_tree('import MedicalImageAnonymizer')
+
+  assert 'MedicalImageAnonymizer' in tree
+  assert tree.isdisjoint(('pydicom', 'nibabel', 'tkinter', 'plumbum'))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+The per-file metrics of a headless run (no GUI): anonymization,
+push and pull through the local stand-in server
+'''
+
+import os
+import sys
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+sys.path.insert(0, os.path.join(here, '..', 'MedicalImageAnonymizer', 'GUI'))
+
+from plumbum import local
+from plumbum.path import Path
+from sftp_server import StandInServer
+from transfer_benchmark import _move_to_done
+from _ssh_utils import push_files
+from _ssh_utils import pull_files
+from MedicalImageAnonymizer.Metrics import metrics
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+def _write_dicom (filename):
+
+  pytest.importorskip('pydicom')
+  from pydicom.dataset import Dataset, FileMetaDataset
+  from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+  ds = Dataset()
+  ds.file_meta = FileMetaDataset()
+  ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+  ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+  ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+  ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+  ds.PatientName = 'Doe^John'
+  ds.PatientID = '123'
+
+  try:
+    ds.save_as(filename, enforce_file_format=True)
+  except TypeError:
+    # pydicom < 3
+    ds.save_as(filename, write_like_original=False)
+
+
+@pytest.fixture
+def enabled_metrics ():
+
+  metrics.enable()
+
+  try:
+    yield metrics
+  finally:
+    metrics.disable()
+
+
+def _count (operation, status='ok'):
+  return sum(value for key, value in metrics.files._values.items()
+             if dict(zip(metrics.files.labels, key)) == dict(operation=operation, format='dcm', status=status))
+
+
+def test_headless_per_file_metrics (tmp_path, enabled_metrics):
+
+  from MedicalImageAnonymizer.DICOM_anonymizer import DICOMAnonymize
+
+  root = str(tmp_path)
+  original = os.path.join(root, 'image.dcm')
+  anonymized = os.path.join(root, 'anonym', 'image.dcm')
+  os.makedirs(os.path.dirname(anonymized))
+  _write_dicom(original)
+
+  before = {operation : _count(operation) for operation in ('anonymize', 'push', 'pull')}
+  failed = _count('anonymize', 'failed')
+
+  DICOMAnonymize(original).anonymize(outfile=anonymized, outlog=os.path.join(root, 'image.json'), infolog=True)
+
+  broken = os.path.join(root, 'broken.dcm')
+
+  with open(broken, 'wb') as fp:
+    fp.write(b'not a dicom file')
+
+  with pytest.raises(Exception):
+    DICOMAnonymize(broken).anonymize(outfile=os.path.join(root, 'broken_anonym.dcm'))
+
+  base = os.path.join(root, 'remote')
+
+  for subdir in ('todo', 'done'):
+    os.makedirs(os.path.join(base, subdir))
+
+  remote = dict(base_dir=base, todo_subdir='todo', done_subdir='done')
+
+  with StandInServer(cwd=root) as server:
+    params = server.connection_params
+    list(push_files([Path(anonymized)], params, remote))
+    _move_to_done(base)
+    list(pull_files([local.path(anonymized)], local.path(os.path.join(root, 'pulled')), params, remote, ttl=0.))
+
+  for operation in ('anonymize', 'push', 'pull'):
+    assert _count(operation) == before[operation] + 1
+
+  assert _count('anonymize', 'failed') == failed + 1
+  assert 'mia_files_total{operation="push",format="dcm",status="ok"}' in metrics.render()
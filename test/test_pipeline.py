@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+The anonymize -> hash -> upload pipeline against the local stand-in
+server: the files which can not be read are reported as errors and
+the other ones are still uploaded.
+'''
+
+import os
+import sys
+import shutil
+import threading
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+sys.path.insert(0, os.path.join(here, '..', 'MedicalImageAnonymizer', 'GUI'))
+
+from sftp_server import StandInServer
+from transfer_benchmark import make_corpus
+from _pipeline import Pipeline
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+def _collect (pipeline, file_list, timeout=60.):
+  '''
+  results of the pipeline, failing (instead of hanging) if it does not end
+  '''
+  results = []
+  worker = threading.Thread(target=lambda : results.extend(pipeline.run(file_list)))
+  worker.daemon = True
+  worker.start()
+  worker.join(timeout)
+
+  assert not worker.is_alive(), 'the pipeline did not end'
+
+  return results
+
+
+def test_pipeline_reports_unreadable_inputs (tmp_path):
+
+  root = str(tmp_path)
+  files = make_corpus(os.path.join(root, 'corpus'), 4, 2048)
+  staging = os.path.join(root, 'staging')
+  os.makedirs(staging)
+  base = os.path.join(root, 'remote')
+
+  for subdir in ('todo', 'done'):
+    os.makedirs(os.path.join(base, subdir))
+
+  missing = os.path.join(root, 'corpus', 'missing.dcm')
+  broken = files[2]
+
+  def anonymize (filename):
+
+    if filename == broken:
+      raise ValueError('cannot anonymize {}'.format(filename))
+
+    outfile = os.path.join(staging, os.path.basename(filename))
+    shutil.copy(filename, outfile)
+    return outfile
+
+  remote = dict(base_dir=base, todo_subdir='todo', done_subdir='done')
+
+  with StandInServer(cwd=root) as server:
+    pipeline = Pipeline(anonymize, server.connection_params, remote, max_staging=4096, queue_size=1)
+    results = _collect(pipeline, [files[0], missing, files[1], broken, files[3]])
+
+  outcomes = {result.filename : result for result in results}
+
+  assert sorted(outcomes) == sorted([files[0], missing, files[1], broken, files[3]])
+  assert isinstance(outcomes[missing].error, FileNotFoundError)
+  assert isinstance(outcomes[broken].error, ValueError)
+
+  for filename in (files[0], files[1], files[3]):
+    assert outcomes[filename].error is None
+    assert outcomes[filename].pushed
+
+  assert len(os.listdir(os.path.join(base, 'todo'))) == 3
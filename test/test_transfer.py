@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Round trip of a small corpus through the local stand-in server:
+the pushed files, the pulled and the synced results are compared
+with the originals (content and hash).
+'''
+
+import os
+import sys
+import hashlib
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+sys.path.insert(0, os.path.join(here, '..', 'MedicalImageAnonymizer', 'GUI'))
+
+from plumbum import local
+from plumbum.path import Path
+from sftp_server import StandInServer
+from transfer_benchmark import make_corpus
+from transfer_benchmark import _move_to_done
+from _ssh_utils import push_files
+from _ssh_utils import pull_files
+from _ssh_utils import sync_results
+from _ssh_codec import TransferCodec
+
+__author__ = ['Enrico Giampieri', 'Nico Curti']
+__email__ = ['enrico.giampieri@unibo.it', 'nico.curti2@unibo.it']
+
+
+def _sha1 (filename):
+
+  with open(str(filename), 'rb') as fp:
+    return hashlib.sha1(fp.read()).hexdigest()
+
+
+@pytest.fixture
+def corpus (tmp_path):
+  '''
+  small corpus, the remote directories and a connection to the stand-in server
+  '''
+  root = str(tmp_path)
+  files = make_corpus(os.path.join(root, 'corpus'), 8, 4096)
+  base = os.path.join(root, 'remote')
+
+  for subdir in ('todo', 'done'):
+    os.makedirs(os.path.join(base, subdir))
+
+  remote = dict(base_dir=base, todo_subdir='todo', done_subdir='done')
+
+  with StandInServer(cwd=root) as server:
+    yield root, files, server.connection_params, remote
+
+
+@pytest.mark.parametrize('codec', [None, 'gzip'])
+def test_push_pull_sync (corpus, codec):
+
+  root, files, params, remote = corpus
+  codec = TransferCodec(methods=(codec, ), adaptive=False) if codec else None
+  hashes = {_sha1(f) : f for f in files}
+  todo = os.path.join(remote['base_dir'], 'todo')
+
+  # push: each file is stored in todo with its hash as name
+  pushed = list(push_files(map(Path, files), params, remote, codec=codec))
+
+  assert len(pushed) == len(files)
+  assert all(is_new for _, _, is_new in pushed)
+  assert sorted(os.listdir(todo)) == sorted(h + '.dcm' for h in hashes)
+
+  for name in os.listdir(todo):
+    origin_hash = os.path.splitext(name)[0]
+    assert _sha1(os.path.join(todo, name)) == origin_hash
+
+  # a second push finds all the files already on the server
+  assert not any(is_new for _, _, is_new in push_files(map(Path, files), params, remote, codec=codec))
+
+  _move_to_done(remote['base_dir'])
+
+  # pull into a directory which does not exist yet
+  out = os.path.join(root, 'pulled', 'nested')
+  pulled = list(pull_files(map(local.path, files), local.path(out), params, remote, ttl=0., codec=codec))
+
+  assert len(pulled) == len(files)
+
+  for origin, results in pulled:
+    assert len(results) == 1
+    assert _sha1(results[0]) == _sha1(origin)
+    assert results[0].name == origin.name
+
+  # sync with parallel connections
+  out = os.path.join(root, 'synced')
+  synced = list(sync_results(map(local.path, files), out, params, remote, workers=2, codec=codec))
+
+  assert len(synced) == len(files)
+
+  for origin, results, error in synced:
+    assert error is None
+    assert len(results) == 1
+
+    with open(str(results[0]), 'rb') as result, open(str(origin), 'rb') as fp:
+      assert result.read() == fp.read()
+
+  # the results already retrieved are not downloaded again
+  assert all(not results for _, results, _ in sync_results(map(local.path, files), out, params, remote, codec=codec))
+
+
+def test_batch_verify_before_rename (corpus, monkeypatch):
+
+  import _ssh_utils
+
+  root, files, params, remote = corpus
+  todo = os.path.join(remote['base_dir'], 'todo')
+  upload = _ssh_utils.upload_resumable
+  verify = _ssh_utils.verify_remote_files
+  corrupted = []
+
+  def corrupt_first (rem, origin, destination, *args, **kwargs):
+    upload(rem, origin, destination, *args, **kwargs)
+
+    if not corrupted:
+      # same size, different content: only the hash can detect it
+      partial = os.path.join(todo, os.path.basename(str(destination)) + '.part')
+      with open(partial, 'r+b') as fp:
+        byte = fp.read(1)
+        fp.seek(0)
+        fp.write(bytes([byte[0] ^ 0xff]))
+      corrupted.append(origin)
+
+  def check_todo (rem, expected, *args, **kwargs):
+    # nothing reaches todo before the check
+    assert os.listdir(todo) == [] or all(name.endswith('.part') for name in os.listdir(todo))
+    return verify(rem, expected, *args, **kwargs)
+
+  monkeypatch.setattr(_ssh_utils, 'upload_resumable', corrupt_first)
+  monkeypatch.setattr(_ssh_utils, 'verify_remote_files', check_todo)
+
+  pushed = list(push_files(map(Path, files), params, remote, verify='batch'))
+
+  assert corrupted and len(pushed) == len(files)
+  assert sorted(os.listdir(todo)) == sorted(_sha1(f) + '.dcm' for f in files)
+
+  for name in os.listdir(todo):
+    assert _sha1(os.path.join(todo, name)) == os.path.splitext(name)[0]
+
+
+def test_archive_members_are_known_on_the_server (corpus):
+
+  from _ssh_utils import push_archive
+  from _ssh_utils import get_destination_local
+  from _ssh_utils import query_missing_hashes
+  from _ssh_utils import _list_known_hashes
+
+  root, files, params, remote = corpus
+  todo = os.path.join(remote['base_dir'], 'todo')
+  hashes = {_sha1(f) for f in files}
+
+  destination, members = push_archive(map(Path, files[:5]), params, remote)
+
+  assert all(is_new for _, _, is_new in members)
+  archive = os.path.basename(str(destination))
+  assert sorted(os.listdir(todo)) == sorted([archive, archive + '.hashes'])
+
+  with get_destination_local(params, remote) as (rem, remote_todo, remote_done):
+    # nothing is kept on the client side: the lists on the server are read
+    assert query_missing_hashes(rem, remote_todo, remote_done, hashes) == {_sha1(f) for f in files[5:]}
+    assert hashes.difference(_list_known_hashes(remote_todo, remote_done)) == {_sha1(f) for f in files[5:]}
+
+  # only the new files are packed
+  destination, members = push_archive(map(Path, files), params, remote)
+  assert sum(is_new for _, _, is_new in members) == 3
+
+  # once the server consumes the archives, their lists are ignored
+  for name in os.listdir(todo):
+    if not name.endswith('.hashes'):
+      os.remove(os.path.join(todo, name))
+
+  with get_destination_local(params, remote) as (rem, remote_todo, remote_done):
+    assert query_missing_hashes(rem, remote_todo, remote_done, hashes) == hashes
+    assert not hashes.intersection(_list_known_hashes(remote_todo, remote_done))
+
+
+def test_authentication_errors_are_not_retried (monkeypatch):
+
+  import paramiko
+  import _ssh_utils
+  from contextlib import contextmanager
+
+  attempts = []
+
+  @contextmanager
+  def refuse (params, remote_config):
+    attempts.append(params)
+    raise paramiko.AuthenticationException('Authentication failed.')
+    yield
+
+  monkeypatch.setattr(_ssh_utils, 'get_destination_local', refuse)
+
+  with pytest.raises(paramiko.AuthenticationException):
+    list(push_files([(Path('a.dcm'), '0' * 40)], {}, {}, retries=3))
+
+  assert len(attempts) == 1
+
+
+def test_remote_sha1_errors (corpus):
+
+  from plumbum.commands.processes import ProcessExecutionError
+  from _ssh_utils import remote_sha1
+  from _ssh_utils import get_destination_local
+
+  root, files, params, remote = corpus
+
+  with get_destination_local(params, remote) as (rem, todo, done):
+    assert remote_sha1(rem, files[0]) == _sha1(files[0])
+
+    # an unreadable file is not mistaken for a missing sha1sum
+    with pytest.raises(ProcessExecutionError):
+      remote_sha1(rem, os.path.join(root, 'missing.dcm'))
+
+
+@pytest.mark.parametrize('find', [True, False])
+def test_results_in_hash_directories (corpus, monkeypatch, find):
+
+  import _ssh_utils
+  from plumbum.commands.processes import CommandNotFound
+
+  root, files, params, remote = corpus
+  done = os.path.join(remote['base_dir'], 'done')
+  origin = local.path(files[0])
+  origin_hash = _sha1(files[0])
+
+  # a result named with the hash and two inside a directory named with it
+  os.makedirs(os.path.join(done, origin_hash, 'masks'))
+  results = {origin_hash + '_seg.nii' : b'seg',
+             os.path.join(origin_hash, 'report.txt') : b'report',
+             os.path.join(origin_hash, 'masks', 'liver.nii') : b'liver'}
+
+  for name, data in results.items():
+    with open(os.path.join(done, name), 'wb') as fp:
+      fp.write(data)
+
+  if not find:
+    # the server has no GNU find: the tree is walked over SFTP
+    def no_find (directory):
+      raise CommandNotFound('find', [])
+    monkeypatch.setattr(_ssh_utils, '_find_remote_files', no_find)
+
+  expected = {name.replace(origin_hash, origin.stem) : data for name, data in results.items()}
+
+  out = os.path.join(root, 'pulled')
+  [(_, pulled)] = pull_files([origin], local.path(out), params, remote, ttl=0.)
+  assert sorted(os.path.relpath(str(p), out) for p in pulled) == sorted(expected)
+
+  out = os.path.join(root, 'synced')
+  [(_, synced, error)] = sync_results([origin], out, params, remote)
+  assert error is None
+
+  for name, data in expected.items():
+    with open(os.path.join(out, name), 'rb') as fp:
+      assert fp.read() == data